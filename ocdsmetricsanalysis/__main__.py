@@ -0,0 +1,5 @@
+import sys
+
+from ocdsmetricsanalysis.cli import main
+
+sys.exit(main())
@@ -0,0 +1,283 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional, Union
+
+from ocdsmetricsanalysis.library import (
+    ON_CONFLICT_ERROR,
+    Metric,
+    ObservationList,
+    Store,
+    load_observation_dimensions,
+)
+
+
+class AsyncStore:
+    """
+    An asyncio version of Store, for use in async code such as web applications.
+
+    Methods that need the database are coroutines. The database work is done on a pool of threads,
+    so the event loop is not blocked while it happens.
+
+    Construct: Pass database_filename, and optionally query_cache_max_entries, query_cache_max_rows,
+    read_only, immutable and mmap_size, as for Store.
+    Pass max_workers to set how many threads may work on the database at once.
+    """
+
+    def __init__(
+        self,
+        database_filename: str,
+        max_workers: int = 4,
+        query_cache_max_entries: int = 0,
+        query_cache_max_rows: Optional[int] = None,
+        read_only: bool = False,
+        immutable: bool = False,
+        mmap_size: Optional[int] = None,
+    ):
+        self._store = Store(
+            database_filename,
+            query_cache_max_entries=query_cache_max_entries,
+            query_cache_max_rows=query_cache_max_rows,
+            read_only=read_only,
+            immutable=immutable,
+            mmap_size=mmap_size,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(function, *args, **kwargs)
+        )
+
+    def get_store(self) -> Store:
+        """Returns the normal Store this wraps, for use in code that is not async."""
+        return self._store
+
+    async def add_metric(
+        self,
+        id: str,
+        title: str,
+        description: str,
+        on_conflict: str = ON_CONFLICT_ERROR,
+    ):
+        """Adds a metric to the store. See Store.add_metric."""
+        await self._run(
+            self._store.add_metric, id, title, description, on_conflict=on_conflict
+        )
+
+    async def add_metric_json(self, data: dict, on_conflict: str = ON_CONFLICT_ERROR):
+        """Adds a JSON object which is a Metric class to the store. See Store.add_metric_json."""
+        await self._run(self._store.add_metric_json, data, on_conflict=on_conflict)
+
+    async def get_metric(self, metric_id: str):
+        """Returns a specific Metric. Returns a AsyncMetric class."""
+        metric = await self._run(self._store.get_metric, metric_id)
+        return AsyncMetric(self, metric)
+
+    async def get_metrics(self) -> list:
+        """Returns a list of all metrics in this store. Each item in the list is a AsyncMetric class."""
+        metrics = await self._run(self._store.get_metrics)
+        return [AsyncMetric(self, m) for m in metrics]
+
+    async def get_data_batch(self, observation_lists: dict) -> dict:
+        """Gets the data for many AsyncObservationLists at once. See Store.get_data_batch.
+
+        The dimensions of the Observations are loaded too, so get_dimensions does not block the event loop."""
+        return await self._run(
+            self._get_data_batch,
+            {
+                key: observation_list._observation_list
+                for key, observation_list in observation_lists.items()
+            },
+        )
+
+    def _get_data_batch(self, observation_lists: dict) -> dict:
+        out = self._store.get_data_batch(observation_lists)
+        load_observation_dimensions(
+            [
+                observation
+                for observations in out.values()
+                for observation in observations
+            ]
+        )
+        return out
+
+    async def close(self):
+        """Closes all database connections and the thread pool. The store can not be used after this."""
+        await self._run(self._store.close)
+        self._executor.shutdown(wait=True)
+
+
+class AsyncMetric:
+    """An asyncio version of Metric.
+
+    Do not construct directly; instead call methods on a AsyncStore to get a metric.
+    """
+
+    def __init__(self, async_store: AsyncStore, metric: Metric):
+        self._async_store = async_store
+        self._metric = metric
+
+    def get_metric(self) -> Metric:
+        """Returns the normal Metric this wraps, for use in code that is not async."""
+        return self._metric
+
+    def get_id(self) -> str:
+        """Returns id of this Metric"""
+        return self._metric.get_id()
+
+    def get_observation_list(self):
+        """Returns a new AsyncObservationList object that you can use for filtered querying for observations."""
+        return AsyncObservationList(
+            self._async_store, self._metric.get_observation_list()
+        )
+
+    async def add_observation(
+        self,
+        id: str,
+        value_amount: Optional[str] = None,
+        value_currency: Optional[str] = None,
+        measure: Optional[str] = None,
+        dimensions: dict = {},
+        unit_name: Optional[str] = None,
+        unit_scheme: Optional[str] = None,
+        unit_id: Optional[str] = None,
+        unit_uri: Optional[str] = None,
+        on_conflict: str = ON_CONFLICT_ERROR,
+    ):
+        """Adds a new single observation to this metric and saves it in the store.
+
+        Takes the same parameters as Metric.add_observation."""
+        await self._async_store._run(
+            self._metric.add_observation,
+            id,
+            value_amount=value_amount,
+            value_currency=value_currency,
+            measure=measure,
+            dimensions=dimensions,
+            unit_name=unit_name,
+            unit_scheme=unit_scheme,
+            unit_id=unit_id,
+            unit_uri=unit_uri,
+            on_conflict=on_conflict,
+        )
+
+    async def add_aggregate_observations(
+        self,
+        data_rows: list,
+        idx_to_aggregate: Union[str, int],
+        answer_dimension_key: str,
+        **kwargs
+    ):
+        """Takes rows of data and sums up how often certain answers appear then saves new observations in the store.
+
+        Takes the same parameters as Metric.add_aggregate_observations."""
+        await self._async_store._run(
+            self._metric.add_aggregate_observations,
+            data_rows,
+            idx_to_aggregate,
+            answer_dimension_key,
+            **kwargs
+        )
+
+    async def get_json(self) -> dict:
+        """Get JSON for this Metric, including all observations for it."""
+        return await self._async_store._run(self._metric.get_json)
+
+    async def get_dimension_keys(self) -> list:
+        """Returns a list of all unique dimension keys used in all observations for this metric."""
+        return await self._async_store._run(self._metric.get_dimension_keys)
+
+
+class AsyncObservationList:
+    """An asyncio version of ObservationList.
+
+    Do not construct directly; instead call `get_observation_list` on a AsyncMetric to get an observation list.
+    """
+
+    def __init__(self, async_store: AsyncStore, observation_list: ObservationList):
+        self._async_store = async_store
+        self._observation_list = observation_list
+
+    def filter_by_dimension(self, dimension_key: str, dimension_value: str):
+        """Filter by dimension - this key must match this value exactly."""
+        self._observation_list.filter_by_dimension(dimension_key, dimension_value)
+
+    def filter_by_dimension_not_set(self, dimension_key: str):
+        """Filter by dimension - this key must not exist on the observation."""
+        self._observation_list.filter_by_dimension_not_set(dimension_key)
+
+    def order_by_id(self, descending: bool = False):
+        """Order by observation id. See ObservationList.order_by_id."""
+        self._observation_list.order_by_id(descending=descending)
+
+    def order_by_measure(self, descending: bool = False):
+        """Order by measure, as a number. See ObservationList.order_by_measure."""
+        self._observation_list.order_by_measure(descending=descending)
+
+    def order_by_dimension(self, dimension_key: str, descending: bool = False):
+        """Order by the value of a dimension. See ObservationList.order_by_dimension."""
+        self._observation_list.order_by_dimension(dimension_key, descending=descending)
+
+    def set_limit(self, limit: Optional[int]):
+        """Only get this many observations, or pass None to get them all. See ObservationList.set_limit."""
+        self._observation_list.set_limit(limit)
+
+    async def get_data(self) -> list:
+        """Returns a list of Observations.
+
+        Observations will match the filters set on this observation list. (Just don't set any filters to get all observations.)
+        The dimensions of the Observations are loaded too, so get_dimensions does not block the event loop."""
+        return await self._async_store._run(self._get_data)
+
+    def _get_data(self) -> list:
+        observations = self._observation_list.get_data()
+        load_observation_dimensions(observations)
+        return observations
+
+    async def get_data_by_dimension(self, dimension_key: str) -> dict:
+        """Returns Observations grouped by the value of a dimension key.
+
+        Returns a dict, as ObservationList.get_data_by_dimension does."""
+        return await self._async_store._run(self._get_data_by_dimension, dimension_key)
+
+    def _get_data_by_dimension(self, dimension_key: str) -> dict:
+        out = self._observation_list.get_data_by_dimension(dimension_key)
+        load_observation_dimensions(
+            [
+                observation
+                for observations in out.values()
+                for observation in observations
+            ]
+        )
+        return out
+
+    def _get_data_page(self, **page_kwargs) -> list:
+        observations = self._observation_list._get_data_page(**page_kwargs)
+        load_observation_dimensions(observations)
+        return observations
+
+    async def iter_data(self, batch_size: int = 1000):
+        """Returns an async generator of Observations, for use with `async for`.
+
+        Observations are fetched from the store batch_size at a time, each batch on the thread pool,
+        so large results do not have to be held in memory at once and other tasks can run between batches.
+        The dimensions of the Observations are loaded with each batch, so get_dimensions does not block the event loop."""
+        count_so_far = 0
+        last_id = None
+        while True:
+            page_kwargs = self._observation_list._get_next_page_kwargs(
+                batch_size, count_so_far, last_id
+            )
+            if page_kwargs is None:
+                return
+            observations = await self._async_store._run(
+                self._get_data_page, **page_kwargs
+            )
+            for observation in observations:
+                yield observation
+            if len(observations) < page_kwargs["limit"]:
+                return
+            count_so_far += len(observations)
+            last_id = observations[-1].get_id()
@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class QueryCache:
+    """A cache of query results, used by a Store.
+
+    Results are evicted least recently used first when there are more than max_entries results,
+    or when the results hold more than max_rows rows in total.
+
+    Every result is saved with the store's write generation at the time the query started.
+    A result from an older generation is never returned, so nothing written since can be missed.
+    """
+
+    def __init__(self, max_entries: int, max_rows: Optional[int] = None):
+        self._max_entries = max_entries
+        self._max_rows = max_rows
+        self._entries: OrderedDict = OrderedDict()
+        self._total_rows = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation: int) -> Optional[list]:
+        """Returns the cached rows for key, or None if there are none for this generation."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation: int, rows: list):
+        """Saves rows for key."""
+        if self._max_rows is not None and len(rows) > self._max_rows:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (generation, rows)
+            self._total_rows += len(rows)
+            while len(self._entries) > self._max_entries or (
+                self._max_rows is not None and self._total_rows > self._max_rows
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        """Removes all cached results."""
+        with self._lock:
+            self._entries = OrderedDict()
+            self._total_rows = 0
+
+    def _remove(self, key):
+        generation, rows = self._entries.pop(key)
+        self._total_rows -= len(rows)
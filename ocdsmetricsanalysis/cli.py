@@ -0,0 +1,558 @@
+import argparse
+import csv
+import itertools
+import json
+import sqlite3
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from ocdsmetricsanalysis.counting import (
+    COUNTING_BACKEND_OPTIONS,
+    GROUPING_SETS_CUBE,
+    GROUPING_SETS_ROLLUP,
+    AggregateCounter,
+)
+from ocdsmetricsanalysis.exceptions import (
+    IdClashException,
+    MetricNotFoundException,
+)
+from ocdsmetricsanalysis.library import (
+    ON_CONFLICT_ERROR,
+    ON_CONFLICT_OPTIONS,
+    ON_CONFLICT_SKIP,
+    Store,
+)
+from ocdsmetricsanalysis.sketch import AggregateSketch
+
+INPUT_FORMAT_CSV = "csv"
+INPUT_FORMAT_NDJSON = "ndjson"
+INPUT_FORMAT_OPTIONS = [INPUT_FORMAT_CSV, INPUT_FORMAT_NDJSON]
+
+OUTPUT_FORMAT_JSON = "json"
+OUTPUT_FORMAT_NDJSON = "ndjson"
+OUTPUT_FORMAT_CSV = "csv"
+OUTPUT_FORMAT_OPTIONS = [OUTPUT_FORMAT_JSON, OUTPUT_FORMAT_NDJSON, OUTPUT_FORMAT_CSV]
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+@contextmanager
+def _open_input(filename: str):
+    """Opens a file for reading text, or stdin if filename is "-"."""
+    if filename == "-":
+        yield sys.stdin
+    else:
+        with open(filename, newline="", encoding="utf-8") as fp:
+            yield fp
+
+
+@contextmanager
+def _open_output(filename: Optional[str]):
+    """Opens a file for writing text, or stdout if filename is None."""
+    if filename is None:
+        yield sys.stdout
+    else:
+        with open(filename, "w", newline="", encoding="utf-8") as fp:
+            yield fp
+
+
+def _parse_number(value):
+    """Turns a number read from CSV into an int or float. Empty values are 0."""
+    if value is None or value == "":
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+# ------------------------------- import
+
+
+def _load_json_file(filename: str):
+    with _open_input(filename) as fp:
+        return json.load(fp)
+
+
+def _iter_metrics_json(args, executor: Optional[ProcessPoolExecutor]):
+    """Yields metric JSON objects from the input files, in order.
+
+    With an executor, JSON is parsed by the worker processes."""
+    if args.ndjson:
+        for filename in args.files:
+            with _open_input(filename) as fp:
+                lines = (line for line in fp if line.strip())
+                if executor is None:
+                    for line in lines:
+                        yield json.loads(line)
+                else:
+                    while True:
+                        batch = list(itertools.islice(lines, args.jobs * 4))
+                        if not batch:
+                            break
+                        yield from executor.map(json.loads, batch)
+    else:
+        datas: Iterable
+        if executor is None or "-" in args.files:
+            datas = map(_load_json_file, args.files)
+        else:
+            datas = executor.map(_load_json_file, args.files)
+        for data in datas:
+            # A file can hold one metric, or a list of them as the export command writes.
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+
+
+def _command_import(args) -> int:
+    store = Store(args.database)
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    try:
+        for data in _iter_metrics_json(args, executor):
+            store.add_metric_json(data, on_conflict=args.on_conflict)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        store.close()
+    return 0
+
+
+# ------------------------------- aggregate
+
+
+def _get_idx_to_dimensions(dimension_arguments: list) -> dict:
+    """Turns --dimension arguments of COLUMN or COLUMN=DIMENSION_NAME into idx_to_dimensions."""
+    idx_to_dimensions = {}
+    for dimension_argument in dimension_arguments:
+        column, sep, dimension_name = dimension_argument.partition("=")
+        idx_to_dimensions[column] = {"dimension_name": dimension_name or column}
+    return idx_to_dimensions
+
+
+def _get_grouping_sets(args):
+    """Returns grouping_sets from the --grouping-sets or --grouping-set arguments."""
+    if args.grouping_set:
+        return [
+            [column for column in grouping_set.split(",") if column]
+            for grouping_set in args.grouping_set
+        ]
+    return args.grouping_sets
+
+
+def _make_counter(settings: dict, max_combinations_in_memory: Optional[int] = None):
+    """Returns a new AggregateCounter, or an AggregateSketch if counting approximately."""
+    if settings["approximate_top_n"] is not None:
+        return AggregateSketch(
+            settings["idx_to_aggregate"],
+            idx_to_dimensions=settings["idx_to_dimensions"],
+            top_n=settings["approximate_top_n"],
+            epsilon=settings["approximate_epsilon"],
+            delta=settings["approximate_delta"],
+            create_observations_from_dimensions_exponentially=settings["exponentially"],
+            grouping_sets=settings["grouping_sets"],
+        )
+    return AggregateCounter(
+        settings["idx_to_aggregate"],
+        idx_to_dimensions=settings["idx_to_dimensions"],
+        create_observations_from_dimensions_exponentially=settings["exponentially"],
+        max_combinations_in_memory=max_combinations_in_memory,
+        grouping_sets=settings["grouping_sets"],
+    )
+
+
+def _get_needed_columns(settings: dict) -> list:
+    """Returns the columns that are counted: the answer, the extra dimensions and the weight."""
+    needed_columns = [settings["idx_to_aggregate"]] + list(
+        settings["idx_to_dimensions"].keys()
+    )
+    if settings["idx_to_weight"] is not None:
+        needed_columns.append(settings["idx_to_weight"])
+    return needed_columns
+
+
+def _parse_rows(settings: dict, records, fieldnames: Optional[list]):
+    """Yields rows (dicts) from records.
+
+    For NDJSON each record is a line. For CSV each record is a list of values, in the same order as fieldnames.
+    A column missing from a row (a key left out of an NDJSON row, or a short CSV row) is empty; an empty weight is 0."""
+    idx_to_weight = settings["idx_to_weight"]
+    needed_columns = _get_needed_columns(settings)
+    for record in records:
+        if settings["input_format"] == INPUT_FORMAT_NDJSON:
+            if not record.strip():
+                continue
+            row = json.loads(record)
+        else:
+            row = dict(zip(fieldnames, record))  # type: ignore
+        for column in needed_columns:
+            if column not in row:
+                row[column] = None
+        if idx_to_weight is not None:
+            if settings["input_format"] == INPUT_FORMAT_NDJSON:
+                if row[idx_to_weight] is None:
+                    row[idx_to_weight] = 0
+            else:
+                row[idx_to_weight] = _parse_number(row[idx_to_weight])
+        yield row
+
+
+def _check_columns(settings: dict, columns, filename: str):
+    """Raises ValueError if a column that is counted is not in columns (a CSV header or the first NDJSON row)."""
+    for column in _get_needed_columns(settings):
+        if column not in columns:
+            raise ValueError(
+                "Column not found in "
+                + ("standard input" if filename == "-" else filename)
+                + ": "
+                + column
+            )
+
+
+def _iter_record_batches(settings: dict, files: list, batch_size: int):
+    """Yields tuples of a batch of records and the CSV fieldnames, reading each file as it goes.
+
+    The columns are checked against the CSV header or the first NDJSON row of each file before any are counted."""
+    for filename in files:
+        with _open_input(filename) as fp:
+            if settings["input_format"] == INPUT_FORMAT_NDJSON:
+                records: Iterator = (line for line in fp if line.strip())
+                first_record = next(records, None)
+                if first_record is not None:
+                    _check_columns(settings, json.loads(first_record), filename)
+                    records = itertools.chain([first_record], records)
+                fieldnames = None
+            else:
+                records = csv.reader(fp)
+                fieldnames = next(records, None)
+                if fieldnames is not None:
+                    _check_columns(settings, fieldnames, filename)
+            while True:
+                batch = list(itertools.islice(records, batch_size))
+                if not batch:
+                    break
+                yield batch, fieldnames
+
+
+def _count_batch(settings: dict, batch: list, fieldnames: Optional[list]):
+    """Counts one batch of records in a new counter. This runs in a worker process."""
+    counter = _make_counter(settings)
+    counter.add_rows(
+        _parse_rows(settings, batch, fieldnames),
+        idx_to_weight=settings["idx_to_weight"],
+        counting_backend=settings["counting_backend"],
+    )
+    return counter
+
+
+def _count_record_batches(settings: dict, counter, record_batches, jobs: int):
+    """Adds all the record batches to counter, in this process or with jobs worker processes."""
+    if jobs > 1:
+        # Only a few batches are waiting at any time, so input is not read faster than it can be counted.
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending: deque = deque()
+            for batch, fieldnames in record_batches:
+                pending.append(
+                    executor.submit(_count_batch, settings, batch, fieldnames)
+                )
+                if len(pending) >= jobs * 2:
+                    counter.merge(pending.popleft().result())
+            while pending:
+                counter.merge(pending.popleft().result())
+    else:
+        for batch, fieldnames in record_batches:
+            counter.add_rows(
+                _parse_rows(settings, batch, fieldnames),
+                idx_to_weight=settings["idx_to_weight"],
+                counting_backend=settings["counting_backend"],
+            )
+
+
+def _command_aggregate(args) -> int:
+    settings = {
+        "input_format": args.input_format,
+        "idx_to_aggregate": args.aggregate,
+        "idx_to_dimensions": _get_idx_to_dimensions(args.dimension),
+        "idx_to_weight": args.weight,
+        "exponentially": args.exponentially,
+        "grouping_sets": _get_grouping_sets(args),
+        "counting_backend": args.counting_backend,
+        "approximate_top_n": args.approximate_top_n,
+        "approximate_epsilon": args.approximate_epsilon,
+        "approximate_delta": args.approximate_delta,
+    }
+    # Counters made in worker processes only hold one batch, so only this one may need to spill to disk.
+    counter = _make_counter(
+        settings, max_combinations_in_memory=args.max_combinations_in_memory
+    )
+    try:
+        _count_record_batches(
+            settings,
+            counter,
+            _iter_record_batches(settings, args.files, args.batch_size),
+            args.jobs,
+        )
+        store = Store(args.database)
+        try:
+            store.add_metric(
+                args.metric_id,
+                args.title or args.metric_id,
+                args.description or "",
+                on_conflict=ON_CONFLICT_SKIP,
+            )
+            metric = store.get_metric(args.metric_id)
+            if isinstance(counter, AggregateSketch):
+                metric.add_aggregate_observations_from_sketch(
+                    counter,
+                    args.answer_dimension_key,
+                    unit_name=args.unit_name,
+                    on_conflict=args.on_conflict,
+                )
+            else:
+                metric.add_aggregate_observations_from_counter(
+                    counter,
+                    args.answer_dimension_key,
+                    unit_name=args.unit_name,
+                    on_conflict=args.on_conflict,
+                )
+        finally:
+            store.close()
+    finally:
+        if isinstance(counter, AggregateCounter):
+            counter.close()
+    return 0
+
+
+# ------------------------------- export
+
+
+def _command_export(args) -> int:
+    store = Store(
+        args.database,
+        read_only=True,
+        immutable=args.immutable,
+        mmap_size=args.mmap_size,
+    )
+    try:
+        if args.metric is not None:
+            # Check it exists before writing anything
+            metric = store.get_metric(args.metric)
+        with _open_output(args.output) as fp:
+            if args.format == OUTPUT_FORMAT_JSON:
+                if args.metric is not None:
+                    metric.write_json(fp)
+                else:
+                    fp.write("[")
+                    for i, metric in enumerate(store.get_metrics()):
+                        if i > 0:
+                            fp.write(",")
+                        metric.write_json(fp)
+                    fp.write("]")
+                fp.write("\n")
+            elif args.format == OUTPUT_FORMAT_NDJSON:
+                store.export_ndjson(
+                    fp,
+                    metric_id=args.metric,
+                    dimensions_as_columns=bool(args.dimensions_as_columns),
+                )
+            else:
+                store.export_csv(
+                    fp,
+                    metric_id=args.metric,
+                    dimensions_as_columns=args.dimensions_as_columns is not False,
+                )
+    finally:
+        store.close()
+    return 0
+
+
+# ------------------------------- main
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be 1 or more")
+    return number
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Returns the argument parser for the command line tool."""
+    parser = argparse.ArgumentParser(
+        prog="ocdsmetricsanalysis",
+        description="Import, aggregate and export OCDS metrics and observations.",
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.required = True
+
+    import_parser = subparsers.add_parser(
+        "import", help="Import metric JSON into a store."
+    )
+    import_parser.add_argument("database", help="The store's database file.")
+    import_parser.add_argument(
+        "files",
+        nargs="*",
+        default=["-"],
+        metavar="FILE",
+        help="Metric JSON files; a file can hold one metric or a list of them. Default or - is stdin.",
+    )
+    import_parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Files have one metric per line, so they can be read one metric at a time.",
+    )
+    import_parser.add_argument(
+        "--on-conflict", choices=ON_CONFLICT_OPTIONS, default=ON_CONFLICT_ERROR
+    )
+    import_parser.add_argument(
+        "--jobs",
+        type=_positive_int,
+        default=1,
+        help="Number of processes to parse JSON with.",
+    )
+    import_parser.set_defaults(function=_command_import)
+
+    aggregate_parser = subparsers.add_parser(
+        "aggregate",
+        help="Count answers in rows of data and save them as observations of a metric.",
+    )
+    aggregate_parser.add_argument("database", help="The store's database file.")
+    aggregate_parser.add_argument(
+        "metric_id", help="The metric to add to. It is made if it does not exist."
+    )
+    aggregate_parser.add_argument(
+        "files",
+        nargs="*",
+        default=["-"],
+        metavar="FILE",
+        help="Files of rows of data. Default or - is stdin.",
+    )
+    aggregate_parser.add_argument(
+        "--input-format", choices=INPUT_FORMAT_OPTIONS, default=INPUT_FORMAT_CSV
+    )
+    aggregate_parser.add_argument(
+        "--aggregate", required=True, metavar="COLUMN", help="The column to count."
+    )
+    aggregate_parser.add_argument("--answer-dimension-key", default="answer")
+    aggregate_parser.add_argument(
+        "--dimension",
+        action="append",
+        default=[],
+        metavar="COLUMN[=DIMENSION_NAME]",
+        help="An extra dimension. Can be passed more than once.",
+    )
+    aggregate_parser.add_argument(
+        "--exponentially",
+        action="store_true",
+        help="Make observations for every combination of extra dimensions.",
+    )
+    aggregate_parser.add_argument(
+        "--grouping-sets",
+        choices=[GROUPING_SETS_CUBE, GROUPING_SETS_ROLLUP],
+        help="Make observations for every combination of extra dimensions (cube), or for the first one, then the first two, and so on (rollup).",
+    )
+    aggregate_parser.add_argument(
+        "--grouping-set",
+        action="append",
+        default=[],
+        metavar="COLUMN,COLUMN...",
+        help="Make observations for this combination of extra dimensions. Can be passed more than once. Pass an empty value for just the answers.",
+    )
+    aggregate_parser.add_argument(
+        "--weight",
+        metavar="COLUMN",
+        help="Column saying how many times each row happened.",
+    )
+    aggregate_parser.add_argument("--title")
+    aggregate_parser.add_argument("--description")
+    aggregate_parser.add_argument("--unit-name")
+    aggregate_parser.add_argument(
+        "--on-conflict", choices=ON_CONFLICT_OPTIONS, default=ON_CONFLICT_ERROR
+    )
+    aggregate_parser.add_argument(
+        "--counting-backend", choices=COUNTING_BACKEND_OPTIONS
+    )
+    aggregate_parser.add_argument(
+        "--approximate-top-n",
+        type=_positive_int,
+        help="Count approximately in a fixed amount of memory.",
+    )
+    aggregate_parser.add_argument("--approximate-epsilon", type=float, default=0.001)
+    aggregate_parser.add_argument("--approximate-delta", type=float, default=0.01)
+    aggregate_parser.add_argument(
+        "--batch-size",
+        type=_positive_int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of rows to read and count at once.",
+    )
+    aggregate_parser.add_argument(
+        "--max-combinations-in-memory",
+        type=_positive_int,
+        help="Move counts to a temporary database on disk when there are more different combinations of values than this.",
+    )
+    aggregate_parser.add_argument(
+        "--jobs",
+        type=_positive_int,
+        default=1,
+        help="Number of processes to count batches with.",
+    )
+    aggregate_parser.set_defaults(function=_command_aggregate)
+
+    export_parser = subparsers.add_parser("export", help="Export data from a store.")
+    export_parser.add_argument("database", help="The store's database file.")
+    export_parser.add_argument(
+        "--metric", metavar="METRIC_ID", help="Only export this metric."
+    )
+    export_parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMAT_OPTIONS,
+        default=OUTPUT_FORMAT_JSON,
+        help="json is metric JSON (a list of metrics, unless --metric is passed). ndjson and csv have one observation per row.",
+    )
+    export_parser.add_argument(
+        "--dimensions-as-columns",
+        action="store_true",
+        default=None,
+        help="For ndjson, give each dimension key its own column. This is the default for csv.",
+    )
+    export_parser.add_argument(
+        "--no-dimensions-as-columns",
+        action="store_false",
+        dest="dimensions_as_columns",
+        help="For csv, put all dimensions in one column.",
+    )
+    export_parser.add_argument(
+        "--immutable",
+        action="store_true",
+        help="Nothing will change the database while exporting, so it can be read without locking.",
+    )
+    export_parser.add_argument(
+        "--mmap-size",
+        type=int,
+        metavar="BYTES",
+        help="Read the database with memory-mapped I/O, up to this many bytes.",
+    )
+    export_parser.add_argument(
+        "--output", metavar="FILE", help="File to write to. Default is stdout."
+    )
+    export_parser.set_defaults(function=_command_export)
+
+    return parser
+
+
+def main(argv: Optional[list] = None) -> int:
+    """Runs the command line tool. Returns the exit code."""
+    args = get_parser().parse_args(argv)
+    try:
+        return args.function(args)
+    except (
+        MetricNotFoundException,
+        IdClashException,
+        ValueError,
+        sqlite3.OperationalError,
+    ) as e:
+        print("Error: " + str(e), file=sys.stderr)
+        return 1
@@ -0,0 +1,503 @@
+import itertools
+import sqlite3
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Mapping
+from typing import Optional, Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
+COUNTING_BACKEND_PYTHON = "python"
+COUNTING_BACKEND_NUMPY = "numpy"
+COUNTING_BACKEND_OPTIONS = [COUNTING_BACKEND_PYTHON, COUNTING_BACKEND_NUMPY]
+
+# When memory use must be bounded and no batch_size is passed, rows are counted this many at a time
+BOUNDED_MEMORY_BATCH_SIZE = 10000
+
+# Combined codes are squashed back down before they could get bigger than this
+_NUMPY_MAX_COMBINED_CODE = 2**62
+
+GROUPING_SETS_CUBE = "cube"
+GROUPING_SETS_ROLLUP = "rollup"
+
+# In the spill database, counts of the answer and every extra dimension have this grouping.
+# Counts for the groupings observations are made for are summed up from them.
+_SPILL_ALL_DIMENSIONS_GROUPING = -1
+
+
+def get_columns(
+    data_rows: Union[list, Mapping],
+    column_idxs: list,
+    idx_to_weight: Optional[Union[str, int]] = None,
+) -> tuple:
+    """Gets columns of data from data rows.
+
+    data_rows can be a list of rows (each row a dict or list), or it can already be columns of data:
+    a dict of column name to a sequence of values, all the same length.
+
+    Returns a tuple. The first item is a dict of column idx to a sequence of values.
+    The second is a sequence of weights if idx_to_weight was passed, or None."""
+    if isinstance(data_rows, Mapping):
+        columns: dict = {idx: data_rows[idx] for idx in column_idxs}
+        weights = data_rows[idx_to_weight] if idx_to_weight is not None else None
+        lengths = set([len(c) for c in columns.values()])
+        if weights is not None:
+            lengths.add(len(weights))
+        if len(lengths) > 1:
+            raise ValueError("All columns of data must be the same length")
+    else:
+        columns = {idx: [d[idx] for d in data_rows] for idx in column_idxs}
+        weights = (
+            [d[idx_to_weight] for d in data_rows] if idx_to_weight is not None else None
+        )
+    return columns, weights
+
+
+def iter_column_batches(
+    data_rows: Union[Iterable, Mapping],
+    column_idxs: list,
+    idx_to_weight: Optional[Union[str, int]] = None,
+    batch_size: Optional[int] = None,
+):
+    """Yields columns of data from data rows, batch_size rows at a time. Each item is a tuple, as get_columns returns.
+
+    data_rows can be anything get_columns takes, or any other iterable of rows such as a generator or a file reader;
+    only one batch of rows is held in memory at once.
+    If batch_size is None, all the rows are one batch."""
+    if isinstance(data_rows, Mapping):
+        columns, weights = get_columns(data_rows, column_idxs, idx_to_weight)
+        length = len(columns[column_idxs[0]])
+        if batch_size is None or length <= batch_size:
+            yield columns, weights
+            return
+        for start in range(0, length, batch_size):
+            end = start + batch_size
+            yield (
+                {idx: column[start:end] for idx, column in columns.items()},
+                weights[start:end] if weights is not None else None,
+            )
+    elif batch_size is None and isinstance(data_rows, list):
+        yield get_columns(data_rows, column_idxs, idx_to_weight)
+    else:
+        data_rows_iterator = iter(data_rows)
+        while True:
+            batch = list(itertools.islice(data_rows_iterator, batch_size))
+            if not batch:
+                return
+            yield get_columns(batch, column_idxs, idx_to_weight)
+
+
+def get_dimension_groupings(
+    idx_to_dimensions: dict,
+    create_observations_from_dimensions_exponentially: bool,
+    grouping_sets: Optional[Union[str, list]] = None,
+) -> list:
+    """Returns the sets of extra dimensions that observations are made for, as a list of tuples of dimension idxs.
+
+    By default the first is an empty tuple, for the observations of just the answers.
+    Then there is one for each extra dimension, or if create_observations_from_dimensions_exponentially is set
+    one for every combination of extra dimensions.
+
+    grouping_sets can instead be "cube" (the same as create_observations_from_dimensions_exponentially),
+    "rollup" (the answers, then the first extra dimension, then the first two, and so on)
+    or a list of lists of dimension idxs."""
+    if grouping_sets is not None and create_observations_from_dimensions_exponentially:
+        raise ValueError(
+            "Pass grouping_sets or create_observations_from_dimensions_exponentially, not both"
+        )
+    if grouping_sets == GROUPING_SETS_CUBE:
+        create_observations_from_dimensions_exponentially = True
+    elif grouping_sets == GROUPING_SETS_ROLLUP:
+        idxs = list(idx_to_dimensions.keys())
+        return [tuple(idxs[:i]) for i in range(len(idxs) + 1)]
+    elif isinstance(grouping_sets, str):
+        raise ValueError(
+            "grouping_sets must be a list, "
+            + GROUPING_SETS_CUBE
+            + " or "
+            + GROUPING_SETS_ROLLUP
+        )
+    elif grouping_sets is not None:
+        for grouping_set in grouping_sets:
+            for idx in grouping_set:
+                if idx not in idx_to_dimensions:
+                    raise ValueError(
+                        "grouping_sets has a dimension not in idx_to_dimensions: "
+                        + str(idx)
+                    )
+        return [tuple(grouping_set) for grouping_set in grouping_sets]
+
+    groupings: list = [()]
+    if create_observations_from_dimensions_exponentially:
+        for idx in idx_to_dimensions.keys():
+            groupings.extend([grouping + (idx,) for grouping in groupings])
+    else:
+        groupings.extend([(idx,) for idx in idx_to_dimensions.keys()])
+    return groupings
+
+
+def get_grouping_positions(idx_to_dimensions: dict, grouping: tuple) -> list:
+    """Returns where the values for a grouping are, in a key of counts of the answer and then every extra dimension."""
+    idxs = list(idx_to_dimensions.keys())
+    return [0] + [1 + idxs.index(idx) for idx in grouping]
+
+
+def sum_counts_for_grouping(counts: dict, positions: list) -> dict:
+    """Takes counts of the answer and every extra dimension, and sums them up for a grouping.
+
+    positions is from get_grouping_positions. Keys with an empty value are left out, as no observation is made for them."""
+    out: dict = defaultdict(int)
+    for key, count in counts.items():
+        grouping_key = tuple(key[p] for p in positions)
+        if all(grouping_key):
+            out[grouping_key] += count
+    return out
+
+
+def get_possible_values(column) -> list:
+    """Returns a sorted list of the distinct values in a column, leaving out empty values."""
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        try:
+            # tolist also turns NumPy values into normal Python values, that can be saved in the database.
+            values = numpy.unique(column).tolist()
+        except TypeError:
+            values = column.tolist()
+    else:
+        values = column
+    return sorted(list(set([v for v in values if v])))
+
+
+class CombinationCounter:
+    """Counts how often each combination of values appears in some columns of data.
+
+    Construct: Pass columns, a dict of column key to a sequence of values. All sequences must be the same length.
+
+    Pass backend to choose how counting is done; "python" or "numpy".
+    By default NumPy is used if it is installed. Both give exactly the same counts, except for mixed int and float weights (see below).
+
+    Pass weights, a sequence of numbers the same length as the columns, if each row should count that many times instead of once.
+    With the python backend, each count is the Python sum of its weights, so it is an int if all its weights are ints and a float otherwise.
+    With the numpy backend, weights are first made into one NumPy array, so if any weight is a float every count is a float.
+    """
+
+    def __init__(self, columns: dict, backend: Optional[str] = None, weights=None):
+        if backend is None:
+            backend = (
+                COUNTING_BACKEND_NUMPY if numpy is not None else COUNTING_BACKEND_PYTHON
+            )
+        if backend not in COUNTING_BACKEND_OPTIONS:
+            raise ValueError(
+                "counting_backend must be one of " + str(COUNTING_BACKEND_OPTIONS)
+            )
+        if backend == COUNTING_BACKEND_NUMPY and numpy is None:
+            raise ValueError("The numpy counting backend needs NumPy to be installed")
+        self._columns = columns
+        self._backend = backend
+        self._weights = weights
+        # Column key to array of integer codes, one per row. Only used by the numpy backend.
+        self._codes: dict = {}
+
+    def count(self, keys: tuple) -> dict:
+        """Returns a dict. The key is a tuple of values, one from each column in keys, and the value is how many rows have them."""
+        if self._backend == COUNTING_BACKEND_NUMPY:
+            return self._count_numpy(keys)
+        combinations = zip(*[self._columns[k] for k in keys])
+        if self._weights is None:
+            return dict(Counter(combinations))
+        weights = self._weights
+        if numpy is not None and isinstance(weights, numpy.ndarray):
+            # Summing NumPy numbers gives NumPy numbers, which can not be saved in the database.
+            weights = weights.tolist()
+        out: dict = defaultdict(int)
+        for combination, weight in zip(combinations, weights):
+            out[combination] += weight
+        return dict(out)
+
+    def _get_codes(self, key):
+        """Returns the column as an array of integer codes, one per distinct value, and how many distinct values there are."""
+        if key not in self._codes:
+            column = self._columns[key]
+            if isinstance(column, numpy.ndarray) and column.dtype.kind != "O":
+                uniques, codes = numpy.unique(column, return_inverse=True)
+                self._codes[key] = (codes.reshape(-1), len(uniques))
+            else:
+                # A list may have values of different types that NumPy would convert to the same string,
+                # so factorise with a dict to keep exactly the same matching as Python.
+                code_by_value: dict = {}
+                codes = numpy.fromiter(
+                    (code_by_value.setdefault(v, len(code_by_value)) for v in column),
+                    dtype=numpy.int64,
+                    count=len(column),
+                )
+                self._codes[key] = (codes, len(code_by_value))
+        return self._codes[key]
+
+    def _count_numpy(self, keys: tuple) -> dict:
+        if len(self._columns[keys[0]]) == 0:
+            return {}
+        combined = numpy.zeros(len(self._columns[keys[0]]), dtype=numpy.int64)
+        combined_size = 1
+        for key in keys:
+            codes, size = self._get_codes(key)
+            if combined_size * size > _NUMPY_MAX_COMBINED_CODE:
+                uniques, combined = numpy.unique(combined, return_inverse=True)
+                combined = combined.reshape(-1)
+                combined_size = len(uniques)
+            combined = combined * size + codes
+            combined_size *= size
+        if self._weights is None:
+            uniques, first_indexes, counts = numpy.unique(
+                combined, return_index=True, return_counts=True
+            )
+        else:
+            uniques, first_indexes, inverse = numpy.unique(
+                combined, return_index=True, return_inverse=True
+            )
+            weights = numpy.asarray(self._weights)
+            if weights.dtype.kind in "biu":
+                # Add in integers, so big counts are exact
+                counts = numpy.zeros(len(uniques), dtype=numpy.int64)
+                numpy.add.at(counts, inverse.reshape(-1), weights)
+            else:
+                counts = numpy.bincount(
+                    inverse.reshape(-1), weights=weights, minlength=len(uniques)
+                )
+        columns = [self._columns[k] for k in keys]
+        return {
+            tuple(column[i] for column in columns): count
+            for i, count in zip(first_indexes.tolist(), counts.tolist())
+        }
+
+
+def to_python_value(value):
+    """Turns a NumPy value, which can be in keys counted from NumPy arrays, into a normal Python value.
+
+    Other values are returned as they are."""
+    if numpy is not None and isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+class AggregateCounter:
+    """Exactly counts how often answers appear in rows of data. This is what Metric.add_aggregate_observations uses.
+
+    Rows can be added all at once or in batches, so they can be streamed in without holding them all in memory.
+    Memory use grows with the number of different combinations of values, not the number of rows.
+    Counters made with the same settings can be merged, so different processes can each count part of the data.
+    Then pass it to Metric.add_aggregate_observations_from_counter.
+
+    Each row is counted once, for the combination of its answer and all its extra dimensions.
+    The counts for each grouping of extra dimensions are summed up from those when observations are made,
+    so asking for more groupings does not mean reading the rows again.
+
+    Construct: Pass idx_to_aggregate, idx_to_dimensions, create_observations_from_dimensions_exponentially
+    and grouping_sets, as for Metric.add_aggregate_observations.
+
+    If there may be too many different combinations of values to fit in memory, pass max_combinations_in_memory.
+    When more combinations than that are held in memory, their counts are added to a temporary database on disk and memory is freed.
+    Rows are then always counted in batches, so no more than one batch of counts is held in memory besides those.
+    The values seen in each column are moved there too. The counts for each grouping are then summed up,
+    and every combination of values made, by the database, so neither has to fit in memory. Counts are still exact.
+    Call close when finished to delete the temporary database.
+    """
+
+    def __init__(
+        self,
+        idx_to_aggregate: Union[str, int],
+        idx_to_dimensions: dict = {},
+        create_observations_from_dimensions_exponentially: bool = False,
+        max_combinations_in_memory: Optional[int] = None,
+        grouping_sets: Optional[Union[str, list]] = None,
+    ):
+        self.idx_to_aggregate = idx_to_aggregate
+        self.idx_to_dimensions = idx_to_dimensions
+        self._groupings = get_dimension_groupings(
+            idx_to_dimensions,
+            create_observations_from_dimensions_exponentially,
+            grouping_sets=grouping_sets,
+        )
+        self._max_combinations_in_memory = max_combinations_in_memory
+        self._idxs = [idx_to_aggregate] + list(idx_to_dimensions.keys())
+        # Every value seen in each column. An observation is made for each, even if it is never seen with an answer.
+        # Once counts are spilled, these only hold the values seen since the last spill.
+        self._possible_values: dict = {idx: set() for idx in self._idxs}
+        # Key is a tuple of the answer and every extra dimension
+        self._counts: dict = defaultdict(int)
+        # The temporary database counts are spilled to. Only made when first needed.
+        self._spill_connection: Optional[sqlite3.Connection] = None
+
+    def add_rows(
+        self,
+        data_rows: Union[Iterable, Mapping],
+        idx_to_weight: Optional[Union[str, int]] = None,
+        counting_backend: Optional[str] = None,
+        batch_size: Optional[int] = None,
+    ):
+        """Adds rows of data. data_rows, idx_to_weight and counting_backend are as for Metric.add_aggregate_observations.
+
+        data_rows can also be any iterable of rows, such as a generator. Pass batch_size to only hold that many rows in memory at once.
+        If max_combinations_in_memory was passed and batch_size is not, BOUNDED_MEMORY_BATCH_SIZE is used.
+        """
+        if batch_size is None and self._max_combinations_in_memory is not None:
+            batch_size = BOUNDED_MEMORY_BATCH_SIZE
+        for columns, weights in iter_column_batches(
+            data_rows, self._idxs, idx_to_weight=idx_to_weight, batch_size=batch_size
+        ):
+            for idx, column in columns.items():
+                self._possible_values[idx].update(get_possible_values(column))
+            combination_counter = CombinationCounter(
+                columns, backend=counting_backend, weights=weights
+            )
+            for key, count in combination_counter.count(tuple(self._idxs)).items():
+                # No observation is made for an empty answer, so there is no need to keep its count.
+                # Empty extra dimensions are kept, as the row still counts for groupings without that dimension.
+                if key[0]:
+                    self._counts[key] += count
+                    self._spill_if_needed()
+
+    def merge(self, other: "AggregateCounter"):
+        """Adds the counts from another AggregateCounter, made with the same settings, to this one."""
+        if self._groupings != other._groupings or self._idxs != other._idxs:
+            raise ValueError("Can only merge counters with the same settings")
+        for idx, values in other._possible_values.items():
+            self._possible_values[idx].update(values)
+        for key, count in other._counts.items():
+            self._counts[key] += count
+            self._spill_if_needed()
+        if other._spill_connection is not None:
+            self._spill(
+                "?",
+                other._spill_connection.execute(
+                    "SELECT key, count FROM spilled_count WHERE grouping=?",
+                    (_SPILL_ALL_DIMENSIONS_GROUPING,),
+                ),
+                other._spill_connection.execute(
+                    "SELECT position, value FROM spilled_value"
+                ),
+            )
+
+    def _spill_if_needed(self):
+        if (
+            self._max_combinations_in_memory is not None
+            and len(self._counts) > self._max_combinations_in_memory
+        ):
+            self._spill_counts()
+
+    def _spill_counts(self):
+        """Moves all counts and possible values held in memory to the spill database."""
+        # Keys are made into JSON by the database, so they are made in the same way as keys summed up for a grouping.
+        self._spill(
+            "json_array(" + ", ".join(["?"] * len(self._idxs)) + ")",
+            (
+                tuple(to_python_value(v) for v in key) + (to_python_value(count),)
+                for key, count in self._counts.items()
+            ),
+            (
+                (position, to_python_value(value))
+                for position, idx in enumerate(self._idxs)
+                for value in self._possible_values[idx]
+            ),
+        )
+        self._counts.clear()
+        for values in self._possible_values.values():
+            values.clear()
+
+    def _spill(self, key_sql: str, rows, value_rows):
+        """Adds counts for the answer and every extra dimension, and possible values, to the spill database.
+
+        key_sql is the SQL to make the key from parameters. Each row is a tuple of those parameters and the count.
+        Each value row is a tuple of the position of the column in a key, and a value."""
+        if self._spill_connection is None:
+            # An empty filename makes a private temporary database on disk, which is deleted when it is closed.
+            self._spill_connection = sqlite3.connect("")
+            self._spill_connection.execute(
+                "CREATE TABLE spilled_count(grouping INTEGER, key TEXT, count, PRIMARY KEY(grouping, key))"
+            )
+            self._spill_connection.execute(
+                "CREATE TABLE spilled_value(position INTEGER, value, PRIMARY KEY(position, value))"
+            )
+        with self._spill_connection:
+            self._spill_connection.executemany(
+                "INSERT INTO spilled_count (grouping, key, count) VALUES ("
+                + str(_SPILL_ALL_DIMENSIONS_GROUPING)
+                + ", "
+                + key_sql
+                + ", ?) ON CONFLICT (grouping, key) DO UPDATE SET count=count+excluded.count",
+                rows,
+            )
+            self._spill_connection.executemany(
+                "INSERT OR IGNORE INTO spilled_value (position, value) VALUES (?, ?)",
+                value_rows,
+            )
+
+    def _sum_spilled_counts_for_grouping(self, grouping_index: int, positions: list):
+        """Sums up the spilled counts for a grouping, in the spill database."""
+        values_sql = ", ".join(
+            ["json_extract(key, '$[" + str(p) + "]')" for p in positions]
+        )
+        with self._spill_connection:  # type: ignore
+            self._spill_connection.execute(  # type: ignore
+                "DELETE FROM spilled_count WHERE grouping=?", (grouping_index,)
+            )
+            self._spill_connection.execute(  # type: ignore
+                "INSERT INTO spilled_count (grouping, key, count) "
+                + "SELECT ?, json_array("
+                + values_sql
+                + "), SUM(count) FROM spilled_count WHERE grouping=? GROUP BY 2",
+                (grouping_index, _SPILL_ALL_DIMENSIONS_GROUPING),
+            )
+
+    def _iter_spilled_combinations(self, grouping_index: int, positions: list):
+        """Yields every combination of possible values for a grouping, in order, with its count, from the spill database.
+
+        The combinations are made and ordered by the database, and read one at a time."""
+        tables = ["v" + str(i) for i in range(len(positions))]
+        cursor = self._spill_connection.execute(  # type: ignore
+            "SELECT "
+            + ", ".join([t + ".value" for t in tables])
+            + ", COALESCE(spilled_count.count, 0) FROM "
+            + " CROSS JOIN ".join(["spilled_value " + t for t in tables])
+            + " LEFT JOIN spilled_count ON spilled_count.grouping=? AND spilled_count.key=json_array("
+            + ", ".join([t + ".value" for t in tables])
+            + ") WHERE "
+            + " AND ".join([t + ".position=?" for t in tables])
+            + " ORDER BY "
+            + ", ".join([t + ".value" for t in tables]),
+            [grouping_index] + positions,
+        )
+        for row in cursor:
+            yield row[:-1], row[-1]
+
+    def iter_combinations(self):
+        """Yields the combinations to make observations for, with their counts.
+
+        First come the answers, then the combinations for each extra dimension (or combination of extra dimensions).
+        Each item is a tuple of the extra dimension idxs, a tuple of values (answer first), and the count.
+        Every combination of possible values is included, even if its count is 0."""
+        if self._spill_connection is not None:
+            self._spill_counts()
+        for grouping_index, grouping in enumerate(self._groupings):
+            positions = get_grouping_positions(self.idx_to_dimensions, grouping)
+            if self._spill_connection is None:
+                counts = sum_counts_for_grouping(self._counts, positions)
+                for values in itertools.product(
+                    *[
+                        sorted(self._possible_values[idx])
+                        for idx in (self.idx_to_aggregate,) + grouping
+                    ]
+                ):
+                    yield grouping, values, counts.get(values, 0)
+            else:
+                self._sum_spilled_counts_for_grouping(grouping_index, positions)
+                for values, count in self._iter_spilled_combinations(
+                    grouping_index, positions
+                ):
+                    yield grouping, values, count
+
+    def close(self):
+        """Deletes the temporary database, if counts were spilled to one."""
+        if self._spill_connection is not None:
+            self._spill_connection.close()
+            self._spill_connection = None
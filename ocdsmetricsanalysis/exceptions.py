@@ -1,2 +1,10 @@
 class MetricNotFoundException(Exception):
     pass
+
+
+class IdClashException(Exception):
+    pass
+
+
+class ReadOnlyStoreException(Exception):
+    pass
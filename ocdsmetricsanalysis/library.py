@@ -1,9 +1,125 @@
-import copy
+import csv
+import json
+import os
+import pathlib
+import shutil
 import sqlite3
+import tempfile
+import threading
+import weakref
 from collections import defaultdict
+from collections.abc import Iterable, Mapping
+from contextlib import contextmanager
 from typing import Optional, Union
 
-from ocdsmetricsanalysis.exceptions import MetricNotFoundException
+from ocdsmetricsanalysis.cache import QueryCache
+from ocdsmetricsanalysis.counting import AggregateCounter
+from ocdsmetricsanalysis.exceptions import (
+    IdClashException,
+    MetricNotFoundException,
+    ReadOnlyStoreException,
+)
+from ocdsmetricsanalysis.sketch import AggregateSketch
+
+ON_CONFLICT_ERROR = "error"
+ON_CONFLICT_SKIP = "skip"
+ON_CONFLICT_REPLACE = "replace"
+ON_CONFLICT_MERGE = "merge"
+ON_CONFLICT_OPTIONS = [
+    ON_CONFLICT_ERROR,
+    ON_CONFLICT_SKIP,
+    ON_CONFLICT_REPLACE,
+    ON_CONFLICT_MERGE,
+]
+
+# NULL values are never equal in a primary key, so ON CONFLICT would not catch them.
+# Instead the count is updated if the row is there (comparing with IS, so NULL matches NULL), and the row added if not.
+DIMENSION_CATALOG_ADD_SQL = (
+    "UPDATE dimension_catalog SET observation_count=observation_count+1 "
+    + "WHERE metric_id=NEW.metric_id AND key=NEW.key AND value IS NEW.value; "
+    + "INSERT INTO dimension_catalog (metric_id, key, value, observation_count) "
+    + "SELECT NEW.metric_id, NEW.key, NEW.value, 1 WHERE NOT EXISTS ("
+    + "SELECT 1 FROM dimension_catalog WHERE metric_id=NEW.metric_id AND key=NEW.key AND value IS NEW.value);"
+)
+DIMENSION_CATALOG_REMOVE_SQL = (
+    "UPDATE dimension_catalog SET observation_count=observation_count-1 "
+    + "WHERE metric_id=OLD.metric_id AND key=OLD.key AND value IS OLD.value; "
+    + "DELETE FROM dimension_catalog "
+    + "WHERE metric_id=OLD.metric_id AND key=OLD.key AND value IS OLD.value AND observation_count<=0;"
+)
+
+# The most observation lists queried in one statement by Store.get_data_batch.
+# SQLite allows no more than 500 SELECTs joined by UNION ALL, and a limited number of parameters.
+BATCH_QUERY_MAX_OBSERVATION_LISTS = 50
+
+# How many observation ids load_observation_dimensions puts in one query
+LOAD_DIMENSIONS_MAX_IDS = 500
+
+ORDER_BY_ID = "id"
+ORDER_BY_MEASURE = "measure"
+ORDER_BY_DIMENSION = "dimension"
+
+DIFF_ADDED = "added"
+DIFF_REMOVED = "removed"
+DIFF_CHANGED = "changed"
+
+METRIC_COLUMNS = "id, title, description, approximate_epsilon, approximate_delta, approximate_max_error"
+
+OBSERVATION_COLUMNS = "metric_id, id, value_amount, value_currency, measure, unit_name, unit_scheme, unit_id, unit_uri"
+
+# Builds the same JSON for an observation (as o) as Metric.get_json does, inside the database.
+# Every key is put in, then json_remove takes out value, measure and unit if they are empty.
+# "$.none" is not a key the object has, so json_remove does nothing with it.
+OBSERVATION_JSON_SQL = (
+    "json_remove(json_object("
+    + "'id', o.id, "
+    + "'dimensions', json((SELECT json_group_object(d.key, d.value) FROM dimension AS d "
+    + "WHERE d.metric_id=o.metric_id AND d.observation_id=o.id)), "
+    + "'value', json_object('amount', o.value_amount, 'currency', o.value_currency), "
+    + "'measure', o.measure, "
+    + "'unit', json_object('name', o.unit_name, 'scheme', o.unit_scheme, 'id', o.unit_id, 'uri', o.unit_uri)"
+    + "), "
+    + "CASE WHEN COALESCE(o.value_amount, '') != '' OR COALESCE(o.value_currency, '') != '' "
+    + "THEN '$.none' ELSE '$.value' END, "
+    + "CASE WHEN COALESCE(o.measure, '') != '' THEN '$.none' ELSE '$.measure' END, "
+    + "CASE WHEN COALESCE(o.unit_name, '') != '' OR COALESCE(o.unit_scheme, '') != '' "
+    + "OR COALESCE(o.unit_id, '') != '' OR COALESCE(o.unit_uri, '') != '' "
+    + "THEN '$.none' ELSE '$.unit' END)"
+)
+
+
+class _ThreadReadConnection:
+    """Holds the read connection for one thread, in thread local data."""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+
+def _close_read_connection(
+    connection: sqlite3.Connection, connections: set, lock: threading.Lock
+):
+    with lock:
+        connections.discard(connection)
+    connection.close()
+
+
+def _get_database_uri(
+    database_filename: str, read_only: bool = False, immutable: bool = False
+) -> str:
+    """Returns a URI for opening a database file, so flags can be passed.
+
+    With read_only, a file that does not exist is an error instead of being made."""
+    uri = pathlib.Path(database_filename).absolute().as_uri()
+    if read_only:
+        uri += "?mode=ro"
+        if immutable:
+            uri += "&immutable=1"
+    return uri
+
+
+def _check_on_conflict(on_conflict: str):
+    if on_conflict not in ON_CONFLICT_OPTIONS:
+        raise ValueError("on_conflict must be one of " + str(ON_CONFLICT_OPTIONS))
 
 
 class Store:
@@ -14,18 +130,99 @@ class Store:
     Stores do not persist data automatically; if you want to keep the data there are methods to export it as JSON
     that should be used before discarding the store.
 
-    Construct: Pass database_filename. This should be a file that does not already exist.
-    It is not needed after the store is finished with and can be deleted."""
+    Construct: Pass database_filename. This should be a file that does not already exist,
+    or the file of an earlier store to carry on working with its data.
+    It is not needed after the store is finished with and can be deleted.
+    Pass ":memory:" to not keep the database; it is put in a temporary file, which is deleted when the store is closed.
 
-    def __init__(self, database_filename: str):
-        self._database_connection = sqlite3.connect(database_filename)
-        self._database_connection.row_factory = sqlite3.Row
+    A store can be shared between threads. The database is put in WAL mode;
+    all writes go through one connection, one at a time,
+    and every thread that reads gets its own connection so reads can happen at the same time.
+    A thread's connection is closed when the thread finishes.
+
+    If the database file is finished with and will only be queried, pass read_only. The database is then opened
+    read only, no tables are made and any method that writes raises ReadOnlyStoreException.
+    Also pass immutable if nothing at all, in any process, will change the file while it is open.
+    SQLite then does no locking at all, which makes queries faster when many processes read the same file.
+
+    To have SQLite read the database with memory-mapped I/O, pass mmap_size (the most bytes to map).
+    The operating system then shares the mapped pages between all processes reading the file,
+    instead of each process keeping its own copy in its cache.
+
+    To cache the results of ObservationList queries, pass query_cache_max_entries (the number of results to keep).
+    You can also pass query_cache_max_rows, to limit the total number of observations kept in the cache.
+    Any write to the store empties the cache, so results are never out of date."""
+
+    def __init__(
+        self,
+        database_filename: str,
+        query_cache_max_entries: int = 0,
+        query_cache_max_rows: Optional[int] = None,
+        read_only: bool = False,
+        immutable: bool = False,
+        mmap_size: Optional[int] = None,
+    ):
+        if immutable and not read_only:
+            raise ValueError("immutable can only be set if read_only is set")
+        self._database_filename = database_filename
+        self._read_only = read_only
+        self._mmap_size = mmap_size
+        # Deletes the temporary directory of an in-memory store. Runs when the store is closed or garbage collected.
+        self._remove_temporary_directory: Optional[weakref.finalize] = None
+        if database_filename == ":memory:":
+            if read_only:
+                raise ValueError("An in-memory store can not be read only")
+            # Every connection to ":memory:" gets a different empty database, and in-memory databases can not use WAL mode.
+            # Instead use a file in a new temporary directory, so reads and writes work just as for any other store.
+            temporary_directory = tempfile.mkdtemp(prefix="ocdsmetricsanalysis-")
+            self._remove_temporary_directory = weakref.finalize(
+                self, shutil.rmtree, temporary_directory, ignore_errors=True
+            )
+            database_filename = os.path.join(temporary_directory, "database.sqlite")
+        # All connections open the database with this, so flags can be passed.
+        self._database_uri = _get_database_uri(
+            database_filename, read_only=read_only, immutable=immutable
+        )
+        # Goes up by one after every write, so cached results can be checked.
+        self._write_generation = 0
+        self._query_cache: Optional[QueryCache] = (
+            QueryCache(query_cache_max_entries, max_rows=query_cache_max_rows)
+            if query_cache_max_entries > 0
+            else None
+        )
+        self._write_lock = threading.Lock()
+        self._read_connections_local = threading.local()
+        self._read_connections: set = set()
+        self._read_connections_lock = threading.Lock()
+        # This is the only connection used for writing. Always take _write_lock before using it.
+        self._database_connection: Optional[sqlite3.Connection] = None
+        if read_only:
+            # Open a connection now, so an error is raised straight away if the database can not be read.
+            self._get_read_connection()
+        else:
+            self._database_connection = sqlite3.connect(
+                self._database_uri, uri=True, check_same_thread=False
+            )
+            self._database_connection.row_factory = sqlite3.Row
+            self._set_mmap_size(self._database_connection)
+            self._create_tables()
+
+    def _create_tables(self):
         cur = self._database_connection.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
         cur.execute(
-            "CREATE TABLE metric(id TEXT, title TEXT, description TEXT, PRIMARY KEY(id))"
+            "CREATE TABLE IF NOT EXISTS metric("
+            + "id TEXT, "
+            + "title TEXT, "
+            + "description TEXT, "
+            + "approximate_epsilon REAL, "
+            + "approximate_delta REAL, "
+            + "approximate_max_error REAL, "
+            + "PRIMARY KEY(id)"
+            + ")"
         )
         cur.execute(
-            "CREATE TABLE observation("
+            "CREATE TABLE IF NOT EXISTS observation("
             + "metric_id TEXT, "
             + "id TEXT, "
             + "value_amount TEXT, "
@@ -39,66 +236,504 @@ class Store:
             + ")"
         )
         cur.execute(
-            "CREATE TABLE dimension(metric_id TEXT, observation_id TEXT, key TEXT, value TEXT, PRIMARY KEY(metric_id, observation_id, key))"
+            "CREATE TABLE IF NOT EXISTS dimension(metric_id TEXT, observation_id TEXT, key TEXT, value TEXT, PRIMARY KEY(metric_id, observation_id, key))"
         )
-        self._database_connection.commit()
-
-    def add_metric(self, id: str, title: str, description: str):
-        """Adds a metric to the store."""
-        # TODO check for id clash
-        cur = self._database_connection.cursor()
+        # The dimension catalog holds every dimension key and value used in each metric, and how many observations have it.
+        # It is kept up to date by triggers, so whatever way data is written it is correct.
         cur.execute(
-            "INSERT INTO metric (id, title, description) VALUES (?, ?, ?)",
-            (
-                id,
-                title,
-                description,
-            ),
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='dimension_catalog'"
+        )
+        dimension_catalog_exists = cur.fetchone() is not None
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS dimension_catalog(metric_id TEXT, key TEXT, value TEXT, observation_count INTEGER, PRIMARY KEY(metric_id, key, value))"
+        )
+        if not dimension_catalog_exists:
+            # The database may be from before there was a dimension catalog, so fill it from any dimensions already there.
+            cur.execute(
+                "INSERT INTO dimension_catalog (metric_id, key, value, observation_count) "
+                + "SELECT metric_id, key, value, COUNT(*) FROM dimension GROUP BY metric_id, key, value"
+            )
+        cur.execute(
+            "CREATE TRIGGER IF NOT EXISTS dimension_catalog_insert AFTER INSERT ON dimension BEGIN "
+            + DIMENSION_CATALOG_ADD_SQL
+            + " END"
+        )
+        cur.execute(
+            "CREATE TRIGGER IF NOT EXISTS dimension_catalog_delete AFTER DELETE ON dimension BEGIN "
+            + DIMENSION_CATALOG_REMOVE_SQL
+            + " END"
+        )
+        cur.execute(
+            "CREATE TRIGGER IF NOT EXISTS dimension_catalog_update AFTER UPDATE ON dimension BEGIN "
+            + DIMENSION_CATALOG_REMOVE_SQL
+            + " "
+            + DIMENSION_CATALOG_ADD_SQL
+            + " END"
         )
         self._database_connection.commit()
 
-    def add_metric_json(self, data: dict):
-        """Adds a JSON object which is a Metric class to the store. Adds the metric and any observations it contains in the JSON."""
-        # TODO check for id clash
-        cur = self._database_connection.cursor()
-        cur.execute(
-            "INSERT INTO metric (id, title, description) VALUES (?, ?, ?)",
-            (
+    def _set_mmap_size(self, connection: sqlite3.Connection):
+        if self._mmap_size is not None:
+            connection.execute("PRAGMA mmap_size=" + str(int(self._mmap_size)))
+
+    def _open_read_connection(self) -> sqlite3.Connection:
+        """Opens a new connection for reading. The caller must close it."""
+        connection = sqlite3.connect(
+            self._database_uri, uri=True, check_same_thread=False
+        )
+        connection.row_factory = sqlite3.Row
+        self._set_mmap_size(connection)
+        return connection
+
+    def _get_read_connection(self) -> sqlite3.Connection:
+        """Returns the read connection for the current thread, opening it the first time.
+
+        The connection is closed when the thread finishes, or when the store is closed."""
+        thread_connection = getattr(self._read_connections_local, "connection", None)
+        if thread_connection is None:
+            connection = self._open_read_connection()
+            thread_connection = _ThreadReadConnection(connection)
+            self._read_connections_local.connection = thread_connection
+            with self._read_connections_lock:
+                self._read_connections.add(connection)
+            # When the thread finishes, its thread local data is dropped and this runs.
+            weakref.finalize(
+                thread_connection,
+                _close_read_connection,
+                connection,
+                self._read_connections,
+                self._read_connections_lock,
+            )
+        return thread_connection.connection
+
+    @contextmanager
+    def _write_transaction(self, attach_database_uri: Optional[str] = None):
+        """Context manager for writing. Yields a cursor on the write connection.
+
+        Writes from different threads are serialised. Commits at the end, or rolls back if there is an error.
+
+        If attach_database_uri is passed, that database is available as "other" during the transaction."""
+        if self._database_connection is None:
+            raise ReadOnlyStoreException("This store was opened read only")
+        with self._write_lock:
+            cur = self._database_connection.cursor()
+            if attach_database_uri:
+                cur.execute("ATTACH DATABASE ? AS other", [attach_database_uri])
+            try:
+                yield cur
+                self._database_connection.commit()
+            except BaseException:
+                self._database_connection.rollback()
+                raise
+            finally:
+                # This must happen after the commit; see QueryCache
+                self._write_generation += 1
+                if self._query_cache is not None:
+                    self._query_cache.clear()
+                if attach_database_uri:
+                    cur.execute("DETACH DATABASE other")
+
+    def close(self):
+        """Closes all database connections. The store can not be used after this."""
+        with self._read_connections_lock:
+            for connection in self._read_connections:
+                connection.close()
+            self._read_connections.clear()
+        with self._write_lock:
+            if self._database_connection is not None:
+                self._database_connection.close()
+        if self._remove_temporary_directory is not None:
+            self._remove_temporary_directory()
+
+    def add_metric(
+        self,
+        id: str,
+        title: str,
+        description: str,
+        on_conflict: str = ON_CONFLICT_ERROR,
+    ):
+        """Adds a metric to the store.
+
+        on_conflict says what to do if there is already a metric with this id:
+
+        * "error" - raise IdClashException.
+        * "skip" - keep the metric already in the store and do nothing.
+        * "replace" - replace the title and description, and delete all observations for the metric.
+        * "merge" - replace the title and description where they are set, and keep the observations.
+        """
+        _check_on_conflict(on_conflict)
+        with self._write_transaction() as cur:
+            self._add_metric(cur, id, title, description, on_conflict)
+
+    def add_metric_json(self, data: dict, on_conflict: str = ON_CONFLICT_ERROR):
+        """Adds a JSON object which is a Metric class to the store. Adds the metric and any observations it contains in the JSON.
+
+        on_conflict says what to do if there is already a metric with this id:
+
+        * "error" - raise IdClashException.
+        * "skip" - keep the metric already in the store and ignore the JSON.
+        * "replace" - delete the metric already in the store and all its observations, then add the JSON.
+        * "merge" - add the observations in the JSON to the metric already in the store.
+          Where an observation id is in both, fields and dimensions set in the JSON win.
+          Title and description set in the JSON also win.
+
+        Either everything in the JSON is added, or nothing is."""
+        _check_on_conflict(on_conflict)
+        with self._write_transaction() as cur:
+            if not self._add_metric(
+                cur,
                 data.get("id"),
                 data.get("title"),
                 data.get("description"),
-            ),
-        )
-        for observation in data["observations"]:
-            cur.execute(
-                "INSERT INTO observation "
-                + "(metric_id, id, value_amount, value_currency, measure, unit_name, unit_scheme, unit_id, unit_uri) "
-                + "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (
+                on_conflict,
+            ):
+                return
+            observation_on_conflict = (
+                ON_CONFLICT_MERGE
+                if on_conflict == ON_CONFLICT_MERGE
+                else ON_CONFLICT_ERROR
+            )
+            for observation in data["observations"]:
+                self._add_observation(
+                    cur,
                     data.get("id"),
                     observation.get("id"),
                     observation.get("value", {}).get("amount"),
                     observation.get("value", {}).get("currency"),
                     observation.get("measure"),
+                    observation.get("dimensions", {}),
                     observation.get("unit", {}).get("name"),
                     observation.get("unit", {}).get("scheme"),
                     observation.get("unit", {}).get("id"),
                     observation.get("unit", {}).get("uri"),
+                    observation_on_conflict,
+                )
+
+    def _add_metric(
+        self,
+        cur: sqlite3.Cursor,
+        id: Optional[str],
+        title: Optional[str],
+        description: Optional[str],
+        on_conflict: str,
+    ) -> bool:
+        """Adds a metric in the current write transaction. Returns False if it was skipped."""
+        sql = "INSERT INTO metric (id, title, description) VALUES (?, ?, ?)"
+        if on_conflict == ON_CONFLICT_SKIP:
+            sql += " ON CONFLICT (id) DO NOTHING"
+        elif on_conflict == ON_CONFLICT_REPLACE:
+            cur.execute("DELETE FROM dimension WHERE metric_id=?", [id])
+            cur.execute("DELETE FROM observation WHERE metric_id=?", [id])
+            sql += (
+                " ON CONFLICT (id) DO UPDATE SET title=excluded.title, description=excluded.description, "
+                + "approximate_epsilon=NULL, approximate_delta=NULL, approximate_max_error=NULL"
+            )
+        elif on_conflict == ON_CONFLICT_MERGE:
+            sql += (
+                " ON CONFLICT (id) DO UPDATE SET "
+                + "title=COALESCE(excluded.title, title), description=COALESCE(excluded.description, description)"
+            )
+        try:
+            cur.execute(sql, (id, title, description))
+        except sqlite3.IntegrityError as e:
+            raise IdClashException("Metric id already in store: " + str(id)) from e
+        return cur.rowcount > 0
+
+    def _add_observation(
+        self,
+        cur: sqlite3.Cursor,
+        metric_id: Optional[str],
+        id: Optional[str],
+        value_amount: Optional[str],
+        value_currency: Optional[str],
+        measure: Optional[str],
+        dimensions: dict,
+        unit_name: Optional[str],
+        unit_scheme: Optional[str],
+        unit_id: Optional[str],
+        unit_uri: Optional[str],
+        on_conflict: str,
+    ):
+        """Adds an observation in the current write transaction."""
+        sql = (
+            "INSERT INTO observation ("
+            + OBSERVATION_COLUMNS
+            + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        )
+        if on_conflict == ON_CONFLICT_SKIP:
+            sql += " ON CONFLICT (metric_id, id) DO NOTHING"
+        elif on_conflict == ON_CONFLICT_REPLACE:
+            sql += " ON CONFLICT (metric_id, id) DO UPDATE SET " + ", ".join(
+                [
+                    "{c}=excluded.{c}".format(c=c)
+                    for c in OBSERVATION_COLUMNS.split(", ")[2:]
+                ]
+            )
+            cur.execute(
+                "DELETE FROM dimension WHERE metric_id=? AND observation_id=?",
+                (metric_id, id),
+            )
+        elif on_conflict == ON_CONFLICT_MERGE:
+            sql += " ON CONFLICT (metric_id, id) DO UPDATE SET " + ", ".join(
+                [
+                    "{c}=COALESCE(excluded.{c}, {c})".format(c=c)
+                    for c in OBSERVATION_COLUMNS.split(", ")[2:]
+                ]
+            )
+        try:
+            cur.execute(
+                sql,
+                (
+                    metric_id,
+                    id,
+                    value_amount,
+                    value_currency,
+                    measure,
+                    unit_name,
+                    unit_scheme,
+                    unit_id,
+                    unit_uri,
                 ),
             )
-            for dimension_key, dimension_value in observation.get(
-                "dimensions", {}
-            ).items():
+        except sqlite3.IntegrityError as e:
+            raise IdClashException(
+                "Observation id already in metric " + str(metric_id) + ": " + str(id)
+            ) from e
+        if cur.rowcount == 0:
+            # Skipped
+            return
+        cur.executemany(
+            "INSERT INTO dimension (metric_id, observation_id, key, value) VALUES (?, ?, ?, ?)"
+            + (
+                " ON CONFLICT (metric_id, observation_id, key) DO UPDATE SET value=excluded.value"
+                if on_conflict == ON_CONFLICT_MERGE
+                else ""
+            ),
+            [
+                (metric_id, id, dimension_key, dimension_value)
+                for dimension_key, dimension_value in dimensions.items()
+            ],
+        )
+
+    def merge_from(self, database_filename: str, on_conflict: str = ON_CONFLICT_ERROR):
+        """Copies all metrics and observations from another store's database file into this store.
+
+        This is for when several stores are built at once (eg. by different processes) and need to be combined.
+        The data is copied directly by the database in one transaction, so it is much faster than going through JSON.
+
+        on_conflict says what to do when a metric id is in both stores:
+
+        * "error" - raise IdClashException and copy nothing.
+        * "skip" - keep the metric in this store and ignore the other one.
+        * "replace" - delete the metric and all its observations in this store, then copy the other one.
+        * "merge" - copy the observations of the other metric into the metric in this store.
+          Where an observation id is in both, fields and dimensions set in the other store win.
+          Title and description set in the other store also win.
+        """
+        _check_on_conflict(on_conflict)
+
+        # Attach it read only, so a mistyped filename is an error instead of making an empty database there.
+        with self._write_transaction(
+            attach_database_uri=_get_database_uri(database_filename, read_only=True)
+        ) as cur:
+            if on_conflict == ON_CONFLICT_ERROR:
                 cur.execute(
-                    "INSERT INTO dimension (metric_id, observation_id, key, value) VALUES (?, ?, ?, ?)",
-                    (
-                        data.get("id"),
-                        observation.get("id"),
-                        dimension_key,
-                        dimension_value,
-                    ),
+                    "SELECT o.id FROM other.metric AS o JOIN main.metric AS m ON m.id=o.id ORDER BY o.id ASC LIMIT 1"
+                )
+                clash = cur.fetchone()
+                if clash:
+                    raise IdClashException(
+                        "Metric id already in store: " + str(clash["id"])
+                    )
+
+            if on_conflict == ON_CONFLICT_REPLACE:
+                for table in ["dimension", "observation"]:
+                    cur.execute(
+                        "DELETE FROM main."
+                        + table
+                        + " WHERE metric_id IN (SELECT id FROM other.metric)"
+                    )
+                cur.execute(
+                    "DELETE FROM main.metric WHERE id IN (SELECT id FROM other.metric)"
                 )
-        self._database_connection.commit()
+
+            if on_conflict == ON_CONFLICT_MERGE:
+                cur.execute(
+                    "INSERT INTO main.metric ("
+                    + METRIC_COLUMNS
+                    + ") SELECT "
+                    + METRIC_COLUMNS
+                    + " FROM other.metric WHERE true "
+                    + "ON CONFLICT (id) DO UPDATE SET "
+                    + ", ".join(
+                        [
+                            "{c}=COALESCE(excluded.{c}, {c})".format(c=c)
+                            for c in METRIC_COLUMNS.split(", ")[1:]
+                        ]
+                    )
+                )
+                cur.execute(
+                    "INSERT INTO main.observation ("
+                    + OBSERVATION_COLUMNS
+                    + ") SELECT "
+                    + OBSERVATION_COLUMNS
+                    + " FROM other.observation WHERE true "
+                    + "ON CONFLICT (metric_id, id) DO UPDATE SET "
+                    + ", ".join(
+                        [
+                            "{c}=COALESCE(excluded.{c}, {c})".format(c=c)
+                            for c in OBSERVATION_COLUMNS.split(", ")[2:]
+                        ]
+                    )
+                )
+                cur.execute(
+                    "INSERT INTO main.dimension (metric_id, observation_id, key, value) "
+                    + "SELECT metric_id, observation_id, key, value FROM other.dimension WHERE true "
+                    + "ON CONFLICT (metric_id, observation_id, key) DO UPDATE SET value=excluded.value"
+                )
+            else:
+                # For skip, leave out metrics already in this store.
+                # The dimensions and observations must be copied before the metrics, so this check still works for them.
+                skip = on_conflict == ON_CONFLICT_SKIP
+                cur.execute(
+                    "INSERT INTO main.dimension (metric_id, observation_id, key, value) "
+                    + "SELECT metric_id, observation_id, key, value FROM other.dimension"
+                    + (
+                        " WHERE metric_id NOT IN (SELECT id FROM main.metric)"
+                        if skip
+                        else ""
+                    )
+                )
+                cur.execute(
+                    "INSERT INTO main.observation ("
+                    + OBSERVATION_COLUMNS
+                    + ") SELECT "
+                    + OBSERVATION_COLUMNS
+                    + " FROM other.observation"
+                    + (
+                        " WHERE metric_id NOT IN (SELECT id FROM main.metric)"
+                        if skip
+                        else ""
+                    )
+                )
+                cur.execute(
+                    "INSERT INTO main.metric ("
+                    + METRIC_COLUMNS
+                    + ") SELECT "
+                    + METRIC_COLUMNS
+                    + " FROM other.metric"
+                    + (" WHERE id NOT IN (SELECT id FROM main.metric)" if skip else "")
+                )
+
+    def diff(self, other_store: "Store"):
+        """Compares the observations in this store (the old data) with those in another store (the new data).
+
+        Returns a generator of changes. Each change is a dict with keys:
+
+        * "metric_id"
+        * "change" - "added", "removed" or "changed"
+        * "id" - the id of the observation
+        * "old" - the Observation in this store, or None if it was added
+        * "new" - the Observation in the other store, or None if it was removed
+
+        Metrics are compared by id. See Metric.diff."""
+        metric_ids = set([m.get_id() for m in self.get_metrics()])
+        other_metric_ids = set([m.get_id() for m in other_store.get_metrics()])
+        for metric_id in sorted(metric_ids | other_metric_ids):
+            if metric_id not in other_metric_ids:
+                for observation in (
+                    self.get_metric(metric_id).get_observation_list().iter_data()
+                ):
+                    yield {
+                        "metric_id": metric_id,
+                        "change": DIFF_REMOVED,
+                        "id": observation.get_id(),
+                        "old": observation,
+                        "new": None,
+                    }
+            elif metric_id not in metric_ids:
+                for observation in (
+                    other_store.get_metric(metric_id).get_observation_list().iter_data()
+                ):
+                    yield {
+                        "metric_id": metric_id,
+                        "change": DIFF_ADDED,
+                        "id": observation.get_id(),
+                        "old": None,
+                        "new": observation,
+                    }
+            else:
+                for change in self.get_metric(metric_id).diff(
+                    other_store.get_metric(metric_id)
+                ):
+                    change["metric_id"] = metric_id
+                    yield change
+
+    def get_data_batch(self, observation_lists: dict) -> dict:
+        """Gets the data for many observation lists at once, for instance to show many charts on one page.
+
+        Pass a dict. The key can be anything, and the value is an ObservationList from a metric in this store.
+        The lists can have different filters, orders and limits, and be from different metrics.
+
+        Returns a dict with the same keys. The value is the list of Observations that get_data on that observation list would return.
+
+        The database is queried with one statement for all the observation lists, instead of one for each.
+        (For very many observation lists, a few statements are used.) If there is a query cache, it is used for each observation list.
+        """
+        rows: dict = {}
+        to_query: list = []
+        generation = self._write_generation
+        for key, observation_list in observation_lists.items():
+            if observation_list._store is not self:
+                raise ValueError("All observation lists must be from this store")
+            if self._query_cache is not None:
+                results = self._query_cache.get(
+                    observation_list._get_cache_key(limit=observation_list._limit),
+                    generation,
+                )
+                if results is not None:
+                    rows[key] = results
+                    continue
+            to_query.append((key, observation_list))
+
+        for start in range(0, len(to_query), BATCH_QUERY_MAX_OBSERVATION_LISTS):
+            batch = to_query[start : start + BATCH_QUERY_MAX_OBSERVATION_LISTS]
+            selects: list = []
+            params: dict = {}
+            for batch_index, (key, observation_list) in enumerate(batch):
+                sql, list_params = observation_list._get_sql(
+                    limit=observation_list._limit,
+                    param_prefix="list" + str(batch_index) + "_",
+                    with_row_number=True,
+                )
+                selects.append(
+                    "SELECT "
+                    + str(batch_index)
+                    + " AS batch_index, q.* FROM ("
+                    + sql
+                    + ") AS q"
+                )
+                params.update(list_params)
+                rows[key] = []
+            cur = self._get_read_connection().cursor()
+            cur.execute(
+                " UNION ALL ".join(selects) + " ORDER BY batch_index, row_number",
+                params,
+            )
+            for row in cur:
+                rows[batch[row["batch_index"]][0]].append(row)
+            if self._query_cache is not None:
+                for key, observation_list in batch:
+                    self._query_cache.put(
+                        observation_list._get_cache_key(limit=observation_list._limit),
+                        generation,
+                        rows[key],
+                    )
+
+        return {
+            key: [Observation(observation_list._metric, row) for row in rows[key]]
+            for key, observation_list in observation_lists.items()
+        }
 
     def get_metric(self, metric_id):
         """Returns a specific Metric. Returns a Metric class."""
@@ -106,13 +741,138 @@ class Store:
 
     def get_metrics(self):
         """Returns a list of all metrics in this store. Each item in the list is a Metric class."""
-        cur = self._database_connection.cursor()
+        cur = self._get_read_connection().cursor()
         cur.execute(
             "SELECT id FROM metric ORDER BY id ASC",
             [],
         )
         return [Metric(self, m["id"]) for m in cur.fetchall()]
 
+    def _get_metric_row(self, metric_id: str):
+        cur = self._get_read_connection().cursor()
+        cur.execute(
+            "SELECT metric.* FROM metric WHERE id=?",
+            [metric_id],
+        )
+        return cur.fetchone()
+
+    def iter_flat_observations(
+        self, metric_id: Optional[str] = None, dimensions_as_columns: bool = False
+    ):
+        """Returns a generator of flat observations - one dict per observation, with the metric id in it.
+
+        Pass metric_id to only get observations from that metric, otherwise you get observations from all metrics.
+
+        Dimensions are in a dict in the "dimensions" key, or if dimensions_as_columns is set
+        they are spread into their own keys called "dimensions/" followed by the dimension key.
+
+        This reads the observation and dimension tables in one pass with one query, so uses little memory however many observations there are.
+        """
+        cur = self._get_read_connection().cursor()
+        sql = (
+            "SELECT o.*, d.key AS dimension_key, d.value AS dimension_value FROM observation AS o "
+            + "LEFT JOIN dimension AS d ON d.metric_id=o.metric_id AND d.observation_id=o.id "
+        )
+        params: list = []
+        if metric_id is not None:
+            sql += "WHERE o.metric_id=? "
+            params.append(metric_id)
+        sql += "ORDER BY o.metric_id ASC, o.id ASC, d.rowid ASC"
+        cur.execute(sql, params)
+
+        current: Optional[dict] = None
+        for row in cur:
+            if (
+                current is None
+                or current["metric_id"] != row["metric_id"]
+                or current["id"] != row["id"]
+            ):
+                if current is not None:
+                    yield current
+                current = {
+                    "metric_id": row["metric_id"],
+                    "id": row["id"],
+                    "value_amount": row["value_amount"],
+                    "value_currency": row["value_currency"],
+                    "measure": row["measure"],
+                    "unit_name": row["unit_name"],
+                    "unit_scheme": row["unit_scheme"],
+                    "unit_id": row["unit_id"],
+                    "unit_uri": row["unit_uri"],
+                }
+                if not dimensions_as_columns:
+                    current["dimensions"] = {}
+            if row["dimension_key"] is not None:
+                if dimensions_as_columns:
+                    current["dimensions/" + row["dimension_key"]] = row[
+                        "dimension_value"
+                    ]
+                else:
+                    current["dimensions"][row["dimension_key"]] = row["dimension_value"]
+        if current is not None:
+            yield current
+
+    def export_ndjson(
+        self, fp, metric_id: Optional[str] = None, dimensions_as_columns: bool = False
+    ):
+        """Writes observations to fp as Newline Delimited JSON, one observation per line.
+
+        fp should be a file opened for writing text.
+
+        Pass metric_id to only export that metric. See iter_flat_observations for the other parameters."""
+        for flat_observation in self.iter_flat_observations(
+            metric_id=metric_id, dimensions_as_columns=dimensions_as_columns
+        ):
+            fp.write(json.dumps(flat_observation) + "\n")
+
+    def export_csv(
+        self, fp, metric_id: Optional[str] = None, dimensions_as_columns: bool = True
+    ):
+        """Writes observations to fp as CSV, one observation per row.
+
+        fp should be a file opened for writing text with newline="".
+
+        Pass metric_id to only export that metric.
+
+        If dimensions_as_columns is set, each dimension key gets its own column called "dimensions/" followed by the dimension key.
+        Otherwise there is one "dimensions" column with all dimensions in it as a JSON object."""
+        fieldnames = [
+            "metric_id",
+            "id",
+            "value_amount",
+            "value_currency",
+            "measure",
+            "unit_name",
+            "unit_scheme",
+            "unit_id",
+            "unit_uri",
+        ]
+        if dimensions_as_columns:
+            cur = self._get_read_connection().cursor()
+            if metric_id is not None:
+                cur.execute(
+                    "SELECT key FROM dimension_catalog WHERE metric_id=? GROUP BY key ORDER BY key ASC",
+                    [metric_id],
+                )
+            else:
+                cur.execute(
+                    "SELECT key FROM dimension_catalog GROUP BY key ORDER BY key ASC"
+                )
+            fieldnames.extend(["dimensions/" + d["key"] for d in cur.fetchall()])
+        else:
+            fieldnames.append("dimensions")
+
+        writer = csv.DictWriter(fp, fieldnames=fieldnames)
+        writer.writeheader()
+        for flat_observation in self.iter_flat_observations(
+            metric_id=metric_id, dimensions_as_columns=dimensions_as_columns
+        ):
+            if not dimensions_as_columns:
+                flat_observation["dimensions"] = json.dumps(
+                    flat_observation["dimensions"]
+                )
+            writer.writerow(flat_observation)
+
 
 class Metric:
     """A class representing one metric from a store.
@@ -123,13 +883,7 @@ class Metric:
     def __init__(self, store: Store, metric_id: str):
         self._store = store
         self._metric_id = metric_id
-
-        cur = self._store._database_connection.cursor()
-        cur.execute(
-            "SELECT metric.* FROM metric WHERE id=?",
-            [metric_id],
-        )
-        self._metric_row = cur.fetchone()
+        self._metric_row = self._store._get_metric_row(metric_id)
         if self._metric_row is None:
             raise MetricNotFoundException("No such metric found")
 
@@ -152,39 +906,37 @@ class Metric:
         unit_scheme: Optional[str] = None,
         unit_id: Optional[str] = None,
         unit_uri: Optional[str] = None,
+        on_conflict: str = ON_CONFLICT_ERROR,
     ):
-        """Adds a new single observation to this metric and saves it in the store."""
-        # TODO check for id clash
-        cur = self._store._database_connection.cursor()
-        cur.execute(
-            "INSERT INTO observation (metric_id, id, value_amount, value_currency, measure, unit_name, unit_scheme, unit_id, unit_uri) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
+        """Adds a new single observation to this metric and saves it in the store.
+
+        on_conflict says what to do if this metric already has an observation with this id:
+
+        * "error" - raise IdClashException.
+        * "skip" - keep the observation already in the store and do nothing.
+        * "replace" - replace the observation already in the store, including all its dimensions.
+        * "merge" - replace fields and dimensions where they are set, and keep the rest of the observation already in the store.
+        """
+        _check_on_conflict(on_conflict)
+        with self._store._write_transaction() as cur:
+            self._store._add_observation(
+                cur,
                 self._metric_id,
                 id,
                 value_amount,
                 value_currency,
                 measure,
+                dimensions,
                 unit_name,
                 unit_scheme,
                 unit_id,
                 unit_uri,
-            ),
-        )
-        for dimension_key, dimension_value in dimensions.items():
-            cur.execute(
-                "INSERT INTO dimension (metric_id, observation_id, key, value) VALUES (?, ?, ?, ?)",
-                (
-                    self._metric_id,
-                    id,
-                    dimension_key,
-                    dimension_value,
-                ),
+                on_conflict,
             )
-        self._store._database_connection.commit()
 
     def add_aggregate_observations(
         self,
-        data_rows: list,
+        data_rows: Union[Iterable, Mapping],
         idx_to_aggregate: Union[str, int],
         answer_dimension_key: str,
         idx_to_dimensions: dict = {},
@@ -193,83 +945,209 @@ class Metric:
         unit_id: Optional[str] = None,
         unit_uri: Optional[str] = None,
         create_observations_from_dimensions_exponentially: bool = False,
+        counting_backend: Optional[str] = None,
+        idx_to_weight: Optional[Union[str, int]] = None,
+        on_conflict: str = ON_CONFLICT_ERROR,
+        approximate_top_n: Optional[int] = None,
+        approximate_epsilon: float = 0.001,
+        approximate_delta: float = 0.01,
+        batch_size: Optional[int] = None,
+        max_combinations_in_memory: Optional[int] = None,
+        grouping_sets: Optional[Union[str, list]] = None,
     ):
-        """Takes rows of data and sums up how often certain answers appear then saves new observations in the store."""
-
-        # ------------------------------- Get list of Observations
-        # First, just the observations for possible answers
-        possible_answers = sorted(
-            list(set([d[idx_to_aggregate] for d in data_rows if d[idx_to_aggregate]]))
+        """Takes rows of data and sums up how often certain answers appear then saves new observations in the store.
+
+        data_rows can be a list of rows (each row a dict or list), or it can be columns of data:
+        a dict of column name to a sequence of values (such as a list or a NumPy array), all the same length.
+        idx_to_aggregate and the keys of idx_to_dimensions are then column names.
+        data_rows can also be any iterable of rows, such as a generator or a csv.DictReader.
+        Pass batch_size to count batch_size rows at a time, so not all rows have to be held in memory at once.
+        With approximate_top_n, rows are always counted in batches; see AggregateSketch.add_rows.
+
+        Observations are made for the answers, then for the answers with each extra dimension.
+        If create_observations_from_dimensions_exponentially is set, they are made for every combination of extra dimensions instead.
+        To choose other combinations, pass grouping_sets as:
+
+        * "cube" - every combination of extra dimensions, the same as create_observations_from_dimensions_exponentially.
+        * "rollup" - the answers, then the answers with the first extra dimension, then with the first two, and so on.
+        * a list of lists of keys of idx_to_dimensions. Include an empty list to make observations for just the answers.
+
+        Each row is only counted once, for its answer and all its extra dimensions; the counts for each combination are summed up from those.
+
+        If there are too many different combinations of values to hold their counts in memory, pass max_combinations_in_memory.
+        When there are more than that, counts are moved to a temporary database on disk. Counting is slower but still exact.
+        Rows are then always counted in batches; see AggregateCounter.add_rows.
+
+        If rows of data have already been counted, pass idx_to_weight. This is the key (or column name) in the data
+        that says how many times that row happened. Rows will be counted that many times, instead of once.
+
+        counting_backend can be "python" or "numpy". By default NumPy is used if it is installed,
+        which is faster for large amounts of data. Both give exactly the same observations,
+        unless weights are a mix of ints and floats: the "numpy" backend then makes every count a float,
+        and the "python" backend only the counts that include a float weight; see CombinationCounter.
+
+        New observations have ids starting at "000000001". on_conflict says what to do if this metric already has observations with these ids;
+        see add_observation. All the new observations are saved, or none are.
+
+        If there are too many different combinations of values to count exactly in memory, pass approximate_top_n.
+        Counting is then approximate and uses a fixed amount of memory; only observations for the approximate_top_n most common answers,
+        and the approximate_top_n most common combinations for each extra dimension, are made. Observations with a count of 0 are not made.
+        approximate_epsilon and approximate_delta set the error bounds; see AggregateSketch. They are saved on the metric - see get_approximation."""
+        _check_on_conflict(on_conflict)
+
+        if approximate_top_n is not None:
+            sketch = AggregateSketch(
+                idx_to_aggregate,
+                idx_to_dimensions=idx_to_dimensions,
+                top_n=approximate_top_n,
+                epsilon=approximate_epsilon,
+                delta=approximate_delta,
+                create_observations_from_dimensions_exponentially=create_observations_from_dimensions_exponentially,
+                grouping_sets=grouping_sets,
+            )
+            sketch.add_rows(
+                data_rows,
+                idx_to_weight=idx_to_weight,
+                counting_backend=counting_backend,
+                batch_size=batch_size,
+            )
+            self.add_aggregate_observations_from_sketch(
+                sketch,
+                answer_dimension_key,
+                unit_name=unit_name,
+                unit_scheme=unit_scheme,
+                unit_id=unit_id,
+                unit_uri=unit_uri,
+                on_conflict=on_conflict,
+            )
+            return
+
+        counter = AggregateCounter(
+            idx_to_aggregate,
+            idx_to_dimensions=idx_to_dimensions,
+            create_observations_from_dimensions_exponentially=create_observations_from_dimensions_exponentially,
+            max_combinations_in_memory=max_combinations_in_memory,
+            grouping_sets=grouping_sets,
         )
-
-        observations = [
-            {
-                "answer_value": a,
-                "count": 0,
-                "extra_dimension_definitions": {},
-                "dimensions": {answer_dimension_key: a},
-            }
-            for a in possible_answers
-        ]
-
-        # Second, for every extra dimension add more observations
-        if create_observations_from_dimensions_exponentially:
-            for idx, dimension in idx_to_dimensions.items():
-                possible_answers = sorted(
-                    list(set([d[idx] for d in data_rows if d[idx]]))
-                )
-                new_observations = []
-                for observation in observations:
-                    for a in possible_answers:
-                        new_observation = copy.deepcopy(observation)
-                        new_observation["dimensions"][dimension["dimension_name"]] = a
-                        new_observation["extra_dimension_definitions"][idx] = dimension
-                        new_observations.append(new_observation)
-                observations.extend(new_observations)
-        else:
-            new_observations = []
-            for idx, dimension in idx_to_dimensions.items():
-                possible_answers = sorted(
-                    list(set([d[idx] for d in data_rows if d[idx]]))
-                )
-                for observation in observations:
-                    for a in possible_answers:
-                        new_observation = copy.deepcopy(observation)
-                        new_observation["dimensions"][dimension["dimension_name"]] = a
-                        new_observation["extra_dimension_definitions"][idx] = dimension
-                        new_observations.append(new_observation)
-            observations.extend(new_observations)
-
-        # ------------------------------- Process Data
-        for data_row in data_rows:
-            for observation in observations:
-                # For every data row and every observation see if it matches - if so, increase count
-                if observation["answer_value"] == data_row[idx_to_aggregate]:
-                    increase_count = True
-                    for d_idx, dimension in observation[
-                        "extra_dimension_definitions"
-                    ].items():
-                        if (
-                            data_row[d_idx]
-                            != observation["dimensions"][dimension["dimension_name"]]
-                        ):
-                            increase_count = False
-                    if increase_count:
-                        observation["count"] += 1
-
-        # ------------------------------- Save data to disk
-        id = 0
-        for observation in observations:
-            id += 1
-            self.add_observation(
-                "%09d" % (id),
-                measure=observation["count"],
-                dimensions=observation["dimensions"],
+        try:
+            counter.add_rows(
+                data_rows,
+                idx_to_weight=idx_to_weight,
+                counting_backend=counting_backend,
+                batch_size=batch_size,
+            )
+            self.add_aggregate_observations_from_counter(
+                counter,
+                answer_dimension_key,
                 unit_name=unit_name,
                 unit_scheme=unit_scheme,
                 unit_id=unit_id,
                 unit_uri=unit_uri,
+                on_conflict=on_conflict,
+            )
+        finally:
+            counter.close()
+
+    def add_aggregate_observations_from_counter(
+        self,
+        counter: AggregateCounter,
+        answer_dimension_key: str,
+        unit_name: Optional[str] = None,
+        unit_scheme: Optional[str] = None,
+        unit_id: Optional[str] = None,
+        unit_uri: Optional[str] = None,
+        on_conflict: str = ON_CONFLICT_ERROR,
+    ):
+        """Saves new observations in the store from the exact counts in an AggregateCounter.
+
+        Other parameters are as for add_aggregate_observations."""
+        _check_on_conflict(on_conflict)
+        with self._store._write_transaction() as cur:
+            id = 0
+            for grouping, values, count in counter.iter_combinations():
+                id += 1
+                dimensions = {answer_dimension_key: values[0]}
+                for idx, value in zip(grouping, values[1:]):
+                    dimensions[counter.idx_to_dimensions[idx]["dimension_name"]] = value
+                self._store._add_observation(
+                    cur,
+                    self._metric_id,
+                    "%09d" % (id),
+                    None,
+                    None,
+                    count,
+                    dimensions,
+                    unit_name,
+                    unit_scheme,
+                    unit_id,
+                    unit_uri,
+                    on_conflict,
+                )
+
+    def add_aggregate_observations_from_sketch(
+        self,
+        sketch: AggregateSketch,
+        answer_dimension_key: str,
+        unit_name: Optional[str] = None,
+        unit_scheme: Optional[str] = None,
+        unit_id: Optional[str] = None,
+        unit_uri: Optional[str] = None,
+        on_conflict: str = ON_CONFLICT_ERROR,
+    ):
+        """Saves new observations in the store from the approximate counts in an AggregateSketch.
+
+        Observations are made for the most common answers, and the most common combinations for each extra dimension.
+        The error bounds of the sketch are saved on the metric - see get_approximation.
+
+        Other parameters are as for add_aggregate_observations."""
+        _check_on_conflict(on_conflict)
+        with self._store._write_transaction() as cur:
+            id = 0
+            for grouping, top_combinations in sketch.get_top_combinations():
+                for values, count in top_combinations:
+                    id += 1
+                    dimensions = {answer_dimension_key: values[0]}
+                    for idx, value in zip(grouping, values[1:]):
+                        dimensions[
+                            sketch.idx_to_dimensions[idx]["dimension_name"]
+                        ] = value
+                    self._store._add_observation(
+                        cur,
+                        self._metric_id,
+                        "%09d" % (id),
+                        None,
+                        None,
+                        count,
+                        dimensions,
+                        unit_name,
+                        unit_scheme,
+                        unit_id,
+                        unit_uri,
+                        on_conflict,
+                    )
+            cur.execute(
+                "UPDATE metric SET approximate_epsilon=?, approximate_delta=?, approximate_max_error=? WHERE id=?",
+                (
+                    sketch.epsilon,
+                    sketch.delta,
+                    sketch.get_max_error(),
+                    self._metric_id,
+                ),
             )
+        self._metric_row = self._store._get_metric_row(self._metric_id)
+
+    def get_approximation(self) -> Optional[dict]:
+        """If observations in this metric were counted approximately, returns the error bounds. Otherwise returns None.
+
+        Returns a dict with keys epsilon, delta and max_error. With probability 1 - delta, each count is too high by no more than max_error.
+        """
+        if self._metric_row["approximate_epsilon"] is None:
+            return None
+        return {
+            "epsilon": self._metric_row["approximate_epsilon"],
+            "delta": self._metric_row["approximate_delta"],
+            "max_error": self._metric_row["approximate_max_error"],
+        }
 
     def get_json(self) -> dict:
         """Get JSON for this Metric, including all observations for it."""
@@ -304,15 +1182,190 @@ class Metric:
 
         return out
 
+    def get_json_string(self) -> str:
+        """Get JSON for this Metric, including all observations for it, as a string.
+
+        This has the same structure as get_json, but the whole thing is built by the database in one query,
+        which is much faster for metrics with lots of observations."""
+        cur = self._store._get_read_connection().cursor()
+        cur.execute(
+            "SELECT json_object('id', m.id, 'title', m.title, 'description', m.description, 'observations', "
+            + "json((SELECT json_group_array(json(observation_json)) FROM "
+            + "(SELECT "
+            + OBSERVATION_JSON_SQL
+            + " AS observation_json FROM observation AS o WHERE o.metric_id=m.id ORDER BY o.id ASC)))"
+            + ") AS metric_json FROM metric AS m WHERE m.id=?",
+            [self._metric_id],
+        )
+        return cur.fetchone()["metric_json"]
+
+    def write_json(self, fp):
+        """Writes JSON for this Metric, including all observations for it, to fp.
+
+        fp should be a file opened for writing text.
+
+        This has the same structure as get_json. Each observation is built by the database and written as it is read,
+        so the whole metric is never held in memory."""
+        cur = self._store._get_read_connection().cursor()
+        cur.execute(
+            "SELECT json_object('id', id, 'title', title, 'description', description) AS metric_json FROM metric WHERE id=?",
+            [self._metric_id],
+        )
+        # Leave off the closing brace, so the observations can be added
+        fp.write(cur.fetchone()["metric_json"][:-1] + ',"observations":[')
+        cur.execute(
+            "SELECT "
+            + OBSERVATION_JSON_SQL
+            + " AS observation_json FROM observation AS o WHERE o.metric_id=? ORDER BY o.id ASC",
+            [self._metric_id],
+        )
+        for i, row in enumerate(cur):
+            if i > 0:
+                fp.write(",")
+            fp.write(row["observation_json"])
+        fp.write("]}")
+
+    def export_ndjson(self, fp, dimensions_as_columns: bool = False):
+        """Writes all observations for this Metric to fp as Newline Delimited JSON. See Store.export_ndjson."""
+        self._store.export_ndjson(
+            fp, metric_id=self._metric_id, dimensions_as_columns=dimensions_as_columns
+        )
+
+    def export_csv(self, fp, dimensions_as_columns: bool = True):
+        """Writes all observations for this Metric to fp as CSV. See Store.export_csv."""
+        self._store.export_csv(
+            fp, metric_id=self._metric_id, dimensions_as_columns=dimensions_as_columns
+        )
+
+    def diff(self, other_metric: "Metric"):
+        """Compares the observations in this metric (the old data) with those in another metric (the new data).
+
+        The other metric can be in this store or a different one. The comparison is done by the database.
+
+        Returns a generator of changes, in order of observation id. Each change is a dict with keys:
+
+        * "change" - "added" (only in the other metric), "removed" (only in this metric)
+          or "changed" (in both, but with different fields or dimensions)
+        * "id" - the id of the observation
+        * "old" - the Observation in this metric, or None if it was added
+        * "new" - the Observation in the other metric, or None if it was removed
+        """
+        if other_metric._store is self._store:
+            connection = self._store._get_read_connection()
+            other_schema = "main"
+            close_connection = False
+        else:
+            # Open a separate connection, so the other store can be attached to it without affecting anything else.
+            connection = self._store._open_read_connection()
+            connection.execute(
+                "ATTACH DATABASE ? AS other", [other_metric._store._database_uri]
+            )
+            other_schema = "other"
+            close_connection = True
+
+        observation_columns = OBSERVATION_COLUMNS.split(", ")
+        old_columns = ", ".join(
+            ["o.{c} AS old_{c}".format(c=c) for c in observation_columns]
+        )
+        new_columns = ", ".join(
+            ["n.{c} AS new_{c}".format(c=c) for c in observation_columns]
+        )
+        null_old_columns = ", ".join(
+            ["NULL AS old_{c}".format(c=c) for c in observation_columns]
+        )
+        changed_where = " OR ".join(
+            ["o.{c} IS NOT n.{c}".format(c=c) for c in observation_columns[2:]]
+            + [
+                "EXISTS (SELECT key, value FROM main.dimension WHERE metric_id=o.metric_id AND observation_id=o.id "
+                + "EXCEPT SELECT key, value FROM {other}.dimension WHERE metric_id=n.metric_id AND observation_id=n.id)",
+                "EXISTS (SELECT key, value FROM {other}.dimension WHERE metric_id=n.metric_id AND observation_id=n.id "
+                + "EXCEPT SELECT key, value FROM main.dimension WHERE metric_id=o.metric_id AND observation_id=o.id)",
+            ]
+        )
+        sql = (
+            "SELECT o.id AS sort_id, "
+            + old_columns
+            + ", "
+            + new_columns
+            + " FROM main.observation AS o "
+            + "LEFT JOIN {other}.observation AS n ON n.metric_id=:new_metric_id AND n.id=o.id "
+            + "WHERE o.metric_id=:old_metric_id AND (n.id IS NULL OR "
+            + changed_where
+            + ") "
+            + "UNION ALL "
+            + "SELECT n.id AS sort_id, "
+            + null_old_columns
+            + ", "
+            + new_columns
+            + " FROM {other}.observation AS n "
+            + "LEFT JOIN main.observation AS o ON o.metric_id=:old_metric_id AND o.id=n.id "
+            + "WHERE n.metric_id=:new_metric_id AND o.id IS NULL "
+            + "ORDER BY sort_id ASC"
+        ).format(other=other_schema)
+
+        try:
+            cur = connection.cursor()
+            cur.execute(
+                sql,
+                {
+                    "old_metric_id": self._metric_id,
+                    "new_metric_id": other_metric._metric_id,
+                },
+            )
+            for row in cur:
+                old = (
+                    Observation(self, {c: row["old_" + c] for c in observation_columns})
+                    if row["old_id"] is not None
+                    else None
+                )
+                new = (
+                    Observation(
+                        other_metric, {c: row["new_" + c] for c in observation_columns}
+                    )
+                    if row["new_id"] is not None
+                    else None
+                )
+                if old is None:
+                    change = DIFF_ADDED
+                elif new is None:
+                    change = DIFF_REMOVED
+                else:
+                    change = DIFF_CHANGED
+                yield {
+                    "change": change,
+                    "id": row["sort_id"],
+                    "old": old,
+                    "new": new,
+                }
+        finally:
+            if close_connection:
+                connection.close()
+
     def get_dimension_keys(self) -> list:
         """Returns a list of all unique dimension keys used in all observations for this metric."""
-        cur = self._store._database_connection.cursor()
+        cur = self._store._get_read_connection().cursor()
         cur.execute(
-            "SELECT key FROM dimension WHERE metric_id=? GROUP BY key ORDER BY key ASC",
+            "SELECT key FROM dimension_catalog WHERE metric_id=? GROUP BY key ORDER BY key ASC",
             [self._metric_id],
         )
         return [d["key"] for d in cur.fetchall()]
 
+    def get_dimension_values(self, dimension_key: str) -> list:
+        """Returns a list of all unique values used for a dimension key in all observations for this metric."""
+        return list(self.get_dimension_value_counts(dimension_key).keys())
+
+    def get_dimension_value_counts(self, dimension_key: str) -> dict:
+        """Returns how many observations for this metric have each value of a dimension key.
+
+        Returns a dict. The key is the value of the dimension, and the value is the number of observations with that dimension value.
+        """
+        cur = self._store._get_read_connection().cursor()
+        cur.execute(
+            "SELECT value, observation_count FROM dimension_catalog WHERE metric_id=? AND key=? ORDER BY value ASC",
+            [self._metric_id, dimension_key],
+        )
+        return {d["value"]: d["observation_count"] for d in cur.fetchall()}
+
 
 class ObservationList:
     """A class to get list of observations from a metric.
@@ -326,6 +1379,9 @@ class ObservationList:
         self._store: Store = metric._store
         self._filter_by_dimensions: dict = {}
         self._filter_by_dimensions_not_set: list = []
+        # Tuples of what to order by, the dimension key (or None) and if it is descending
+        self._order_by: list = []
+        self._limit: Optional[int] = None
 
     def filter_by_dimension(self, dimension_key: str, dimension_value: str):
         """Filter by dimension - this key must match this value exactly."""
@@ -335,18 +1391,60 @@ class ObservationList:
         """Filter by dimension - this key must not exist on the observation."""
         self._filter_by_dimensions_not_set.append(dimension_key)
 
-    def get_data(self) -> list:
-        """Returns a list of Observations.
+    def order_by_id(self, descending: bool = False):
+        """Order by observation id.
+
+        Call the order_by methods more than once to order by more than one thing; the first call is the most important.
+        Observations are always ordered by id last, so the order is always the same. By default, that is the only order.
+        """
+        self._order_by.append((ORDER_BY_ID, None, descending))
 
-        Observations will match the filters set on this observation list. (Just don't set any filters to get all observations.)"""
-        cur = self._store._database_connection.cursor()
+    def order_by_measure(self, descending: bool = False):
+        """Order by measure, as a number. Observations with no measure come last."""
+        self._order_by.append((ORDER_BY_MEASURE, None, descending))
 
-        params: dict = {"metric_id": self._metric._metric_id}
+    def order_by_dimension(self, dimension_key: str, descending: bool = False):
+        """Order by the value of a dimension. Observations without this dimension come last."""
+        self._order_by.append((ORDER_BY_DIMENSION, dimension_key, descending))
 
-        where: list = ["o.metric_id = :metric_id"]
+    def set_limit(self, limit: Optional[int]):
+        """Only get this many observations, or pass None to get them all.
+
+        With an order_by method, this gets the top observations; for instance the 10 with the highest measure.
+        The ordering and limit are done by the database, so only these observations are loaded."""
+        if limit is not None and limit < 0:
+            raise ValueError("limit can not be negative")
+        self._limit = limit
+
+    def _get_sql(
+        self,
+        after_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        param_prefix: str = "",
+        with_row_number: bool = False,
+    ) -> tuple:
+        """Returns the SQL and parameters to select the observations that match the filters, in order.
+
+        after_id, limit and offset are used to page through the results.
+        after_id can only be used if the results are in id order.
+
+        param_prefix is put at the start of every parameter name, so this SQL can be used with others in one statement.
+        If with_row_number is set, a row_number column says where each row comes in the order."""
+        params: dict = {}
+
+        def add_param(name: str, value) -> str:
+            params[param_prefix + name] = value
+            return ":" + param_prefix + name
+
+        where: list = [
+            "o.metric_id = " + add_param("metric_id", self._metric._metric_id)
+        ]
 
         joins: list = []
 
+        order_by: list = []
+
         dimension_join_count = 0
 
         for dimension_key, dimension_filter in self._filter_by_dimensions.items():
@@ -358,41 +1456,174 @@ class ObservationList:
                 )
             )
             where.append(
-                " {table_alias}.key=:{table_alias}key".format(table_alias=table_alias)
+                " {table_alias}.key={param}".format(
+                    table_alias=table_alias,
+                    param=add_param(table_alias + "key", dimension_key),
+                )
             )
-            params[table_alias + "key"] = dimension_key
             where.append(
-                " {table_alias}.value=:{table_alias}value".format(
-                    table_alias=table_alias
+                " {table_alias}.value={param}".format(
+                    table_alias=table_alias,
+                    param=add_param(table_alias + "value", dimension_filter["value"]),
                 )
             )
-            params[table_alias + "value"] = dimension_filter["value"]
 
         for dimension_key in list(set(self._filter_by_dimensions_not_set)):
             dimension_join_count += 1
             table_alias = "dimension_filter_" + str(dimension_join_count)
             joins.append(
-                " LEFT JOIN dimension AS {table_alias} ON {table_alias}.metric_id=o.metric_id AND {table_alias}.observation_id=o.id AND {table_alias}.key = :{table_alias}key".format(
-                    table_alias=table_alias
+                " LEFT JOIN dimension AS {table_alias} ON {table_alias}.metric_id=o.metric_id AND {table_alias}.observation_id=o.id AND {table_alias}.key = {param}".format(
+                    table_alias=table_alias,
+                    param=add_param(table_alias + "key", dimension_key),
                 )
             )
-            params[table_alias + "key"] = dimension_key
             where.append(" {table_alias}.key IS NULL".format(table_alias=table_alias))
 
+        for order_by_type, dimension_key, descending in self._order_by:
+            direction = "DESC" if descending else "ASC"
+            if order_by_type == ORDER_BY_ID:
+                order_by.append("o.id " + direction)
+            elif order_by_type == ORDER_BY_MEASURE:
+                # Measures are saved as text, so compare them as numbers. Missing measures come last either way.
+                order_by.append("o.measure IS NULL")
+                order_by.append("CAST(o.measure AS NUMERIC) " + direction)
+            else:
+                dimension_join_count += 1
+                table_alias = "dimension_order_" + str(dimension_join_count)
+                joins.append(
+                    " LEFT JOIN dimension AS {table_alias} ON {table_alias}.metric_id=o.metric_id AND {table_alias}.observation_id=o.id AND {table_alias}.key = {param}".format(
+                        table_alias=table_alias,
+                        param=add_param(table_alias + "key", dimension_key),
+                    )
+                )
+                order_by.append(table_alias + ".value IS NULL")
+                order_by.append(table_alias + ".value " + direction)
+
+        if after_id is not None:
+            if self._order_by:
+                raise ValueError("after_id can only be used when ordering by id")
+            where.append(" o.id > " + add_param("after_id", after_id))
+
+        order_by.append("o.id ASC")
+
         sql: str = (
-            "SELECT o.* FROM observation AS o "
+            "SELECT o.*"
+            + (
+                ", ROW_NUMBER() OVER (ORDER BY "
+                + ", ".join(order_by)
+                + ") AS row_number"
+                if with_row_number
+                else ""
+            )
+            + " FROM observation AS o "
             + " ".join(joins)
             + " WHERE "
             + " AND ".join(where)
-            + " ORDER BY o.id ASC"
+            + " ORDER BY "
+            + ", ".join(order_by)
+        )
+
+        if limit is not None or offset is not None:
+            sql += " LIMIT " + add_param("limit", limit if limit is not None else -1)
+        if offset is not None:
+            sql += " OFFSET " + add_param("offset", offset)
+
+        return sql, params
+
+    def _get_cache_key(
+        self,
+        after_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+    ) -> tuple:
+        return (
+            self._metric._metric_id,
+            tuple(
+                sorted((k, v["value"]) for k, v in self._filter_by_dimensions.items())
+            ),
+            tuple(sorted(set(self._filter_by_dimensions_not_set))),
+            tuple(self._order_by),
+            after_id,
+            limit,
+            offset,
         )
 
+    def get_data(self) -> list:
+        """Returns a list of Observations.
+
+        Observations will match the filters set on this observation list. (Just don't set any filters to get all observations.)
+        They are in order, and there are no more than the limit; see the order_by methods and set_limit."""
+        return self._get_data_page(limit=self._limit)
+
+    def _get_data_page(
+        self,
+        after_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+    ) -> list:
+        query_cache = self._store._query_cache
+        if query_cache is not None:
+            generation = self._store._write_generation
+            cache_key = self._get_cache_key(
+                after_id=after_id, limit=limit, offset=offset
+            )
+            results = query_cache.get(cache_key, generation)
+            if results is None:
+                results = self._query_data(
+                    after_id=after_id, limit=limit, offset=offset
+                )
+                query_cache.put(cache_key, generation, results)
+        else:
+            results = self._query_data(after_id=after_id, limit=limit, offset=offset)
+
+        return [Observation(self._metric, result) for result in results]
+
+    def _query_data(
+        self,
+        after_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+    ) -> list:
+        cur = self._store._get_read_connection().cursor()
+        sql, params = self._get_sql(after_id=after_id, limit=limit, offset=offset)
         cur.execute(sql, params)
+        return cur.fetchall()
+
+    def _get_next_page_kwargs(
+        self, batch_size: int, count_so_far: int, last_id: Optional[str]
+    ) -> Optional[dict]:
+        """Returns the keyword arguments for _get_data_page to get the next page of iter_data, or None if there are no more pages.
+
+        In id order, pages start after the last id, which stays right even if observations are added while paging.
+        In any other order, pages start at an offset."""
+        limit = batch_size
+        if self._limit is not None:
+            limit = min(batch_size, self._limit - count_so_far)
+            if limit <= 0:
+                return None
+        if self._order_by:
+            return {"offset": count_so_far, "limit": limit}
+        return {"after_id": last_id, "limit": limit}
+
+    def iter_data(self, batch_size: int = 1000):
+        """Returns a generator of Observations.
 
-        out: list = []
-        for result in cur.fetchall():
-            out.append(Observation(self._metric, result))
-        return out
+        Observations will match the filters set on this observation list. (Just don't set any filters to get all observations.)
+        They are in order, and there are no more than the limit; see the order_by methods and set_limit.
+
+        Observations are fetched from the store batch_size at a time, so large results do not have to be held in memory at once."""
+        count_so_far = 0
+        last_id = None
+        while True:
+            page_kwargs = self._get_next_page_kwargs(batch_size, count_so_far, last_id)
+            if page_kwargs is None:
+                return
+            observations = self._get_data_page(**page_kwargs)
+            yield from observations
+            if len(observations) < page_kwargs["limit"]:
+                return
+            count_so_far += len(observations)
+            last_id = observations[-1].get_id()
 
     def get_data_by_dimension(self, dimension_key: str) -> dict:
         """Returns Observations grouped by the value of a dimension key.
@@ -419,9 +1650,14 @@ class Observation:
         self._metric: Metric = metric
         self._store: Store = metric._store
         self._observation_row_data = observation_row_data
+        # Set by load_observation_dimensions, so get_dimensions does not need the database.
+        self._dimensions: Optional[dict] = None
 
     def get_dimensions(self) -> dict:
-        cur = self._store._database_connection.cursor()
+        if self._dimensions is not None:
+            return dict(self._dimensions)
+
+        cur = self._store._get_read_connection().cursor()
 
         cur.execute(
             "SELECT dimension.key, dimension.value FROM dimension WHERE metric_id=? AND observation_id=?",
@@ -476,3 +1712,30 @@ class Observation:
 
     def get_id(self) -> str:
         return self._observation_row_data["id"]
+
+
+def load_observation_dimensions(observations: list):
+    """Gets the dimensions for all these Observations from the database at once, and keeps them on each Observation.
+
+    After this, get_dimensions on these Observations does not use the database.
+    This is for when Observations are got in one thread and used in another, as AsyncObservationList does."""
+    by_metric: dict = defaultdict(lambda: defaultdict(list))
+    for observation in observations:
+        observation._dimensions = {}
+        by_metric[(observation._store, observation._metric._metric_id)][
+            observation.get_id()
+        ].append(observation)
+    for (store, metric_id), observations_by_id in by_metric.items():
+        cur = store._get_read_connection().cursor()
+        observation_ids = list(observations_by_id.keys())
+        for start in range(0, len(observation_ids), LOAD_DIMENSIONS_MAX_IDS):
+            chunk = observation_ids[start : start + LOAD_DIMENSIONS_MAX_IDS]
+            cur.execute(
+                "SELECT observation_id, key, value FROM dimension WHERE metric_id=? AND observation_id IN ("
+                + ", ".join(["?"] * len(chunk))
+                + ")",
+                [metric_id] + chunk,
+            )
+            for row in cur.fetchall():
+                for observation in observations_by_id[row["observation_id"]]:
+                    observation._dimensions[row["key"]] = row["value"]
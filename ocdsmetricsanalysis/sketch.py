@@ -0,0 +1,259 @@
+import hashlib
+import heapq
+import json
+import math
+from collections.abc import Iterable, Mapping
+from typing import Optional, Union
+
+from ocdsmetricsanalysis.counting import (
+    BOUNDED_MEMORY_BATCH_SIZE,
+    CombinationCounter,
+    get_dimension_groupings,
+    get_grouping_positions,
+    iter_column_batches,
+    sum_counts_for_grouping,
+    to_python_value,
+)
+
+# How many candidates a heavy hitters summary keeps, for each one it is asked to return
+HEAVY_HITTERS_CAPACITY_FACTOR = 10
+
+
+def _json_default(value):
+    # NumPy values hash the same as the normal Python value, so sketches from arrays and lists can be merged.
+    python_value = to_python_value(value)
+    return str(value) if python_value is value else python_value
+
+
+def _get_hashes(key) -> tuple:
+    """Returns two 64 bit hashes of a key. They are the same in every process, so sketches can be merged."""
+    digest = hashlib.blake2b(
+        json.dumps(key, default=_json_default).encode("utf-8"), digest_size=16
+    ).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class CountMinSketch:
+    """A count-min sketch. This estimates how often keys have been seen, in a fixed amount of memory.
+
+    An estimate is never less than the true count. With probability 1 - delta,
+    it is more than the true count by no more than epsilon multiplied by the total of all counts.
+    """
+
+    def __init__(self, epsilon: float = 0.001, delta: float = 0.01):
+        self.epsilon = epsilon
+        self.delta = delta
+        self._width = math.ceil(math.e / epsilon)
+        self._depth = math.ceil(math.log(1 / delta))
+        self._table = [[0] * self._width for i in range(self._depth)]
+        self.total = 0
+
+    def _get_indexes(self, key) -> list:
+        hash_1, hash_2 = _get_hashes(key)
+        return [(hash_1 + i * hash_2) % self._width for i in range(self._depth)]
+
+    def add(self, key, count=1):
+        """Adds count to key. Returns the new estimate for key."""
+        self.total += count
+        estimate = None
+        for row, index in zip(self._table, self._get_indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        """Returns the estimated count for key."""
+        return min(
+            row[index] for row, index in zip(self._table, self._get_indexes(key))
+        )
+
+    def merge(self, other: "CountMinSketch"):
+        """Adds the counts from another sketch, made with the same epsilon and delta, to this one."""
+        if self._width != other._width or self._depth != other._depth:
+            raise ValueError("Can only merge sketches with the same epsilon and delta")
+        for row, other_row in zip(self._table, other._table):
+            for index, count in enumerate(other_row):
+                row[index] += count
+        self.total += other.total
+
+
+class HeavyHitters:
+    """Keeps track of the keys that have been seen most, in a fixed amount of memory.
+
+    Counts come from a count-min sketch. Up to capacity candidate keys are kept;
+    a new key replaces the candidate with the lowest estimate when its own estimate is higher.
+    The candidates are kept in a min-heap, so adding a key takes O(log capacity) time, not O(capacity).
+    """
+
+    def __init__(self, capacity: int, epsilon: float = 0.001, delta: float = 0.01):
+        self._capacity = capacity
+        self.count_min_sketch = CountMinSketch(epsilon=epsilon, delta=delta)
+        # Key to the estimate it had when it was last added
+        self._candidates: dict = {}
+        # A min-heap of tuples of estimate, sequence number (so keys are never compared) and key, one for each candidate.
+        # An estimate here may be lower than the one in _candidates; it is brought up to date when it reaches the top.
+        self._heap: list = []
+        self._sequence_number = 0
+
+    def _push(self, estimate, key):
+        self._sequence_number += 1
+        heapq.heappush(self._heap, (estimate, self._sequence_number, key))
+
+    def _replace_min(self, estimate, key):
+        self._sequence_number += 1
+        heapq.heapreplace(self._heap, (estimate, self._sequence_number, key))
+
+    def add(self, key, count=1):
+        """Adds count to key."""
+        estimate = self.count_min_sketch.add(key, count)
+        if key in self._candidates:
+            self._candidates[key] = estimate
+        elif len(self._candidates) < self._capacity:
+            self._candidates[key] = estimate
+            self._push(estimate, key)
+        else:
+            # Bring the top of the heap up to date, until it really is the candidate with the lowest estimate.
+            while self._heap[0][0] != self._candidates[self._heap[0][2]]:
+                min_key = self._heap[0][2]
+                self._replace_min(self._candidates[min_key], min_key)
+            if estimate > self._heap[0][0]:
+                del self._candidates[self._heap[0][2]]
+                self._candidates[key] = estimate
+                self._replace_min(estimate, key)
+
+    def merge(self, other: "HeavyHitters"):
+        """Adds the counts from another HeavyHitters, made with the same settings, to this one."""
+        self.count_min_sketch.merge(other.count_min_sketch)
+        candidates = set(self._candidates.keys()) | set(other._candidates.keys())
+        self._candidates = dict(
+            self._get_top(candidates, self._capacity, self.count_min_sketch)
+        )
+        self._heap = []
+        for key, estimate in self._candidates.items():
+            self._push(estimate, key)
+
+    def top(self, n: int) -> list:
+        """Returns the n keys with the highest estimates, as a list of tuples of key and estimated count."""
+        return self._get_top(self._candidates.keys(), n, self.count_min_sketch)
+
+    @staticmethod
+    def _get_top(keys, n: int, count_min_sketch: CountMinSketch) -> list:
+        estimates = [(key, count_min_sketch.estimate(key)) for key in keys]
+        estimates.sort(key=lambda e: e[1], reverse=True)
+        return estimates[:n]
+
+
+class AggregateSketch:
+    """Approximately counts how often answers appear in rows of data, in a fixed amount of memory.
+
+    This is for data with so many different combinations of values that counting them all exactly would not fit in memory.
+    Make one, add rows of data to it (all at once or in batches), then pass it to Metric.add_aggregate_observations_from_sketch.
+    Sketches made with the same settings can be merged,
+    so different processes can each count part of the data.
+
+    Construct: Pass idx_to_aggregate, idx_to_dimensions, create_observations_from_dimensions_exponentially
+    and grouping_sets, as for Metric.add_aggregate_observations.
+    Pass top_n, the most observations to make for the answers and for each extra dimension.
+    Pass epsilon and delta to set the error bounds: with probability 1 - delta, each count is too high
+    by no more than epsilon multiplied by the number of rows. Counts are never too low.
+    Smaller values use more memory.
+    """
+
+    def __init__(
+        self,
+        idx_to_aggregate: Union[str, int],
+        idx_to_dimensions: dict = {},
+        top_n: int = 100,
+        epsilon: float = 0.001,
+        delta: float = 0.01,
+        create_observations_from_dimensions_exponentially: bool = False,
+        grouping_sets: Optional[Union[str, list]] = None,
+    ):
+        self.idx_to_aggregate = idx_to_aggregate
+        self.idx_to_dimensions = idx_to_dimensions
+        self.top_n = top_n
+        self.epsilon = epsilon
+        self.delta = delta
+        self._groupings = get_dimension_groupings(
+            idx_to_dimensions,
+            create_observations_from_dimensions_exponentially,
+            grouping_sets=grouping_sets,
+        )
+        self._heavy_hitters = [
+            HeavyHitters(
+                top_n * HEAVY_HITTERS_CAPACITY_FACTOR, epsilon=epsilon, delta=delta
+            )
+            for grouping in self._groupings
+        ]
+        self.total = 0
+
+    def add_rows(
+        self,
+        data_rows: Union[Iterable, Mapping],
+        idx_to_weight: Optional[Union[str, int]] = None,
+        counting_backend: Optional[str] = None,
+        batch_size: Optional[int] = None,
+    ):
+        """Adds rows of data. data_rows and idx_to_weight are as for Metric.add_aggregate_observations.
+
+        Rows are counted exactly first, so each distinct combination in one batch only updates the sketch once.
+        data_rows can also be any iterable of rows, such as a generator. Only batch_size rows are held in memory and counted at once,
+        so memory use does not grow with the number of different combinations. If batch_size is not passed, BOUNDED_MEMORY_BATCH_SIZE is used.
+        """
+        for columns, weights in iter_column_batches(
+            data_rows,
+            [self.idx_to_aggregate] + list(self.idx_to_dimensions.keys()),
+            idx_to_weight=idx_to_weight,
+            batch_size=(
+                batch_size if batch_size is not None else BOUNDED_MEMORY_BATCH_SIZE
+            ),
+        ):
+            combination_counter = CombinationCounter(
+                columns, backend=counting_backend, weights=weights
+            )
+            self.total += (
+                sum(weights)
+                if weights is not None
+                else len(columns[self.idx_to_aggregate])
+            )
+            # Count each row once, then sum up those counts for each grouping.
+            counts = combination_counter.count(
+                (self.idx_to_aggregate,) + tuple(self.idx_to_dimensions.keys())
+            )
+            for grouping, heavy_hitters in zip(self._groupings, self._heavy_hitters):
+                # Just like exact counting, rows with an empty value are not counted.
+                for key, count in sum_counts_for_grouping(
+                    counts, get_grouping_positions(self.idx_to_dimensions, grouping)
+                ).items():
+                    # Keys from NumPy arrays have NumPy values, which can not be saved in the database.
+                    heavy_hitters.add(tuple(to_python_value(v) for v in key), count)
+
+    def merge(self, other: "AggregateSketch"):
+        """Adds the counts from another AggregateSketch, made with the same settings, to this one."""
+        if (
+            self._groupings != other._groupings
+            or self.idx_to_aggregate != other.idx_to_aggregate
+            or self.top_n != other.top_n
+        ):
+            raise ValueError("Can only merge sketches with the same settings")
+        for heavy_hitters, other_heavy_hitters in zip(
+            self._heavy_hitters, other._heavy_hitters
+        ):
+            heavy_hitters.merge(other_heavy_hitters)
+        self.total += other.total
+
+    def get_max_error(self):
+        """Returns the most any count may be too high by, with probability 1 - delta."""
+        return self.epsilon * self.total
+
+    def get_top_combinations(self) -> list:
+        """Returns the combinations to make observations for.
+
+        Returns a list with one item for the answers, then one for each extra dimension (or combination of extra dimensions).
+        Each item is a tuple of the extra dimension idxs,
+        and a list of up to top_n tuples of the values (answer first) and their estimated count, sorted by the values."""
+        return [
+            (grouping, sorted(heavy_hitters.top(self.top_n), key=lambda e: e[0]))
+            for grouping, heavy_hitters in zip(self._groupings, self._heavy_hitters)
+        ]
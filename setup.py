@@ -25,6 +25,15 @@ setup(
             "mypy",
             "sphinx",
             "sphinx_rtd_theme",
+            "numpy",
+        ],
+        "numpy": [
+            "numpy",
+        ],
+    },
+    entry_points={
+        "console_scripts": [
+            "ocdsmetricsanalysis = ocdsmetricsanalysis.cli:main",
         ],
     },
     classifiers=[],
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from ocdsmetricsanalysis.async_library import AsyncStore
+from ocdsmetricsanalysis.exceptions import MetricNotFoundException
+
+
+@pytest.fixture
+def data() -> dict:
+    source_file = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), "data", "two_dimensions.json"
+    )
+    with open(source_file) as fp:
+        return json.load(fp)
+
+
+def test_add_and_get_json(tmpdir, data):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        await store.add_metric_json(data)
+        metrics = await store.get_metrics()
+        assert ["HATS"] == [m.get_id() for m in metrics]
+        metric = await store.get_metric("HATS")
+        out = await metric.get_json()
+        keys = await metric.get_dimension_keys()
+        await store.close()
+        return out, keys
+
+    out, keys = asyncio.run(run())
+    assert data["id"] == out["id"]
+    assert len(data["observations"]) == len(out["observations"])
+    assert ["answer", "height"] == keys
+
+
+def test_get_metric_that_does_not_exist(tmpdir):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        try:
+            await store.get_metric("HATS")
+        finally:
+            await store.close()
+
+    with pytest.raises(MetricNotFoundException):
+        asyncio.run(run())
+
+
+def test_observation_list(tmpdir, data):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        await store.add_metric_json(data)
+        metric = await store.get_metric("HATS")
+        observation_list = metric.get_observation_list()
+        observation_list.filter_by_dimension("height", "tall")
+        observations = await observation_list.get_data()
+        grouped = await metric.get_observation_list().get_data_by_dimension("height")
+        await store.close()
+        return observations, grouped
+
+    observations, grouped = asyncio.run(run())
+    assert ["1", "2", "3"] == [o.get_id() for o in observations]
+    assert ["short", "tall"] == sorted(grouped.keys())
+
+
+def test_iter_data(tmpdir):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        await store.add_metric("HATS", "Hats", "How many hats?")
+        metric = await store.get_metric("HATS")
+        for i in range(25):
+            await metric.add_observation(
+                "%03d" % i, measure=str(i), dimensions={"answer": "yes"}
+            )
+        ids = []
+        async for observation in metric.get_observation_list().iter_data(batch_size=10):
+            ids.append(observation.get_id())
+        await store.close()
+        return ids
+
+    assert ["%03d" % i for i in range(25)] == asyncio.run(run())
+
+
+def test_get_dimensions_does_not_use_database_on_event_loop(tmpdir, data):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        await store.add_metric_json(data)
+        metric = await store.get_metric("HATS")
+        observation_list = metric.get_observation_list()
+        dimensions = [o.get_dimensions() for o in await observation_list.get_data()]
+        async for observation in observation_list.iter_data(batch_size=2):
+            dimensions.append(observation.get_dimensions())
+        grouped = await observation_list.get_data_by_dimension("height")
+        dimensions.extend(o.get_dimensions() for o in grouped["tall"])
+        # The event loop's thread never opened a read connection
+        assert None is getattr(
+            store.get_store()._read_connections_local, "connection", None
+        )
+        await store.close()
+        return dimensions
+
+    dimensions = asyncio.run(run())
+    expected = [o["dimensions"] for o in data["observations"]]
+    assert expected + expected + expected[:3] == dimensions
+
+
+def test_add_aggregate_observations(tmpdir):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        await store.add_metric("HATS", "Hats", "How many hats?")
+        metric = await store.get_metric("HATS")
+        await metric.add_aggregate_observations(
+            [{"like_answer": "yes"}, {"like_answer": "no"}, {"like_answer": "yes"}],
+            "like_answer",
+            "answer",
+        )
+        observations = await metric.get_observation_list().get_data()
+        await store.close()
+        return observations
+
+    observations = asyncio.run(run())
+    assert ["1", "2"] == [o.get_measure() for o in observations]
+
+
+def test_observation_list_order_and_limit(tmpdir, data):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        await store.add_metric_json(data)
+        metric = await store.get_metric("HATS")
+        observation_list = metric.get_observation_list()
+        observation_list.order_by_dimension("height", descending=True)
+        observation_list.order_by_id(descending=True)
+        observation_list.set_limit(3)
+        observations = await observation_list.get_data()
+        iterated = [o async for o in observation_list.iter_data(batch_size=2)]
+        await store.close()
+        return observations, iterated
+
+    observations, iterated = asyncio.run(run())
+    assert 3 == len(observations)
+    assert [o.get_id() for o in observations] == [o.get_id() for o in iterated]
+    assert ["tall"] * 3 == [o.get_dimensions()["height"] for o in observations]
+    ids = [o.get_id() for o in observations]
+    assert sorted(ids, reverse=True) == ids
+
+
+def test_get_data_batch(tmpdir, data):
+    async def run():
+        store = AsyncStore(os.path.join(tmpdir, "database.sqlite"))
+        await store.add_metric_json(data)
+        metric = await store.get_metric("HATS")
+        observation_lists = {}
+        for height in ["tall", "short"]:
+            observation_list = metric.get_observation_list()
+            observation_list.filter_by_dimension("height", height)
+            observation_lists[height] = observation_list
+        results = await store.get_data_batch(observation_lists)
+        await store.close()
+        return results
+
+    results = asyncio.run(run())
+    assert ["tall", "short"] == list(results.keys())
+    assert ["tall"] * 3 == [o.get_dimensions()["height"] for o in results["tall"]]
+    assert ["short"] * 3 == [o.get_dimensions()["height"] for o in results["short"]]
+
+
+def test_query_cache(tmpdir, data):
+    async def run():
+        store = AsyncStore(
+            os.path.join(tmpdir, "database.sqlite"),
+            query_cache_max_entries=2,
+            query_cache_max_rows=100,
+        )
+        await store.add_metric_json(data)
+        metric = await store.get_metric("HATS")
+        for i in range(2):
+            observation_list = metric.get_observation_list()
+            observation_list.filter_by_dimension("height", "tall")
+            observations = await observation_list.get_data()
+        query_cache = store.get_store()._query_cache
+        await store.close()
+        return observations, query_cache
+
+    observations, query_cache = asyncio.run(run())
+    assert ["1", "2", "3"] == [o.get_id() for o in observations]
+    assert 1 == query_cache.hits
+    assert 1 == query_cache.misses
+    assert 100 == query_cache._max_rows
@@ -0,0 +1,441 @@
+import csv
+import io
+import json
+import os
+
+import pytest
+
+from ocdsmetricsanalysis.cli import main
+from ocdsmetricsanalysis.library import Store
+
+DATA_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "data", "one_and_two_dimensions.json"
+)
+
+SURVEY_CSV = """response,person_height,people
+like,tall,2
+dislike,tall,1
+like,short,3
+,short,5
+like,tall,1
+"""
+
+EXPECTED_SURVEY_OBSERVATIONS = [
+    ("000000001", "1", {"answer": "dislike"}),
+    ("000000002", "6", {"answer": "like"}),
+    ("000000003", "0", {"answer": "dislike", "height": "short"}),
+    ("000000004", "1", {"answer": "dislike", "height": "tall"}),
+    ("000000005", "3", {"answer": "like", "height": "short"}),
+    ("000000006", "3", {"answer": "like", "height": "tall"}),
+]
+
+
+def _get_observations(database_filename, metric_id):
+    store = Store(database_filename)
+    out = [
+        (o.get_id(), o.get_measure(), o.get_dimensions())
+        for o in store.get_metric(metric_id).get_observation_list().get_data()
+    ]
+    store.close()
+    return out
+
+
+def test_import_and_export_json(tmpdir, capsys):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+
+    assert main(["import", database_filename, DATA_FILE]) == 0
+    assert main(["export", database_filename, "--metric", "HATS"]) == 0
+
+    store = Store(database_filename)
+    expected = store.get_metric("HATS").get_json()
+    store.close()
+    assert json.loads(capsys.readouterr().out) == expected
+    assert [o["id"] for o in expected["observations"]] == ["1", "2"]
+
+
+def test_import_ndjson_from_stdin_with_jobs(tmpdir, monkeypatch):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    with open(DATA_FILE) as fp:
+        data = json.load(fp)
+    lines = []
+    for i in range(5):
+        data["id"] = "HATS%d" % i
+        lines.append(json.dumps(data))
+    monkeypatch.setattr("sys.stdin", io.StringIO("\n".join(lines) + "\n"))
+
+    assert main(["import", database_filename, "--ndjson", "--jobs", "2"]) == 0
+
+    store = Store(database_filename)
+    assert sorted([m.get_id() for m in store.get_metrics()]) == [
+        "HATS0",
+        "HATS1",
+        "HATS2",
+        "HATS3",
+        "HATS4",
+    ]
+    store.close()
+
+
+def test_import_export_round_trip(tmpdir):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    export_filename = os.path.join(tmpdir, "export.json")
+    copy_filename = os.path.join(tmpdir, "copy.sqlite")
+
+    main(["import", database_filename, DATA_FILE])
+    main(["export", database_filename, "--output", export_filename])
+    assert main(["import", copy_filename, export_filename]) == 0
+
+    assert _get_observations(copy_filename, "HATS") == _get_observations(
+        database_filename, "HATS"
+    )
+
+
+def test_import_clash(tmpdir, capsys):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    main(["import", database_filename, DATA_FILE])
+
+    assert main(["import", database_filename, DATA_FILE]) == 1
+    assert "Metric id already in store" in capsys.readouterr().err
+
+    assert main(["import", database_filename, DATA_FILE, "--on-conflict", "skip"]) == 0
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+@pytest.mark.parametrize("batch_size", ["1", "2", "100"])
+def test_aggregate_csv_from_stdin(tmpdir, monkeypatch, jobs, batch_size):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    monkeypatch.setattr("sys.stdin", io.StringIO(SURVEY_CSV))
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                "--aggregate",
+                "response",
+                "--dimension",
+                "person_height=height",
+                "--weight",
+                "people",
+                "--batch-size",
+                batch_size,
+                "--jobs",
+                jobs,
+            ]
+        )
+        == 0
+    )
+
+    assert (
+        _get_observations(database_filename, "SURVEY") == EXPECTED_SURVEY_OBSERVATIONS
+    )
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_aggregate_spill_to_disk(tmpdir, monkeypatch, jobs):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    monkeypatch.setattr("sys.stdin", io.StringIO(SURVEY_CSV))
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                "--aggregate",
+                "response",
+                "--dimension",
+                "person_height=height",
+                "--weight",
+                "people",
+                "--batch-size",
+                "2",
+                "--max-combinations-in-memory",
+                "1",
+                "--jobs",
+                jobs,
+            ]
+        )
+        == 0
+    )
+
+    assert (
+        _get_observations(database_filename, "SURVEY") == EXPECTED_SURVEY_OBSERVATIONS
+    )
+
+
+def test_aggregate_grouping_set(tmpdir, monkeypatch):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    monkeypatch.setattr("sys.stdin", io.StringIO(SURVEY_CSV))
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                "--aggregate",
+                "response",
+                "--dimension",
+                "person_height=height",
+                "--weight",
+                "people",
+                "--grouping-set",
+                "person_height",
+            ]
+        )
+        == 0
+    )
+
+    assert _get_observations(database_filename, "SURVEY") == [
+        ("%09d" % (i + 1), o[1], o[2])
+        for i, o in enumerate(EXPECTED_SURVEY_OBSERVATIONS[2:])
+    ]
+
+
+def test_aggregate_ndjson_files(tmpdir):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    rows = list(csv.DictReader(io.StringIO(SURVEY_CSV)))
+    filenames = []
+    for i, part in enumerate([rows[:2], rows[2:]]):
+        filename = os.path.join(tmpdir, "part%d.ndjson" % i)
+        with open(filename, "w") as fp:
+            for row in part:
+                row["people"] = int(row["people"])
+                fp.write(json.dumps(row) + "\n")
+        filenames.append(filename)
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                *filenames,
+                "--input-format",
+                "ndjson",
+                "--aggregate",
+                "response",
+                "--dimension",
+                "person_height=height",
+                "--weight",
+                "people",
+                "--title",
+                "Survey",
+            ]
+        )
+        == 0
+    )
+
+    assert (
+        _get_observations(database_filename, "SURVEY") == EXPECTED_SURVEY_OBSERVATIONS
+    )
+    store = Store(database_filename)
+    assert store.get_metric("SURVEY").get_json()["title"] == "Survey"
+    store.close()
+
+
+@pytest.mark.parametrize(
+    "arguments",
+    [
+        ["--aggregate", "nope"],
+        ["--aggregate", "response", "--dimension", "nope=height"],
+        ["--aggregate", "response", "--weight", "nope"],
+    ],
+)
+def test_aggregate_column_not_found_csv(tmpdir, monkeypatch, capsys, arguments):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    monkeypatch.setattr("sys.stdin", io.StringIO(SURVEY_CSV))
+
+    assert main(["aggregate", database_filename, "SURVEY"] + arguments) == 1
+    assert "Error: Column not found in standard input: nope" in capsys.readouterr().err
+    assert not os.path.exists(database_filename)
+
+
+def test_aggregate_column_not_found_ndjson(tmpdir, capsys):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    filename = os.path.join(tmpdir, "survey.ndjson")
+    with open(filename, "w") as fp:
+        fp.write("\n")
+        fp.write(json.dumps({"response": "like", "person_height": "tall"}) + "\n")
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                filename,
+                "--input-format",
+                "ndjson",
+                "--aggregate",
+                "response",
+                "--dimension",
+                "height=height",
+            ]
+        )
+        == 1
+    )
+    assert "Error: Column not found in " + filename + ": height" in (
+        capsys.readouterr().err
+    )
+
+
+def test_aggregate_missing_values_csv(tmpdir, monkeypatch):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    # Short rows, which leave out the height and the number of people
+    monkeypatch.setattr(
+        "sys.stdin", io.StringIO(SURVEY_CSV + "like,short\nlike\ndislike,tall\n")
+    )
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                "--aggregate",
+                "response",
+                "--dimension",
+                "person_height=height",
+                "--weight",
+                "people",
+            ]
+        )
+        == 0
+    )
+
+    assert (
+        _get_observations(database_filename, "SURVEY") == EXPECTED_SURVEY_OBSERVATIONS
+    )
+
+
+def test_aggregate_missing_values_ndjson(tmpdir):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    filename = os.path.join(tmpdir, "survey.ndjson")
+    with open(filename, "w") as fp:
+        for row in csv.DictReader(io.StringIO(SURVEY_CSV)):
+            row["people"] = int(row["people"])
+            fp.write(json.dumps(row) + "\n")
+        # Rows that leave out keys, or have null for them
+        fp.write(json.dumps({"person_height": "tall", "people": 4}) + "\n")
+        fp.write(json.dumps({"response": "like", "person_height": "short"}) + "\n")
+        fp.write(json.dumps({"response": "like", "people": 1}) + "\n")
+        fp.write(json.dumps({"response": "dislike", "people": None}) + "\n")
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                filename,
+                "--input-format",
+                "ndjson",
+                "--aggregate",
+                "response",
+                "--dimension",
+                "person_height=height",
+                "--weight",
+                "people",
+            ]
+        )
+        == 0
+    )
+
+    observations = _get_observations(database_filename, "SURVEY")
+    assert EXPECTED_SURVEY_OBSERVATIONS[:1] == observations[:1]
+    assert ("000000002", "7", {"answer": "like"}) == observations[1]
+    assert EXPECTED_SURVEY_OBSERVATIONS[2:] == observations[2:]
+
+
+def test_aggregate_approximate(tmpdir, monkeypatch):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    monkeypatch.setattr("sys.stdin", io.StringIO(SURVEY_CSV))
+
+    assert (
+        main(
+            [
+                "aggregate",
+                database_filename,
+                "SURVEY",
+                "--aggregate",
+                "response",
+                "--weight",
+                "people",
+                "--approximate-top-n",
+                "1",
+            ]
+        )
+        == 0
+    )
+
+    assert _get_observations(database_filename, "SURVEY") == [
+        ("000000001", "6", {"answer": "like"})
+    ]
+
+
+def test_export_ndjson_and_csv(tmpdir, capsys):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    main(["import", database_filename, DATA_FILE])
+
+    assert main(["export", database_filename, "--format", "ndjson"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert json.loads(lines[0])["dimensions"] == {"answer": "Like"}
+
+    assert main(["export", database_filename, "--format", "csv"]) == 0
+    rows = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    assert rows[0]["dimensions/answer"] == "Like"
+
+    assert (
+        main(
+            [
+                "export",
+                database_filename,
+                "--format",
+                "csv",
+                "--no-dimensions-as-columns",
+            ]
+        )
+        == 0
+    )
+    rows = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    assert json.loads(rows[0]["dimensions"]) == {"answer": "Like"}
+
+
+def test_export_metric_not_found(tmpdir, capsys):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    main(["import", database_filename, DATA_FILE])
+
+    assert main(["export", database_filename, "--metric", "NOPE"]) == 1
+    assert "No such metric found" in capsys.readouterr().err
+
+
+def test_export_database_not_found(tmpdir, capsys):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+
+    assert main(["export", database_filename]) == 1
+    assert "unable to open database file" in capsys.readouterr().err
+    assert not os.path.exists(database_filename)
+
+
+def test_export_immutable_mmap(tmpdir, capsys):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    main(["import", database_filename, DATA_FILE])
+
+    assert (
+        main(
+            [
+                "export",
+                database_filename,
+                "--immutable",
+                "--mmap-size",
+                "1000000",
+                "--format",
+                "ndjson",
+            ]
+        )
+        == 0
+    )
+    assert len(capsys.readouterr().out.splitlines()) == 2
@@ -0,0 +1,402 @@
+import os
+import random
+
+import pytest
+
+from ocdsmetricsanalysis import counting
+from ocdsmetricsanalysis.counting import (
+    AggregateCounter,
+    CombinationCounter,
+    get_dimension_groupings,
+)
+from ocdsmetricsanalysis.library import Store
+
+BACKENDS = [
+    "python",
+    pytest.param(
+        "numpy",
+        marks=pytest.mark.skipif(counting.numpy is None, reason="NumPy not installed"),
+    ),
+]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_count(backend):
+    combination_counter = CombinationCounter(
+        {
+            "a": ["yes", "no", "yes", "yes", None],
+            "b": ["tall", "tall", "short", "tall", "tall"],
+        },
+        backend=backend,
+    )
+
+    assert {("yes",): 3, ("no",): 1, (None,): 1} == combination_counter.count(("a",))
+    assert {
+        ("yes", "tall"): 2,
+        ("no", "tall"): 1,
+        ("yes", "short"): 1,
+        (None, "tall"): 1,
+    } == combination_counter.count(("a", "b"))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_count_mixed_types(backend):
+    combination_counter = CombinationCounter({"a": [1, "1", 1, None]}, backend=backend)
+
+    assert {(1,): 2, ("1",): 1, (None,): 1} == combination_counter.count(("a",))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_count_no_rows(backend):
+    combination_counter = CombinationCounter({"a": []}, backend=backend)
+
+    assert {} == combination_counter.count(("a",))
+
+
+def test_bad_backend():
+    with pytest.raises(ValueError):
+        CombinationCounter({"a": []}, backend="abacus")
+
+
+def test_numpy_not_installed(monkeypatch):
+    monkeypatch.setattr(counting, "numpy", None)
+    with pytest.raises(ValueError):
+        CombinationCounter({"a": []}, backend="numpy")
+    assert {("x",): 1} == CombinationCounter({"a": ["x"]}).count(("a",))
+
+
+@pytest.mark.skipif(counting.numpy is None, reason="NumPy not installed")
+def test_numpy_squashes_large_combined_codes(monkeypatch):
+    monkeypatch.setattr(counting, "_NUMPY_MAX_COMBINED_CODE", 10)
+    columns = {
+        "a": ["a%d" % (i % 7) for i in range(100)],
+        "b": ["b%d" % (i % 5) for i in range(100)],
+        "c": ["c%d" % (i % 3) for i in range(100)],
+    }
+
+    assert CombinationCounter(columns, backend="python").count(
+        ("a", "b", "c")
+    ) == CombinationCounter(columns, backend="numpy").count(("a", "b", "c"))
+
+
+@pytest.mark.skipif(counting.numpy is None, reason="NumPy not installed")
+@pytest.mark.parametrize("exponentially", [False, True])
+def test_add_aggregate_observations_backends_match(tmpdir, exponentially):
+    random.seed(42)
+    data_rows = [
+        {
+            "like": random.choice(["yes", "no", "maybe", ""]),
+            "height": random.choice(["tall", "short", None]),
+            "hair": random.choice(["lots", "some", "none"]),
+        }
+        for i in range(500)
+    ]
+    out = []
+    for backend in ["python", "numpy"]:
+        store = Store(os.path.join(tmpdir, backend + ".sqlite"))
+        store.add_metric("HATS", "Hats", "How many hats?")
+        metric = store.get_metric("HATS")
+        metric.add_aggregate_observations(
+            data_rows,
+            "like",
+            "answer",
+            idx_to_dimensions={
+                "height": {"dimension_name": "height"},
+                "hair": {"dimension_name": "hair"},
+            },
+            create_observations_from_dimensions_exponentially=exponentially,
+            counting_backend=backend,
+        )
+        out.append(metric.get_json())
+
+    assert out[0] == out[1]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_count_weights(backend):
+    combination_counter = CombinationCounter(
+        {"a": ["yes", "no", "yes"]}, backend=backend, weights=[10, 1, 5]
+    )
+
+    counts = combination_counter.count(("a",))
+    assert {("yes",): 15, ("no",): 1} == counts
+    assert int == type(counts[("yes",)])
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_count_float_weights(backend):
+    combination_counter = CombinationCounter(
+        {"a": ["yes", "no", "yes"]}, backend=backend, weights=[0.5, 1.0, 2.0]
+    )
+
+    assert {("yes",): 2.5, ("no",): 1.0} == combination_counter.count(("a",))
+
+
+def test_count_mixed_weights_python(monkeypatch):
+    combination_counter = CombinationCounter(
+        {"a": ["x", "y"]}, backend="python", weights=[1, 2.5]
+    )
+    counts = combination_counter.count(("a",))
+    monkeypatch.setattr(counting, "numpy", None)
+    counts_without_numpy = CombinationCounter(
+        {"a": ["x", "y"]}, backend="python", weights=[1, 2.5]
+    ).count(("a",))
+
+    assert {("x",): 1, ("y",): 2.5} == counts == counts_without_numpy
+    assert int == type(counts[("x",)]) == type(counts_without_numpy[("x",)])
+
+
+def _get_random_data_rows(count: int) -> list:
+    return [
+        {
+            "like": random.choice(["yes", "no", "maybe", "", "ÿes"]),
+            "height": random.choice(["tall", "short", None]),
+            "hair": random.choice(["lots", "some", "none"]),
+            "people": random.randint(1, 5),
+        }
+        for i in range(count)
+    ]
+
+
+IDX_TO_DIMENSIONS = {
+    "height": {"dimension_name": "height"},
+    "hair": {"dimension_name": "hair"},
+}
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("max_combinations_in_memory", [1, 5, 1000])
+def test_spill_to_disk_matches_in_memory(backend, max_combinations_in_memory):
+    random.seed(42)
+    data_rows = _get_random_data_rows(300)
+
+    in_memory_counter = AggregateCounter("like", IDX_TO_DIMENSIONS, True)
+    in_memory_counter.add_rows(data_rows, idx_to_weight="people")
+    spill_counter = AggregateCounter(
+        "like",
+        IDX_TO_DIMENSIONS,
+        True,
+        max_combinations_in_memory=max_combinations_in_memory,
+    )
+    spill_counter.add_rows(
+        data_rows, idx_to_weight="people", counting_backend=backend, batch_size=50
+    )
+
+    assert list(in_memory_counter.iter_combinations()) == list(
+        spill_counter.iter_combinations()
+    )
+    assert (spill_counter._spill_connection is not None) == (
+        max_combinations_in_memory < 1000
+    )
+    spill_counter.close()
+    assert spill_counter._spill_connection is None
+
+
+def test_spill_to_disk_merge():
+    random.seed(42)
+    data_rows = _get_random_data_rows(300)
+
+    in_memory_counter = AggregateCounter("like", IDX_TO_DIMENSIONS)
+    in_memory_counter.add_rows(data_rows)
+    spill_counter = AggregateCounter(
+        "like", IDX_TO_DIMENSIONS, max_combinations_in_memory=3
+    )
+    spill_counter.add_rows(data_rows[:100])
+    other_spill_counter = AggregateCounter(
+        "like", IDX_TO_DIMENSIONS, max_combinations_in_memory=3
+    )
+    other_spill_counter.add_rows(data_rows[100:])
+    spill_counter.merge(other_spill_counter)
+    other_spill_counter.close()
+
+    assert list(in_memory_counter.iter_combinations()) == list(
+        spill_counter.iter_combinations()
+    )
+    spill_counter.close()
+
+
+def test_add_aggregate_observations_spill_to_disk(tmpdir):
+    random.seed(42)
+    data_rows = _get_random_data_rows(300)
+    out = []
+    for max_combinations_in_memory in [None, 2]:
+        store = Store(os.path.join(tmpdir, str(max_combinations_in_memory) + ".sqlite"))
+        store.add_metric("HATS", "Hats", "How many hats?")
+        metric = store.get_metric("HATS")
+        metric.add_aggregate_observations(
+            data_rows,
+            "like",
+            "answer",
+            idx_to_dimensions=IDX_TO_DIMENSIONS,
+            max_combinations_in_memory=max_combinations_in_memory,
+        )
+        out.append(metric.get_json())
+
+    assert out[0] == out[1]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_add_aggregate_observations_spill_to_disk_numpy_weights(tmpdir, backend):
+    numpy = pytest.importorskip("numpy")
+    store = Store(os.path.join(tmpdir, "database.sqlite"))
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        {"a": numpy.array(["x", "y", "x"]), "w": numpy.array([1, 2, 3])},
+        "a",
+        "answer",
+        idx_to_weight="w",
+        max_combinations_in_memory=1,
+        batch_size=1,
+        counting_backend=backend,
+    )
+
+    assert [("4", {"answer": "x"}), ("2", {"answer": "y"})] == [
+        (o.get_measure(), o.get_dimensions())
+        for o in metric.get_observation_list().get_data()
+    ]
+
+
+def test_spill_to_disk_bounds_memory_without_batch_size(monkeypatch):
+    monkeypatch.setattr(counting, "BOUNDED_MEMORY_BATCH_SIZE", 50)
+    random.seed(42)
+    data_rows = _get_random_data_rows(300)
+    batch_lengths = []
+    original_count = CombinationCounter.count
+
+    def count(self, keys):
+        batch_lengths.append(len(self._columns[keys[0]]))
+        return original_count(self, keys)
+
+    monkeypatch.setattr(CombinationCounter, "count", count)
+    counts_in_memory = []
+    original_spill_if_needed = AggregateCounter._spill_if_needed
+
+    def spill_if_needed(self):
+        counts_in_memory.append(len(self._counts))
+        original_spill_if_needed(self)
+
+    monkeypatch.setattr(AggregateCounter, "_spill_if_needed", spill_if_needed)
+
+    in_memory_counter = AggregateCounter("like", IDX_TO_DIMENSIONS)
+    in_memory_counter.add_rows(data_rows)
+    del counts_in_memory[:]
+    spill_counter = AggregateCounter(
+        "like", IDX_TO_DIMENSIONS, max_combinations_in_memory=3
+    )
+    spill_counter.add_rows(iter(data_rows))
+
+    assert [300] + [50] * 6 == batch_lengths
+    assert 4 == max(counts_in_memory)
+    assert list(in_memory_counter.iter_combinations()) == list(
+        spill_counter.iter_combinations()
+    )
+    spill_counter.close()
+
+
+def test_spill_to_disk_bounds_possible_values(monkeypatch):
+    # Every row has a different answer, so there are many more possible values than combinations held in memory
+    data_rows = [
+        {"like": "answer " + str(i), "height": str(i % 3), "hair": str(i % 2)}
+        for i in range(500)
+    ]
+    values_in_memory = []
+    original_spill_if_needed = AggregateCounter._spill_if_needed
+
+    def spill_if_needed(self):
+        values_in_memory.append(
+            sum(len(values) for values in self._possible_values.values())
+        )
+        original_spill_if_needed(self)
+
+    monkeypatch.setattr(AggregateCounter, "_spill_if_needed", spill_if_needed)
+
+    in_memory_counter = AggregateCounter("like", IDX_TO_DIMENSIONS, True)
+    in_memory_counter.add_rows(data_rows)
+    del values_in_memory[:]
+    spill_counter = AggregateCounter(
+        "like", IDX_TO_DIMENSIONS, True, max_combinations_in_memory=10
+    )
+    spill_counter.add_rows(iter(data_rows), batch_size=10)
+
+    # At most the values of the combinations held in memory, and one more batch
+    assert 25 == max(values_in_memory)
+    # Combinations are made and ordered by the database, in the same order as in memory
+    assert list(in_memory_counter.iter_combinations()) == list(
+        spill_counter.iter_combinations()
+    )
+    assert not any(spill_counter._possible_values.values())
+    spill_counter.close()
+
+
+def test_get_dimension_groupings():
+    idx_to_dimensions = {"a": {}, "b": {}, "c": {}}
+
+    assert [(), ("a",), ("b",), ("c",)] == get_dimension_groupings(
+        idx_to_dimensions, False
+    )
+    assert [
+        (),
+        ("a",),
+        ("b",),
+        ("a", "b"),
+        ("c",),
+        ("a", "c"),
+        ("b", "c"),
+        ("a", "b", "c"),
+    ] == get_dimension_groupings(idx_to_dimensions, False, grouping_sets="cube")
+    assert [(), ("a",), ("a", "b"), ("a", "b", "c")] == get_dimension_groupings(
+        idx_to_dimensions, False, grouping_sets="rollup"
+    )
+    assert [("c", "a"), ()] == get_dimension_groupings(
+        idx_to_dimensions, False, grouping_sets=[["c", "a"], []]
+    )
+
+
+@pytest.mark.parametrize(
+    "grouping_sets,exponentially",
+    [("cube", True), ("sideways", False), ([["d"]], False)],
+)
+def test_get_dimension_groupings_bad(grouping_sets, exponentially):
+    with pytest.raises(ValueError):
+        get_dimension_groupings(
+            {"a": {}, "b": {}}, exponentially, grouping_sets=grouping_sets
+        )
+
+
+@pytest.mark.parametrize("max_combinations_in_memory", [None, 1])
+def test_rows_counted_once_for_all_groupings(monkeypatch, max_combinations_in_memory):
+    random.seed(42)
+    data_rows = _get_random_data_rows(300)
+    count_calls = []
+    original_count = CombinationCounter.count
+
+    def count(self, keys):
+        count_calls.append(keys)
+        return original_count(self, keys)
+
+    monkeypatch.setattr(CombinationCounter, "count", count)
+
+    counter = AggregateCounter(
+        "like",
+        IDX_TO_DIMENSIONS,
+        grouping_sets="cube",
+        max_combinations_in_memory=max_combinations_in_memory,
+    )
+    counter.add_rows(data_rows, batch_size=100)
+
+    assert [("like", "height", "hair")] * 3 == count_calls
+
+    combinations = list(counter.iter_combinations())
+    counter.close()
+    assert [(), ("height",), ("hair",), ("height", "hair")] == list(
+        dict.fromkeys([c[0] for c in combinations])
+    )
+    for grouping, values, count in combinations:
+        assert count == len(
+            [
+                row
+                for row in data_rows
+                if tuple(row[idx] for idx in ("like",) + grouping) == values
+            ]
+        )
@@ -76,3 +76,13 @@ def test_units(store):
         assert (
             "http://example.com/AnimateObjects/HUMANS" == observations[i].get_unit_uri()
         )
+
+
+def test_observation_list_iter_data(store):
+    metric = store.get_metric("HATS")
+    observation_list = metric.get_observation_list()
+
+    assert ["1", "2", "3"] == [o.get_id() for o in observation_list.iter_data()]
+    assert ["1", "2", "3"] == [
+        o.get_id() for o in observation_list.iter_data(batch_size=2)
+    ]
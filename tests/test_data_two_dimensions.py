@@ -130,3 +130,19 @@ def test_units(store):
 
     for i in range(0, 6):
         assert not observations[i].has_unit()
+
+
+def test_metric_get_dimension_values(store):
+    metric = store.get_metric("HATS")
+
+    assert ["short", "tall"] == metric.get_dimension_values("height")
+    assert ["Hate", "Like", "Neither hate or like"] == metric.get_dimension_values(
+        "answer"
+    )
+    assert [] == metric.get_dimension_values("colour")
+
+
+def test_metric_get_dimension_value_counts(store):
+    metric = store.get_metric("HATS")
+
+    assert {"short": 3, "tall": 3} == metric.get_dimension_value_counts("height")
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from ocdsmetricsanalysis.library import Store
+
+
+def _add_hats(store: Store, metric_id: str, observations: dict):
+    store.add_metric(metric_id, "Hats", "How many hats?")
+    metric = store.get_metric(metric_id)
+    for id, (measure, dimensions) in observations.items():
+        metric.add_observation(id, measure=measure, dimensions=dimensions)
+
+
+YESTERDAY = {
+    "H1": ("10", {"colour": "red"}),
+    "H2": ("20", {"colour": "blue"}),
+    "H3": ("30", {"colour": "green"}),
+    "H4": ("40", {"colour": "pink"}),
+}
+
+TODAY = {
+    "H1": ("10", {"colour": "red"}),
+    "H2": ("21", {"colour": "blue"}),
+    "H3": ("30", {"colour": "green", "size": "big"}),
+    "H5": ("50", {"colour": "pink"}),
+}
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"))
+    _add_hats(store, "HATS_YESTERDAY", YESTERDAY)
+    _add_hats(store, "HATS_TODAY", TODAY)
+    return store
+
+
+def _summarise(changes) -> list:
+    return [
+        (
+            c["change"],
+            c["id"],
+            c["old"].get_measure() if c["old"] else None,
+            c["new"].get_dimensions() if c["new"] else None,
+        )
+        for c in changes
+    ]
+
+
+EXPECTED = [
+    ("changed", "H2", "20", {"colour": "blue"}),
+    ("changed", "H3", "30", {"colour": "green", "size": "big"}),
+    ("removed", "H4", "40", None),
+    ("added", "H5", None, {"colour": "pink"}),
+]
+
+
+def test_metric_diff_same_store(store):
+    changes = store.get_metric("HATS_YESTERDAY").diff(store.get_metric("HATS_TODAY"))
+
+    assert EXPECTED == _summarise(changes)
+
+
+def test_metric_diff_same_metric(store):
+    metric = store.get_metric("HATS_TODAY")
+
+    assert [] == list(metric.diff(metric))
+
+
+def test_metric_diff_different_stores(store, tmpdir):
+    other_store = Store(os.path.join(tmpdir, "other.sqlite"))
+    _add_hats(other_store, "HATS", TODAY)
+
+    changes = store.get_metric("HATS_YESTERDAY").diff(other_store.get_metric("HATS"))
+
+    assert EXPECTED == _summarise(changes)
+
+
+def test_store_diff(tmpdir):
+    old_store = Store(os.path.join(tmpdir, "old.sqlite"))
+    _add_hats(old_store, "HATS", YESTERDAY)
+    _add_hats(old_store, "SOCKS", {"S1": ("1", {})})
+    new_store = Store(os.path.join(tmpdir, "new.sqlite"))
+    _add_hats(new_store, "HATS", TODAY)
+    _add_hats(new_store, "TIES", {"T1": ("1", {})})
+
+    changes = list(old_store.diff(new_store))
+
+    assert [("HATS", c[1]) for c in EXPECTED] + [
+        ("SOCKS", "S1"),
+        ("TIES", "T1"),
+    ] == [(c["metric_id"], c["id"]) for c in changes]
+    assert ["removed", "added"] == [c["change"] for c in changes[-2:]]
@@ -0,0 +1,185 @@
+import csv
+import io
+import json
+import os
+
+import pytest
+
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"))
+    source_file = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "data",
+        "one_and_two_dimensions.json",
+    )
+    with open(source_file) as fp:
+        data = json.load(fp)
+    store.add_metric_json(data)
+    store.add_metric("TIES", "Ties", "Why?")
+    store.get_metric("TIES").add_observation(
+        "T1",
+        value_amount="100",
+        value_currency="GBP",
+        dimensions={"colour": "red"},
+    )
+    return store
+
+
+def test_export_ndjson(store):
+    out = io.StringIO()
+    store.export_ndjson(out)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert [
+        {
+            "metric_id": "HATS",
+            "id": "1",
+            "value_amount": None,
+            "value_currency": None,
+            "measure": "46",
+            "unit_name": None,
+            "unit_scheme": None,
+            "unit_id": None,
+            "unit_uri": None,
+            "dimensions": {"answer": "Like"},
+        },
+        {
+            "metric_id": "HATS",
+            "id": "2",
+            "value_amount": None,
+            "value_currency": None,
+            "measure": "24",
+            "unit_name": None,
+            "unit_scheme": None,
+            "unit_id": None,
+            "unit_uri": None,
+            "dimensions": {"answer": "Like", "height": "short"},
+        },
+        {
+            "metric_id": "TIES",
+            "id": "T1",
+            "value_amount": "100",
+            "value_currency": "GBP",
+            "measure": None,
+            "unit_name": None,
+            "unit_scheme": None,
+            "unit_id": None,
+            "unit_uri": None,
+            "dimensions": {"colour": "red"},
+        },
+    ] == lines
+
+
+def test_export_ndjson_one_metric_dimensions_as_columns(store):
+    out = io.StringIO()
+    store.get_metric("HATS").export_ndjson(out, dimensions_as_columns=True)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert 2 == len(lines)
+    assert "Like" == lines[0]["dimensions/answer"]
+    assert "height" not in lines[0]
+    assert "dimensions/height" not in lines[0]
+    assert "short" == lines[1]["dimensions/height"]
+
+
+def test_export_csv(store):
+    out = io.StringIO(newline="")
+    store.export_csv(out)
+    out.seek(0)
+    rows = list(csv.DictReader(out))
+
+    assert 3 == len(rows)
+    assert [
+        "metric_id",
+        "id",
+        "value_amount",
+        "value_currency",
+        "measure",
+        "unit_name",
+        "unit_scheme",
+        "unit_id",
+        "unit_uri",
+        "dimensions/answer",
+        "dimensions/colour",
+        "dimensions/height",
+    ] == list(rows[0].keys())
+    assert "" == rows[0]["dimensions/height"]
+    assert "short" == rows[1]["dimensions/height"]
+    assert "red" == rows[2]["dimensions/colour"]
+    assert "GBP" == rows[2]["value_currency"]
+
+
+def test_export_csv_one_metric_dimensions_as_map(store):
+    out = io.StringIO(newline="")
+    store.get_metric("HATS").export_csv(out, dimensions_as_columns=False)
+    out.seek(0)
+    rows = list(csv.DictReader(out))
+
+    assert 2 == len(rows)
+    assert {"answer": "Like", "height": "short"} == json.loads(rows[1]["dimensions"])
+
+
+def test_export_empty_metric(store):
+    store.add_metric("SOCKS", "Socks", "Any?")
+    out = io.StringIO()
+    store.get_metric("SOCKS").export_ndjson(out)
+    assert "" == out.getvalue()
+
+
+@pytest.mark.parametrize("metric_id", ["HATS", "TIES"])
+def test_get_json_string(store, metric_id):
+    metric = store.get_metric(metric_id)
+    out = io.StringIO()
+    metric.write_json(out)
+
+    assert metric.get_json() == json.loads(metric.get_json_string())
+    assert metric.get_json_string() == out.getvalue()
+
+
+def test_get_json_string_leaves_out_empty_fields(store):
+    metric = store.get_metric("TIES")
+    metric.add_observation("T2", measure="0", dimensions={})
+    metric.add_observation("T3", unit_name="", unit_uri="http://example.com/units/ties")
+    metric.add_observation("T4", value_amount="", measure="")
+
+    data = json.loads(metric.get_json_string())
+
+    assert metric.get_json() == data
+    assert [
+        {
+            "id": "T1",
+            "dimensions": {"colour": "red"},
+            "value": {"amount": "100", "currency": "GBP"},
+        },
+        {"id": "T2", "dimensions": {}, "measure": "0"},
+        {
+            "id": "T3",
+            "dimensions": {},
+            "unit": {
+                "name": "",
+                "scheme": None,
+                "id": None,
+                "uri": "http://example.com/units/ties",
+            },
+        },
+        {"id": "T4", "dimensions": {}},
+    ] == data["observations"]
+
+
+def test_get_json_string_empty_metric(store):
+    store.add_metric("SOCKS", "Socks", "Any?")
+    metric = store.get_metric("SOCKS")
+    out = io.StringIO()
+    metric.write_json(out)
+
+    assert {
+        "id": "SOCKS",
+        "title": "Socks",
+        "description": "Any?",
+        "observations": [],
+    } == json.loads(metric.get_json_string())
+    assert metric.get_json_string() == out.getvalue()
@@ -2,6 +2,7 @@ import os
 
 import pytest
 
+from ocdsmetricsanalysis.counting import AggregateCounter
 from ocdsmetricsanalysis.library import Store
 
 
@@ -223,3 +224,274 @@ def test_two_dimensions_create_observations_from_dimensions_exponentially(store)
         assert expected_answer[3] == observation.get_dimensions().get(
             "hair"
         ), "EXPECTED ANSWER = " + str(expected_answer)
+
+
+def test_columns_of_data(store):
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        {
+            "like_answer": ["yes", "no", "no", "yes", "yes"],
+            "height_answer": ["tall", "tall", "tall", "short", "short"],
+            "not_used": [1, 2, 3, 4, 5],
+        },
+        "like_answer",
+        "answer",
+        idx_to_dimensions={"height_answer": {"dimension_name": "height"}},
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    expected_answers = [
+        ("2", "no", None),
+        ("3", "yes", None),
+        ("0", "no", "short"),
+        ("2", "no", "tall"),
+        ("2", "yes", "short"),
+        ("1", "yes", "tall"),
+    ]
+    assert expected_answers == [
+        (
+            o.get_measure(),
+            o.get_dimensions()["answer"],
+            o.get_dimensions().get("height"),
+        )
+        for o in observations
+    ]
+
+
+def test_columns_of_data_numpy(store):
+    numpy = pytest.importorskip("numpy")
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        {
+            "like_answer": numpy.array(["yes", "no", "no", "yes", "yes"]),
+            "height_answer": numpy.array([180, 180, 180, 150, 0]),
+        },
+        "like_answer",
+        "answer",
+        idx_to_dimensions={"height_answer": {"dimension_name": "height"}},
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    expected_answers = [
+        ("2", "no", None),
+        ("3", "yes", None),
+        ("0", "no", "150"),
+        ("2", "no", "180"),
+        ("1", "yes", "150"),
+        ("1", "yes", "180"),
+    ]
+    assert expected_answers == [
+        (
+            o.get_measure(),
+            o.get_dimensions()["answer"],
+            o.get_dimensions().get("height"),
+        )
+        for o in observations
+    ]
+
+
+def test_columns_of_data_different_lengths(store):
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    with pytest.raises(ValueError):
+        metric.add_aggregate_observations(
+            {"like_answer": ["yes", "no"], "height_answer": ["tall"]},
+            "like_answer",
+            "answer",
+            idx_to_dimensions={"height_answer": {"dimension_name": "height"}},
+        )
+
+
+def test_weights(store):
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        [
+            {"like_answer": "yes", "height_answer": "tall", "count": 1},
+            {"like_answer": "no", "height_answer": "tall", "count": 2},
+            {"like_answer": "yes", "height_answer": "short", "count": 2000},
+        ],
+        "like_answer",
+        "answer",
+        idx_to_dimensions={"height_answer": {"dimension_name": "height"}},
+        idx_to_weight="count",
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    expected_answers = [
+        ("2", "no", None),
+        ("2001", "yes", None),
+        ("0", "no", "short"),
+        ("2", "no", "tall"),
+        ("2000", "yes", "short"),
+        ("1", "yes", "tall"),
+    ]
+    assert expected_answers == [
+        (
+            o.get_measure(),
+            o.get_dimensions()["answer"],
+            o.get_dimensions().get("height"),
+        )
+        for o in observations
+    ]
+
+
+def test_weights_columns_of_data(store):
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        {"like_answer": ["yes", "no", "yes"], "count": [4312, 7, 1]},
+        "like_answer",
+        "answer",
+        idx_to_weight="count",
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    assert ["7", "4313"] == [o.get_measure() for o in observations]
+
+
+@pytest.mark.parametrize("counting_backend", ["python", "numpy"])
+def test_weights_numpy(store, counting_backend):
+    numpy = pytest.importorskip("numpy")
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        {"like_answer": numpy.array(["x", "y", "x"]), "count": numpy.array([1, 2, 3])},
+        "like_answer",
+        "answer",
+        idx_to_weight="count",
+        counting_backend=counting_backend,
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    assert ["4", "2"] == [o.get_measure() for o in observations]
+
+
+@pytest.mark.parametrize("batch_size", [None, 1, 2, 100])
+def test_generator_in_batches(store, batch_size):
+    rows = [
+        {"like_answer": "yes", "height_answer": "tall"},
+        {"like_answer": "no", "height_answer": "tall"},
+        {"like_answer": "yes", "height_answer": "short"},
+        {"like_answer": "", "height_answer": "medium"},
+    ]
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        (row for row in rows),
+        "like_answer",
+        "answer",
+        idx_to_dimensions={"height_answer": {"dimension_name": "height"}},
+        batch_size=batch_size,
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    expected_answers = [
+        ("1", "no", None),
+        ("2", "yes", None),
+        ("0", "no", "medium"),
+        ("0", "no", "short"),
+        ("1", "no", "tall"),
+        ("0", "yes", "medium"),
+        ("1", "yes", "short"),
+        ("1", "yes", "tall"),
+    ]
+    assert expected_answers == [
+        (
+            o.get_measure(),
+            o.get_dimensions()["answer"],
+            o.get_dimensions().get("height"),
+        )
+        for o in observations
+    ]
+
+
+def test_counters_merged(store):
+    counter = AggregateCounter(
+        "like_answer", {"height_answer": {"dimension_name": "height"}}
+    )
+    counter.add_rows([{"like_answer": "yes", "height_answer": "tall"}])
+    other_counter = AggregateCounter(
+        "like_answer", {"height_answer": {"dimension_name": "height"}}
+    )
+    other_counter.add_rows(
+        {"like_answer": ["yes", "no"], "height_answer": ["short", "tall"]},
+        batch_size=1,
+    )
+    counter.merge(other_counter)
+
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations_from_counter(counter, "answer")
+
+    observations = metric.get_observation_list().get_data()
+
+    assert ["1", "2", "0", "1", "1", "1"] == [o.get_measure() for o in observations]
+
+
+def test_grouping_sets_rollup(store):
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        [
+            {"like_answer": "yes", "height_answer": "tall", "hair_answer": "lots"},
+            {"like_answer": "no", "height_answer": "tall", "hair_answer": "lots"},
+            {"like_answer": "yes", "height_answer": "short", "hair_answer": ""},
+        ],
+        "like_answer",
+        "answer",
+        idx_to_dimensions={
+            "height_answer": {"dimension_name": "height"},
+            "hair_answer": {"dimension_name": "hair"},
+        },
+        grouping_sets="rollup",
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    assert [
+        ("1", {"answer": "no"}),
+        ("2", {"answer": "yes"}),
+        ("0", {"answer": "no", "height": "short"}),
+        ("1", {"answer": "no", "height": "tall"}),
+        ("1", {"answer": "yes", "height": "short"}),
+        ("1", {"answer": "yes", "height": "tall"}),
+        ("0", {"answer": "no", "height": "short", "hair": "lots"}),
+        ("1", {"answer": "no", "height": "tall", "hair": "lots"}),
+        ("0", {"answer": "yes", "height": "short", "hair": "lots"}),
+        ("1", {"answer": "yes", "height": "tall", "hair": "lots"}),
+    ] == [(o.get_measure(), o.get_dimensions()) for o in observations]
+
+
+def test_grouping_sets_list(store):
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        [
+            {"like_answer": "yes", "height_answer": "tall", "hair_answer": "lots"},
+            {"like_answer": "no", "height_answer": "tall", "hair_answer": "lots"},
+            {"like_answer": "yes", "height_answer": "short", "hair_answer": "lots"},
+        ],
+        "like_answer",
+        "answer",
+        idx_to_dimensions={
+            "height_answer": {"dimension_name": "height"},
+            "hair_answer": {"dimension_name": "hair"},
+        },
+        grouping_sets=[["hair_answer"]],
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    assert [
+        ("1", {"answer": "no", "hair": "lots"}),
+        ("2", {"answer": "yes", "hair": "lots"}),
+    ] == [(o.get_measure(), o.get_dimensions()) for o in observations]
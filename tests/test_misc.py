@@ -1,4 +1,5 @@
 import os
+import sqlite3
 
 import pytest
 
@@ -99,3 +100,56 @@ def test_get_metrics(store):
     assert 2 == len(metrics)
     assert "HATS" == metrics[0].get_id()
     assert "TIES" == metrics[1].get_id()
+
+
+def test_reopen_store(tmpdir):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    store = Store(database_filename)
+    store.add_metric("HATS", "Hats", "How many hats?")
+    store.get_metric("HATS").add_observation("H1", dimensions={"colour": "red"})
+    store.close()
+
+    store = Store(database_filename)
+    metric = store.get_metric("HATS")
+    metric.add_observation("H2", dimensions={"colour": "red"})
+    assert ["H1", "H2"] == [
+        o.get_id() for o in metric.get_observation_list().get_data()
+    ]
+    assert {"red": 2} == metric.get_dimension_value_counts("colour")
+    store.close()
+
+
+def test_dimension_value_counts_null(store):
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    for i in range(3):
+        metric.add_observation(str(i), dimensions={"colour": None})
+    metric.add_observation("3", dimensions={"colour": "red"})
+
+    assert {None: 3, "red": 1} == metric.get_dimension_value_counts("colour")
+
+    store.add_metric("HATS", "Hats", "How many hats?", on_conflict="replace")
+    assert {} == metric.get_dimension_value_counts("colour")
+
+
+def test_reopen_store_without_dimension_catalog(tmpdir):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    store = Store(database_filename)
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_observation("H1", dimensions={"colour": "red", "size": None})
+    metric.add_observation("H2", dimensions={"colour": "red", "size": None})
+    store.close()
+    # As a database made before there was a dimension catalog
+    connection = sqlite3.connect(database_filename)
+    connection.execute("DROP TABLE dimension_catalog")
+    connection.close()
+
+    store = Store(database_filename)
+    metric = store.get_metric("HATS")
+    assert ["colour", "size"] == metric.get_dimension_keys()
+    assert {"red": 2} == metric.get_dimension_value_counts("colour")
+    assert {None: 2} == metric.get_dimension_value_counts("size")
+    metric.add_observation("H3", dimensions={"colour": "red"})
+    assert {"red": 3} == metric.get_dimension_value_counts("colour")
+    store.close()
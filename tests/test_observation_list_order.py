@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"), query_cache_max_entries=10)
+    store.add_metric_json(
+        {
+            "id": "HATS",
+            "title": "Hats",
+            "description": "How many hats?",
+            "observations": [
+                {"id": "1", "measure": "9", "dimensions": {"colour": "red"}},
+                {"id": "2", "measure": "100", "dimensions": {"colour": "blue"}},
+                {"id": "3", "measure": "10", "dimensions": {"colour": "green"}},
+                {"id": "4", "dimensions": {"colour": "blue"}},
+                {"id": "5", "measure": "10", "dimensions": {"size": "big"}},
+                {"id": "6", "measure": "2.5", "dimensions": {"colour": "red"}},
+            ],
+        }
+    )
+    return store
+
+
+def _get_ids(observation_list) -> list:
+    return [o.get_id() for o in observation_list.get_data()]
+
+
+def test_order_by_measure(store):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.order_by_measure()
+
+    assert ["6", "1", "3", "5", "2", "4"] == _get_ids(observation_list)
+
+
+def test_order_by_measure_descending_top_n(store):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.order_by_measure(descending=True)
+    observation_list.set_limit(3)
+
+    assert ["2", "3", "5"] == _get_ids(observation_list)
+
+
+def test_order_by_id_descending(store):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.order_by_id(descending=True)
+
+    assert ["6", "5", "4", "3", "2", "1"] == _get_ids(observation_list)
+
+
+def test_order_by_dimension_then_measure(store):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.order_by_dimension("colour")
+    observation_list.order_by_measure(descending=True)
+
+    assert ["2", "4", "3", "1", "6", "5"] == _get_ids(observation_list)
+
+
+def test_order_by_with_filter(store):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.filter_by_dimension("colour", "red")
+    observation_list.order_by_measure()
+
+    assert ["6", "1"] == _get_ids(observation_list)
+
+
+def test_limit_without_order(store):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.set_limit(2)
+    assert ["1", "2"] == _get_ids(observation_list)
+
+    observation_list.set_limit(0)
+    assert [] == _get_ids(observation_list)
+
+    observation_list.set_limit(None)
+    assert 6 == len(_get_ids(observation_list))
+
+    with pytest.raises(ValueError):
+        observation_list.set_limit(-1)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 4, 100])
+@pytest.mark.parametrize("limit", [None, 3, 5])
+def test_iter_data_ordered(store, batch_size, limit):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.order_by_measure(descending=True)
+    observation_list.set_limit(limit)
+
+    assert _get_ids(observation_list) == [
+        o.get_id() for o in observation_list.iter_data(batch_size=batch_size)
+    ]
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 100])
+def test_iter_data_limit(store, batch_size):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.set_limit(3)
+
+    assert ["1", "2", "3"] == [
+        o.get_id() for o in observation_list.iter_data(batch_size=batch_size)
+    ]
+
+
+def test_order_is_part_of_cache_key(store):
+    observation_list = store.get_metric("HATS").get_observation_list()
+    assert "1" == _get_ids(observation_list)[0]
+
+    observation_list = store.get_metric("HATS").get_observation_list()
+    observation_list.order_by_id(descending=True)
+    assert "6" == _get_ids(observation_list)[0]
+    assert "6" == _get_ids(observation_list)[0]
+    assert 1 == store._query_cache.hits
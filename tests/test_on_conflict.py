@@ -0,0 +1,208 @@
+import os
+
+import pytest
+
+from ocdsmetricsanalysis.exceptions import IdClashException
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"))
+    store.add_metric_json(
+        {
+            "id": "HATS",
+            "title": "Hats",
+            "description": "How many hats?",
+            "observations": [
+                {"id": "H1", "dimensions": {"colour": "red"}, "measure": "10"},
+                {"id": "H2", "dimensions": {"colour": "blue"}, "measure": "20"},
+            ],
+        }
+    )
+    return store
+
+
+NEW_HATS = {
+    "id": "HATS",
+    "title": "Hats!",
+    "observations": [
+        {
+            "id": "H2",
+            "dimensions": {"size": "big"},
+            "value": {"amount": "5", "currency": "GBP"},
+        },
+        {"id": "H3", "dimensions": {"colour": "green"}, "measure": "30"},
+    ],
+}
+
+
+def test_add_metric_error(store):
+    with pytest.raises(IdClashException):
+        store.add_metric("HATS", "Hats!", None)
+
+    assert "Hats" == store.get_metric("HATS").get_json()["title"]
+
+
+def test_add_metric_skip(store):
+    store.add_metric("HATS", "Hats!", None, on_conflict="skip")
+
+    hats = store.get_metric("HATS").get_json()
+    assert "Hats" == hats["title"]
+    assert 2 == len(hats["observations"])
+
+
+def test_add_metric_replace(store):
+    store.add_metric("HATS", "Hats!", None, on_conflict="replace")
+
+    assert {
+        "id": "HATS",
+        "title": "Hats!",
+        "description": None,
+        "observations": [],
+    } == store.get_metric("HATS").get_json()
+    assert [] == store.get_metric("HATS").get_dimension_keys()
+
+
+def test_add_metric_merge(store):
+    store.add_metric("HATS", "Hats!", None, on_conflict="merge")
+
+    hats = store.get_metric("HATS").get_json()
+    assert "Hats!" == hats["title"]
+    assert "How many hats?" == hats["description"]
+    assert 2 == len(hats["observations"])
+
+
+def test_add_metric_bad_on_conflict(store):
+    with pytest.raises(ValueError):
+        store.add_metric("TIES", "Ties", None, on_conflict="shrug")
+
+
+def test_add_metric_json_error(store):
+    with pytest.raises(IdClashException):
+        store.add_metric_json(NEW_HATS)
+
+    assert ["H1", "H2"] == [
+        o["id"] for o in store.get_metric("HATS").get_json()["observations"]
+    ]
+
+
+def test_add_metric_json_observation_clash_is_atomic(store):
+    with pytest.raises(IdClashException):
+        store.add_metric_json(
+            {
+                "id": "TIES",
+                "observations": [
+                    {"id": "T1", "measure": "1"},
+                    {"id": "T1", "measure": "2"},
+                ],
+            }
+        )
+
+    assert ["HATS"] == [m.get_id() for m in store.get_metrics()]
+
+
+def test_add_metric_json_skip(store):
+    store.add_metric_json(NEW_HATS, on_conflict="skip")
+
+    hats = store.get_metric("HATS").get_json()
+    assert "Hats" == hats["title"]
+    assert ["H1", "H2"] == [o["id"] for o in hats["observations"]]
+
+
+def test_add_metric_json_replace(store):
+    store.add_metric_json(NEW_HATS, on_conflict="replace")
+
+    hats = store.get_metric("HATS").get_json()
+    assert "Hats!" == hats["title"]
+    assert None is hats["description"]
+    assert ["H2", "H3"] == [o["id"] for o in hats["observations"]]
+    assert {"size": "big"} == hats["observations"][0]["dimensions"]
+
+
+def test_add_metric_json_merge(store):
+    store.add_metric_json(NEW_HATS, on_conflict="merge")
+
+    assert {
+        "id": "HATS",
+        "title": "Hats!",
+        "description": "How many hats?",
+        "observations": [
+            {"id": "H1", "dimensions": {"colour": "red"}, "measure": "10"},
+            {
+                "id": "H2",
+                "dimensions": {"colour": "blue", "size": "big"},
+                "value": {"amount": "5", "currency": "GBP"},
+                "measure": "20",
+            },
+            {"id": "H3", "dimensions": {"colour": "green"}, "measure": "30"},
+        ],
+    } == store.get_metric("HATS").get_json()
+
+
+def test_add_observation_error(store):
+    metric = store.get_metric("HATS")
+    with pytest.raises(IdClashException):
+        metric.add_observation("H1", measure="99", dimensions={"size": "big"})
+
+    assert {"colour": "red"} == metric.get_observation_list().get_data()[
+        0
+    ].get_dimensions()
+
+
+def test_add_observation_skip(store):
+    metric = store.get_metric("HATS")
+    metric.add_observation(
+        "H1", measure="99", dimensions={"size": "big"}, on_conflict="skip"
+    )
+
+    observation = metric.get_observation_list().get_data()[0]
+    assert "10" == observation.get_measure()
+    assert {"colour": "red"} == observation.get_dimensions()
+
+
+def test_add_observation_replace(store):
+    metric = store.get_metric("HATS")
+    metric.add_observation(
+        "H1", value_amount="5", dimensions={"size": "big"}, on_conflict="replace"
+    )
+
+    observation = metric.get_observation_list().get_data()[0]
+    assert None is observation.get_measure()
+    assert "5" == observation.get_value_amount()
+    assert {"size": "big"} == observation.get_dimensions()
+    assert {"blue": 1} == metric.get_dimension_value_counts("colour")
+
+
+def test_add_observation_merge(store):
+    metric = store.get_metric("HATS")
+    metric.add_observation(
+        "H1",
+        value_amount="5",
+        dimensions={"colour": "pink", "size": "big"},
+        on_conflict="merge",
+    )
+
+    observation = metric.get_observation_list().get_data()[0]
+    assert "10" == observation.get_measure()
+    assert "5" == observation.get_value_amount()
+    assert {"colour": "pink", "size": "big"} == observation.get_dimensions()
+    assert {"blue": 1, "pink": 1} == metric.get_dimension_value_counts("colour")
+
+
+def test_add_aggregate_observations_replace(store):
+    store.add_metric("SOCKS", "Socks", "Any?")
+    metric = store.get_metric("SOCKS")
+    metric.add_aggregate_observations([{"a": "yes"}, {"a": "no"}], "a", "answer")
+
+    with pytest.raises(IdClashException):
+        metric.add_aggregate_observations([{"a": "yes"}], "a", "answer")
+
+    metric.add_aggregate_observations(
+        [{"a": "yes"}, {"a": "yes"}], "a", "answer", on_conflict="replace"
+    )
+    observations = metric.get_observation_list().get_data()
+    assert ["2", "1"] == [o.get_measure() for o in observations]
+    assert [{"answer": "yes"}, {"answer": "yes"}] == [
+        o.get_dimensions() for o in observations
+    ]
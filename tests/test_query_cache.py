@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from ocdsmetricsanalysis.cache import QueryCache
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"), query_cache_max_entries=2)
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_observation("H1", measure="10", dimensions={"colour": "red"})
+    metric.add_observation("H2", measure="20", dimensions={"colour": "blue"})
+    return store
+
+
+def _get_ids(metric, **filters) -> list:
+    observation_list = metric.get_observation_list()
+    for key, value in filters.items():
+        observation_list.filter_by_dimension(key, value)
+    return [o.get_id() for o in observation_list.get_data()]
+
+
+def test_cache_hit(store):
+    metric = store.get_metric("HATS")
+
+    assert ["H1"] == _get_ids(metric, colour="red")
+    assert ["H1"] == _get_ids(metric, colour="red")
+    assert ["H2"] == _get_ids(metric, colour="blue")
+
+    assert 1 == store._query_cache.hits
+    assert 2 == store._query_cache.misses
+
+
+def test_add_observation_invalidates(store):
+    metric = store.get_metric("HATS")
+    assert ["H1"] == _get_ids(metric, colour="red")
+
+    metric.add_observation("H3", measure="30", dimensions={"colour": "red"})
+
+    assert ["H1", "H3"] == _get_ids(metric, colour="red")
+    assert 0 == store._query_cache.hits
+
+
+def test_add_metric_json_invalidates(store):
+    metric = store.get_metric("HATS")
+    assert ["H1", "H2"] == _get_ids(metric)
+
+    store.add_metric_json({"id": "TIES", "observations": []})
+
+    assert ["H1", "H2"] == _get_ids(metric)
+    assert 0 == store._query_cache.hits
+
+
+def test_add_aggregate_observations_invalidates(store):
+    store.add_metric("SOCKS", "Socks", "Any?")
+    metric = store.get_metric("SOCKS")
+    assert [] == _get_ids(metric)
+
+    metric.add_aggregate_observations([{"a": "yes"}], "a", "answer")
+
+    assert ["000000001"] == _get_ids(metric)
+
+
+def test_query_cache_lru():
+    query_cache = QueryCache(2)
+    query_cache.put("a", 1, [1])
+    query_cache.put("b", 1, [2])
+    assert [1] == query_cache.get("a", 1)
+    query_cache.put("c", 1, [3])
+
+    assert [1] == query_cache.get("a", 1)
+    assert query_cache.get("b", 1) is None
+    assert [3] == query_cache.get("c", 1)
+
+
+def test_query_cache_max_rows():
+    query_cache = QueryCache(10, max_rows=3)
+    query_cache.put("a", 1, [1, 2])
+    query_cache.put("b", 1, [1, 2])
+    query_cache.put("c", 1, [1, 2, 3, 4])
+
+    assert query_cache.get("a", 1) is None
+    assert [1, 2] == query_cache.get("b", 1)
+    assert query_cache.get("c", 1) is None
+
+
+def test_query_cache_generation():
+    query_cache = QueryCache(10)
+    query_cache.put("a", 1, [1])
+
+    assert query_cache.get("a", 2) is None
+    assert query_cache.get("a", 1) is None
@@ -0,0 +1,228 @@
+import os
+import random
+from collections import Counter
+
+import pytest
+
+from ocdsmetricsanalysis.library import Store
+from ocdsmetricsanalysis.sketch import (
+    AggregateSketch,
+    CountMinSketch,
+    HeavyHitters,
+)
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"))
+    store.add_metric("HATS", "Hats", "How many hats?")
+    return store
+
+
+def _get_skewed_keys() -> list:
+    random.seed(42)
+    return [("key%d" % int(random.paretovariate(1.2)),) for i in range(20000)]
+
+
+def test_count_min_sketch_never_underestimates():
+    keys = _get_skewed_keys()
+    count_min_sketch = CountMinSketch(epsilon=0.01, delta=0.01)
+    for key in keys:
+        count_min_sketch.add(key)
+
+    for key, count in Counter(keys).items():
+        estimate = count_min_sketch.estimate(key)
+        assert estimate >= count
+        assert estimate <= count + 0.01 * len(keys)
+
+
+def test_count_min_sketch_merge():
+    keys = _get_skewed_keys()
+    all_sketch = CountMinSketch()
+    sketch_1 = CountMinSketch()
+    sketch_2 = CountMinSketch()
+    for i, key in enumerate(keys):
+        all_sketch.add(key)
+        (sketch_1 if i % 2 else sketch_2).add(key)
+
+    sketch_1.merge(sketch_2)
+
+    assert all_sketch.total == sketch_1.total
+    for key in set(keys):
+        assert all_sketch.estimate(key) == sketch_1.estimate(key)
+
+
+def test_count_min_sketch_merge_different_settings():
+    with pytest.raises(ValueError):
+        CountMinSketch(epsilon=0.01).merge(CountMinSketch(epsilon=0.001))
+
+
+def test_heavy_hitters():
+    keys = _get_skewed_keys()
+    heavy_hitters = HeavyHitters(20)
+    for key in keys:
+        heavy_hitters.add(key)
+
+    expected = [k for k, c in Counter(keys).most_common(5)]
+    assert expected == [k for k, c in heavy_hitters.top(5)]
+
+
+def test_heavy_hitters_heap():
+    heavy_hitters = HeavyHitters(50)
+    # Keys that can not be compared with each other, so the heap must never compare them
+    keys = [(None,), ("a",), (1,)] + _get_skewed_keys()
+    for key in keys:
+        heavy_hitters.add(key)
+
+    assert 50 == len(heavy_hitters._candidates) == len(heavy_hitters._heap)
+    assert set(heavy_hitters._candidates) == set(e[2] for e in heavy_hitters._heap)
+    for estimate, sequence_number, key in heavy_hitters._heap:
+        assert estimate <= heavy_hitters._candidates[key]
+    # The candidate dropped each time was the one with the lowest estimate, so the top keys are all kept
+    expected = [k for k, c in Counter(keys).most_common(5)]
+    assert sorted(expected) == sorted(k for k, c in heavy_hitters.top(5))
+
+
+def test_heavy_hitters_merge():
+    keys = _get_skewed_keys()
+    heavy_hitters_1 = HeavyHitters(20)
+    heavy_hitters_2 = HeavyHitters(20)
+    for i, key in enumerate(keys):
+        (heavy_hitters_1 if i % 2 else heavy_hitters_2).add(key)
+
+    heavy_hitters_1.merge(heavy_hitters_2)
+
+    expected = Counter(keys).most_common(5)
+    assert [k for k, c in expected] == [k for k, c in heavy_hitters_1.top(5)]
+
+
+def test_add_aggregate_observations_approximate(store):
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        [
+            {"like_answer": "yes", "height_answer": "tall"},
+            {"like_answer": "no", "height_answer": "tall"},
+            {"like_answer": "no", "height_answer": "tall"},
+            {"like_answer": "yes", "height_answer": "short"},
+            {"like_answer": "yes", "height_answer": "short"},
+            {"like_answer": "maybe", "height_answer": ""},
+        ],
+        "like_answer",
+        "answer",
+        idx_to_dimensions={"height_answer": {"dimension_name": "height"}},
+        approximate_top_n=2,
+    )
+
+    observations = metric.get_observation_list().get_data()
+
+    expected_answers = [
+        ("2", "no", None),
+        ("3", "yes", None),
+        ("2", "no", "tall"),
+        ("2", "yes", "short"),
+    ]
+    assert expected_answers == [
+        (
+            o.get_measure(),
+            o.get_dimensions()["answer"],
+            o.get_dimensions().get("height"),
+        )
+        for o in observations
+    ]
+    assert {
+        "epsilon": 0.001,
+        "delta": 0.01,
+        "max_error": 0.006,
+    } == store.get_metric("HATS").get_approximation()
+
+
+def test_add_aggregate_observations_from_merged_sketches(store):
+    keys = _get_skewed_keys()
+    sketches = [
+        AggregateSketch(
+            "like_answer",
+            idx_to_dimensions={"height_answer": {"dimension_name": "height"}},
+            top_n=3,
+        )
+        for i in range(2)
+    ]
+    for i in range(2):
+        sketches[i].add_rows(
+            {
+                "like_answer": [k[0] for k in keys[i::2]],
+                "height_answer": [
+                    "tall" if len(k[0]) % 2 else "short" for k in keys[i::2]
+                ],
+            }
+        )
+    sketches[0].merge(sketches[1])
+
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations_from_sketch(sketches[0], "answer")
+
+    observations = metric.get_observation_list()
+    observations.filter_by_dimension_not_set("height")
+    expected = sorted(Counter([k[0] for k in keys]).most_common(3))
+    assert [(k, str(c)) for k, c in expected] == [
+        (o.get_dimensions()["answer"], o.get_measure()) for o in observations.get_data()
+    ]
+    assert 20 == metric.get_approximation()["max_error"]
+
+
+@pytest.mark.parametrize("counting_backend", ["python", "numpy"])
+def test_add_aggregate_observations_approximate_numpy(store, counting_backend):
+    numpy = pytest.importorskip("numpy")
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations(
+        {"like_answer": numpy.array([1, 2, 2, 3])},
+        "like_answer",
+        "answer",
+        approximate_top_n=5,
+        counting_backend=counting_backend,
+    )
+
+    assert [{"answer": "1"}, {"answer": "2"}, {"answer": "3"}] == [
+        o.get_dimensions() for o in metric.get_observation_list().get_data()
+    ]
+
+
+def test_sketch_merge_numpy_and_list():
+    numpy = pytest.importorskip("numpy")
+    sketches = [AggregateSketch("like_answer", top_n=2) for i in range(2)]
+    sketches[0].add_rows({"like_answer": numpy.array([1, 2, 2])})
+    sketches[1].add_rows({"like_answer": [2, 1, 1, 1]})
+    sketches[0].merge(sketches[1])
+
+    assert [((), [((1,), 4), ((2,), 3)])] == sketches[0].get_top_combinations()
+
+
+def test_sketch_add_rows_in_bounded_batches(monkeypatch):
+    monkeypatch.setattr("ocdsmetricsanalysis.sketch.BOUNDED_MEMORY_BATCH_SIZE", 2)
+    rows_taken = []
+
+    def get_rows():
+        for i in range(5):
+            rows_taken.append(i)
+            yield {"like_answer": "yes"}
+
+    sketch = AggregateSketch("like_answer", top_n=1)
+    batch_sizes = []
+    original_add = sketch._heavy_hitters[0].add
+
+    def add(key, count=1):
+        batch_sizes.append(len(rows_taken))
+        original_add(key, count)
+
+    sketch._heavy_hitters[0].add = add  # type: ignore
+    sketch.add_rows(get_rows())
+
+    # Each batch was counted before the next rows were read
+    assert [2, 4, 5] == batch_sizes
+    assert [((), [(("yes",), 5)])] == sketch.get_top_combinations()
+
+
+def test_get_approximation_exact(store):
+    metric = store.get_metric("HATS")
+    metric.add_aggregate_observations([{"a": "yes"}], "a", "answer")
+
+    assert metric.get_approximation() is None
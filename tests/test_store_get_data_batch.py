@@ -0,0 +1,117 @@
+import json
+import os
+
+import pytest
+
+from ocdsmetricsanalysis import library
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"), query_cache_max_entries=100)
+    for filename in ["one_dimension.json", "two_dimensions.json"]:
+        source_file = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "data", filename
+        )
+        with open(source_file) as fp:
+            data = json.load(fp)
+        data["id"] = filename
+        store.add_metric_json(data)
+    return store
+
+
+def _get_observation_lists(store) -> dict:
+    observation_lists = {}
+    for height in ["tall", "short", "medium"]:
+        observation_list = store.get_metric(
+            "two_dimensions.json"
+        ).get_observation_list()
+        observation_list.filter_by_dimension("height", height)
+        observation_lists[height] = observation_list
+    top = store.get_metric("one_dimension.json").get_observation_list()
+    top.order_by_measure(descending=True)
+    top.set_limit(2)
+    observation_lists[("top", 2)] = top
+    everything = store.get_metric("one_dimension.json").get_observation_list()
+    observation_lists["everything"] = everything
+    return observation_lists
+
+
+def _get_ids(results: dict) -> dict:
+    return {key: [o.get_id() for o in value] for key, value in results.items()}
+
+
+def test_get_data_batch_matches_get_data(store):
+    observation_lists = _get_observation_lists(store)
+    expected = {
+        key: observation_list.get_data()
+        for key, observation_list in observation_lists.items()
+    }
+
+    # Use a fresh store without a cache, so everything is queried in the batch
+    batch_store = Store(store._database_filename)
+    results = batch_store.get_data_batch(_get_observation_lists(batch_store))
+
+    assert _get_ids(expected) == _get_ids(results)
+    assert [] == results["medium"]
+    assert ["2", "1"] == [o.get_id() for o in results[("top", 2)]]
+    assert {"answer": "Hate", "height": "tall"} == results["tall"][0].get_dimensions()
+    batch_store.close()
+
+
+def test_get_data_batch_one_statement(store):
+    observation_lists = _get_observation_lists(store)
+    statements = []
+    connection = store._get_read_connection()
+    connection.set_trace_callback(statements.append)
+
+    results = store.get_data_batch(observation_lists)
+
+    connection.set_trace_callback(None)
+    assert 1 == len(statements)
+    assert 5 == len(results)
+
+
+def test_get_data_batch_many_statements(store, monkeypatch):
+    monkeypatch.setattr(library, "BATCH_QUERY_MAX_OBSERVATION_LISTS", 2)
+    observation_lists = _get_observation_lists(store)
+    expected = _get_ids(
+        {
+            key: observation_list.get_data()
+            for key, observation_list in observation_lists.items()
+        }
+    )
+    store._query_cache.clear()
+
+    assert expected == _get_ids(store.get_data_batch(observation_lists))
+
+
+def test_get_data_batch_uses_cache(store):
+    observation_lists = _get_observation_lists(store)
+    observation_lists["tall"].get_data()
+    hits = store._query_cache.hits
+
+    results = store.get_data_batch(observation_lists)
+    assert hits + 1 == store._query_cache.hits
+
+    # Everything is in the cache now
+    assert _get_ids(results) == _get_ids(store.get_data_batch(observation_lists))
+    assert hits + 1 + len(observation_lists) == store._query_cache.hits
+    assert _get_ids(results)["short"] == [
+        o.get_id() for o in observation_lists["short"].get_data()
+    ]
+
+
+def test_get_data_batch_other_store(store, tmpdir):
+    other_store = Store(os.path.join(tmpdir, "other.sqlite"))
+    other_store.add_metric("HATS", "Hats", "How many hats?")
+
+    with pytest.raises(ValueError):
+        store.get_data_batch(
+            {"other": other_store.get_metric("HATS").get_observation_list()}
+        )
+
+
+def test_get_data_batch_empty(store):
+    assert {} == store.get_data_batch({})
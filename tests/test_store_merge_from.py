@@ -0,0 +1,163 @@
+import os
+import sqlite3
+
+import pytest
+
+from ocdsmetricsanalysis.exceptions import IdClashException
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"))
+    store.add_metric("HATS", "Hats", "How many hats?")
+    metric = store.get_metric("HATS")
+    metric.add_observation("H1", measure="10", dimensions={"colour": "red"})
+    metric.add_observation("H2", measure="20", dimensions={"colour": "blue"})
+    return store
+
+
+@pytest.fixture
+def other_database_filename(tmpdir) -> str:
+    database_filename = os.path.join(tmpdir, "other.sqlite")
+    store = Store(database_filename)
+    store.add_metric("HATS", "Hats!", None)
+    metric = store.get_metric("HATS")
+    metric.add_observation(
+        "H2", value_amount="5", value_currency="GBP", dimensions={"size": "big"}
+    )
+    metric.add_observation("H3", measure="30", dimensions={"colour": "green"})
+    store.add_metric("TIES", "Ties", "Why?")
+    store.get_metric("TIES").add_observation(
+        "T1", measure="1", dimensions={"colour": "red"}
+    )
+    store.close()
+    return database_filename
+
+
+def test_merge_from_no_clash(store, tmpdir):
+    database_filename = os.path.join(tmpdir, "other.sqlite")
+    other_store = Store(database_filename)
+    other_store.add_metric("TIES", "Ties", "Why?")
+    other_store.get_metric("TIES").add_observation(
+        "T1", measure="1", dimensions={"colour": "red"}
+    )
+    other_store.close()
+
+    store.merge_from(database_filename)
+
+    assert ["HATS", "TIES"] == [m.get_id() for m in store.get_metrics()]
+    assert {
+        "id": "TIES",
+        "title": "Ties",
+        "description": "Why?",
+        "observations": [
+            {"id": "T1", "dimensions": {"colour": "red"}, "measure": "1"},
+        ],
+    } == store.get_metric("TIES").get_json()
+
+
+def test_merge_from_error(store, other_database_filename):
+    with pytest.raises(IdClashException):
+        store.merge_from(other_database_filename)
+
+    # Nothing was copied
+    assert ["HATS"] == [m.get_id() for m in store.get_metrics()]
+    assert 2 == len(store.get_metric("HATS").get_observation_list().get_data())
+
+
+def test_merge_from_skip(store, other_database_filename):
+    store.merge_from(other_database_filename, on_conflict="skip")
+
+    assert ["HATS", "TIES"] == [m.get_id() for m in store.get_metrics()]
+    hats = store.get_metric("HATS").get_json()
+    assert "Hats" == hats["title"]
+    assert ["H1", "H2"] == [o["id"] for o in hats["observations"]]
+    assert {"colour": "blue"} == hats["observations"][1]["dimensions"]
+
+
+def test_merge_from_replace(store, other_database_filename):
+    store.merge_from(other_database_filename, on_conflict="replace")
+
+    assert ["HATS", "TIES"] == [m.get_id() for m in store.get_metrics()]
+    assert {
+        "id": "HATS",
+        "title": "Hats!",
+        "description": None,
+        "observations": [
+            {
+                "id": "H2",
+                "dimensions": {"size": "big"},
+                "value": {"amount": "5", "currency": "GBP"},
+            },
+            {"id": "H3", "dimensions": {"colour": "green"}, "measure": "30"},
+        ],
+    } == store.get_metric("HATS").get_json()
+
+
+def test_merge_from_merge(store, other_database_filename):
+    store.merge_from(other_database_filename, on_conflict="merge")
+
+    assert ["HATS", "TIES"] == [m.get_id() for m in store.get_metrics()]
+    assert {
+        "id": "HATS",
+        "title": "Hats!",
+        "description": "How many hats?",
+        "observations": [
+            {"id": "H1", "dimensions": {"colour": "red"}, "measure": "10"},
+            {
+                "id": "H2",
+                "dimensions": {"colour": "blue", "size": "big"},
+                "value": {"amount": "5", "currency": "GBP"},
+                "measure": "20",
+            },
+            {"id": "H3", "dimensions": {"colour": "green"}, "measure": "30"},
+        ],
+    } == store.get_metric("HATS").get_json()
+
+
+def test_merge_from_bad_on_conflict(store, other_database_filename):
+    with pytest.raises(ValueError):
+        store.merge_from(other_database_filename, on_conflict="shrug")
+
+
+def test_merge_from_file_not_found(store, tmpdir):
+    missing_filename = os.path.join(tmpdir, "missing.sqlite")
+    with pytest.raises(sqlite3.OperationalError, match="unable to open database"):
+        store.merge_from(missing_filename)
+    assert not os.path.exists(missing_filename)
+    # The store can still be written to
+    store.add_metric("TIES", "Ties", "Why?")
+
+
+def test_merge_from_replace_dimension_catalog(store, other_database_filename):
+    store.merge_from(other_database_filename, on_conflict="replace")
+
+    metric = store.get_metric("HATS")
+    assert ["colour", "size"] == metric.get_dimension_keys()
+    assert {"green": 1} == metric.get_dimension_value_counts("colour")
+
+
+def test_merge_from_merge_dimension_catalog(store, other_database_filename):
+    store.merge_from(other_database_filename, on_conflict="merge")
+
+    metric = store.get_metric("HATS")
+    assert ["colour", "size"] == metric.get_dimension_keys()
+    assert {"blue": 1, "green": 1, "red": 1} == metric.get_dimension_value_counts(
+        "colour"
+    )
+    assert {"red": 1} == store.get_metric("TIES").get_dimension_value_counts("colour")
+
+
+def test_merge_from_merge_changed_dimension_catalog(store, tmpdir):
+    database_filename = os.path.join(tmpdir, "other.sqlite")
+    other_store = Store(database_filename)
+    other_store.add_metric("HATS", "Hats", None)
+    other_store.get_metric("HATS").add_observation(
+        "H1", measure="10", dimensions={"colour": "blue"}
+    )
+    other_store.close()
+
+    store.merge_from(database_filename, on_conflict="merge")
+
+    assert {"blue": 2} == store.get_metric("HATS").get_dimension_value_counts("colour")
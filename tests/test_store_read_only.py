@@ -0,0 +1,81 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from ocdsmetricsanalysis.exceptions import ReadOnlyStoreException
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def database_filename(tmpdir) -> str:
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+    store = Store(database_filename)
+    source_file = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "data",
+        "one_and_two_dimensions.json",
+    )
+    with open(source_file) as fp:
+        store.add_metric_json(json.load(fp))
+    store.close()
+    return database_filename
+
+
+@pytest.mark.parametrize("immutable", [False, True])
+@pytest.mark.parametrize("mmap_size", [None, 0, 2**20])
+def test_read_only_query(database_filename, immutable, mmap_size):
+    store = Store(
+        database_filename, read_only=True, immutable=immutable, mmap_size=mmap_size
+    )
+    metric = store.get_metric("HATS")
+    observation_list = metric.get_observation_list()
+    observation_list.filter_by_dimension("height", "short")
+
+    assert ["2"] == [o.get_id() for o in observation_list.get_data()]
+    assert ["answer", "height"] == metric.get_dimension_keys()
+    if mmap_size is not None:
+        assert [(mmap_size,)] == [
+            tuple(r) for r in store._get_read_connection().execute("PRAGMA mmap_size")
+        ]
+    store.close()
+
+
+def test_read_only_write_raises(database_filename):
+    store = Store(database_filename, read_only=True)
+
+    with pytest.raises(ReadOnlyStoreException):
+        store.add_metric("TIES", "Ties", "Why?")
+    with pytest.raises(ReadOnlyStoreException):
+        store.get_metric("HATS").add_observation("3", dimensions={"answer": "Hate"})
+
+    assert ["HATS"] == [m.get_id() for m in store.get_metrics()]
+    store.close()
+
+
+def test_read_only_diff(database_filename, tmpdir):
+    other_store = Store(os.path.join(tmpdir, "other.sqlite"))
+    other_store.add_metric("HATS", "Hats", "How many hats?")
+    store = Store(database_filename, read_only=True, immutable=True)
+
+    changes = list(store.get_metric("HATS").diff(other_store.get_metric("HATS")))
+    assert ["removed", "removed"] == [c["change"] for c in changes]
+
+    changes = list(other_store.get_metric("HATS").diff(store.get_metric("HATS")))
+    assert ["added", "added"] == [c["change"] for c in changes]
+    store.close()
+    other_store.close()
+
+
+def test_read_only_database_not_found(tmpdir):
+    database_filename = os.path.join(tmpdir, "database.sqlite")
+
+    with pytest.raises(sqlite3.OperationalError):
+        Store(database_filename, read_only=True)
+    assert not os.path.exists(database_filename)
+
+
+def test_immutable_needs_read_only(database_filename):
+    with pytest.raises(ValueError):
+        Store(database_filename, immutable=True)
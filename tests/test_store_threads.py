@@ -0,0 +1,184 @@
+import json
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from ocdsmetricsanalysis.exceptions import IdClashException
+from ocdsmetricsanalysis.library import Store
+
+
+@pytest.fixture
+def store(tmpdir) -> Store:
+    store = Store(os.path.join(tmpdir, "database.sqlite"))
+    source_file = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), "data", "two_dimensions.json"
+    )
+    with open(source_file) as fp:
+        data = json.load(fp)
+    store.add_metric_json(data)
+    return store
+
+
+def test_journal_mode_is_wal(store):
+    cur = store._get_read_connection().cursor()
+    cur.execute("PRAGMA journal_mode")
+    assert "wal" == cur.fetchone()[0]
+
+
+def test_read_from_many_threads(store):
+    expected = store.get_metric("HATS").get_json()
+    results: list = []
+    errors: list = []
+
+    def read():
+        try:
+            results.append(store.get_metric("HATS").get_json())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [] == errors
+    assert 8 == len(results)
+    for result in results:
+        assert expected == result
+    # Each reading thread had its own read connection, which was closed when it finished
+    assert 1 == len(store._read_connections)
+
+
+def test_read_connections_closed_when_threads_finish(store):
+    connections: list = []
+
+    def read():
+        store.get_metric("HATS")
+        connections.append(store._get_read_connection())
+
+    store.get_metrics()
+    for i in range(200):
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+    assert 200 == len(connections)
+    # Only the main thread's connection is still open
+    assert 1 == len(store._read_connections)
+    with pytest.raises(sqlite3.ProgrammingError):
+        connections[0].execute("SELECT 1")
+
+
+def test_write_from_many_threads(store):
+    store.add_metric("TIES", "Ties", "Why?")
+    metric = store.get_metric("TIES")
+
+    def write(thread_number):
+        for i in range(10):
+            metric.add_observation(
+                "%d-%d" % (thread_number, i),
+                measure=str(i),
+                dimensions={"thread": str(thread_number)},
+            )
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 40 == len(metric.get_observation_list().get_data())
+
+
+def test_failed_write_is_rolled_back(store):
+    store.add_metric("TIES", "Ties", "Why?")
+    with pytest.raises(Exception):
+        store.add_metric_json(
+            {
+                "id": "SOCKS",
+                "observations": [
+                    {"id": "1", "measure": "1"},
+                    {"id": "1", "measure": "2"},
+                ],
+            }
+        )
+    assert ["HATS", "TIES"] == [m.get_id() for m in store.get_metrics()]
+
+
+def test_close(store):
+    store.get_metrics()
+    store.close()
+    assert set() == store._read_connections
+
+
+def test_in_memory_store(tmpdir):
+    store = Store(":memory:")
+    store.add_metric("TIES", "Ties", "Why?")
+    metric = store.get_metric("TIES")
+    metric.add_observation("1", measure="10", dimensions={"colour": "red"})
+    results: list = []
+
+    def read():
+        results.append(store.get_metric("TIES").get_json())
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+
+    assert [metric.get_json()] == results
+    assert {"colour": "red"} == metric.get_observation_list().get_data()[
+        0
+    ].get_dimensions()
+    # Two in-memory stores do not share data
+    other_store = Store(":memory:")
+    assert [] == other_store.get_metrics()
+    other_store.close()
+    temporary_directory = os.path.dirname(
+        store._get_read_connection().execute("PRAGMA database_list").fetchone()["file"]
+    )
+    assert os.path.exists(temporary_directory)
+    store.close()
+    assert not os.path.exists(temporary_directory)
+    assert not os.path.exists(":memory:")
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_read_during_write_that_rolls_back(tmpdir, in_memory):
+    store = Store(":memory:" if in_memory else os.path.join(tmpdir, "database.sqlite"))
+    store.add_metric("A", "A", "A")
+    counts_seen: list = []
+
+    def count_observations():
+        counts_seen.append(
+            store._get_read_connection()
+            .execute("SELECT COUNT(*) FROM observation WHERE metric_id='B'")
+            .fetchone()[0]
+        )
+
+    original_add_observation = store._add_observation
+
+    def add_observation(cur, metric_id, id, *args, **kwargs):
+        # Read from another thread, part way through the write
+        if id == "500":
+            thread = threading.Thread(target=count_observations)
+            thread.start()
+            thread.join()
+        return original_add_observation(cur, metric_id, id, *args, **kwargs)
+
+    store._add_observation = add_observation  # type: ignore
+    with pytest.raises(IdClashException):
+        store.add_metric_json(
+            {
+                "id": "B",
+                "observations": [{"id": str(i), "measure": "1"} for i in range(1000)]
+                + [{"id": "0", "measure": "2"}],
+            }
+        )
+    count_observations()
+
+    assert [0, 0] == counts_seen
+    assert ["A"] == [m.get_id() for m in store.get_metrics()]
+    store.close()